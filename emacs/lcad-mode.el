@@ -20,6 +20,7 @@
 				"curve" 
 				"cross-product" 
 				"def" 
+				"defmemo" 
 				"dot-product" 
 				"for" 
 				"group" 
@@ -79,6 +80,7 @@
 
 ;; lcad specific offsets here
 (put 'def 'lcad-indent-function 'defun)
+(put 'defmemo 'lcad-indent-function 'defun)
 (put 'for 'lcad-indent-function 1)
 (put 'group 'lcad-indent-function 1)
 (put 'if 'lcad-indent-function 2)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+.. module:: arrayFunctions
+   :synopsis: array, arange, linspace, etc.
+
+.. moduleauthor:: Hazen Babcock
+
+Arrays are numpy arrays of numbers. The math functions work on each
+element of an array, so that calculations like the positions of a
+large number of parts can be done without a loop. For example::
+
+ (def x (* 20 (arange 100)))  ; 0, 20, .. 1980
+ (def y (* 40 (sin (/ x 400))))
+
+"""
+
+import numbers
+import numpy
+
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.lcadExceptions as lce
+import opensdraw.lcad_language.lcadTypes as lcadTypes
+
+lcad_functions = {}
+
+
+def toArray(vals):
+    """
+    Return a numpy array as a LCadArray.
+    """
+    return numpy.asarray(vals).view(lcadTypes.LCadArray)
+
+
+class ArrayFunction(interp.LCadFunction):
+    pure = True
+
+
+class Arange(ArrayFunction):
+    """
+    **arange** - Create an array of evenly spaced numbers.
+
+    This works like Python's range(), and like for, the last number
+    is not included.
+
+    Usage::
+
+     (arange 5)         ; 0, 1, 2, 3, 4
+     (arange 1 5)       ; 1, 2, 3, 4
+     (arange 0 1 0.25)  ; 0, 0.25, 0.5, 0.75
+
+    """
+    def __init__(self):
+        ArrayFunction.__init__(self, "arange")
+        self.setSignature([[numbers.Number], ["optional", [numbers.Number]]])
+
+    def call(self, model, *vals):
+        if (len(vals) > 3):
+            raise lce.NumberArgumentsException("1, 2 or 3", len(vals))
+        return toArray(numpy.arange(*vals))
+
+lcad_functions["arange"] = Arange()
+
+
+class Array(ArrayFunction):
+    """
+    **array** - Create an array.
+
+    The elements can be numbers, or a list (of lists), vector or matrix.
+
+    Usage::
+
+     (array 1 2 3)                        ; The array 1, 2, 3.
+     (array (list 1 2 3))                 ; The same array.
+     (array (list (list 1 2) (list 3 4))) ; A 2 x 2 array.
+
+    """
+    def __init__(self):
+        ArrayFunction.__init__(self, "array")
+        self.setSignature([[numbers.Number, list, numpy.ndarray], ["optional", [numbers.Number]]])
+
+    def call(self, model, *vals):
+        if not isinstance(vals[0], numbers.Number):
+            if (len(vals) > 1):
+                raise lce.NumberArgumentsException("1", len(vals))
+            vals = vals[0]
+        try:
+            array = numpy.array(vals)
+        except ValueError:
+            raise lce.LCadException("the lists must all have the same length.")
+        if not numpy.issubdtype(array.dtype, numpy.number):
+            raise lce.WrongTypeException("number", array.dtype)
+        return array.view(lcadTypes.LCadArray)
+
+lcad_functions["array"] = Array()
+
+
+class Linspace(ArrayFunction):
+    """
+    **linspace** - Create an array of evenly spaced numbers.
+
+    Unlike arange, the last number is included.
+
+    :param start: The first number.
+    :param stop: The last number.
+    :param n: The number of numbers.
+
+    Usage::
+
+     (linspace 0 1 5)  ; 0, 0.25, 0.5, 0.75, 1.0
+
+    """
+    def __init__(self):
+        ArrayFunction.__init__(self, "linspace")
+        self.setSignature([[numbers.Number], [numbers.Number], [int]])
+
+    def call(self, model, start, stop, n):
+        if (n < 0):
+            raise lce.LCadException("the number of numbers must be positive, got " + str(n))
+        return toArray(numpy.linspace(start, stop, n))
+
+lcad_functions["linspace"] = Linspace()
+
+
+class Slice(ArrayFunction):
+    """
+    **slice** - Return a copy of part of an array or a list.
+
+    The indices work the same as in Python, the element at the stop index
+    is not included and negative indices count from the end.
+
+    :param start: The index of the first element.
+    :param stop: (Optional) The index after the last element, defaults to the end.
+    :param step: (Optional) The step between elements, defaults to 1.
+
+    Usage::
+
+     (slice (arange 10) 2 5)    ; 2, 3, 4
+     (slice (arange 10) 7)      ; 7, 8, 9
+     (slice (arange 10) 0 10 3) ; 0, 3, 6, 9
+     (slice (list 1 2 3) -1)    ; The list (3).
+
+    """
+    def __init__(self):
+        ArrayFunction.__init__(self, "slice")
+        self.setSignature([[list, lcadTypes.LCadArray], [int], ["optional", [int]]])
+
+    def call(self, model, vals, *indices):
+        if (len(indices) > 3):
+            raise lce.NumberArgumentsException("2, 3 or 4", len(indices) + 1)
+        if (len(indices) > 2) and (indices[2] == 0):
+            raise lce.LCadException("slice step cannot be zero.")
+        part = vals[slice(*indices) if (len(indices) > 1) else slice(indices[0], None)]
+        if isinstance(part, numpy.ndarray):
+            return part.copy()
+        return part
+
+lcad_functions["slice"] = Slice()
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
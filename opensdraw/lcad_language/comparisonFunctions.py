@@ -29,6 +29,8 @@ class ComparisonFunction(interp.LCadFunction):
     """
     Comparison functions, =, >, <, >=, <=, !=.
     """
+    pure = True
+
     def __init__(self, name):
         interp.LCadFunction.__init__(self, name)
         self.setSignature([[basestring, numbers.Number], 
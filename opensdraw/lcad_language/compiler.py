@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+.. module:: compiler
+   :synopsis: Compiles the lcad AST into a tree of Python closures.
+
+.. moduleauthor:: Hazen Babcock
+
+The closure for each node is stored in the nodes code attribute and
+interpreter.interpret() will use it instead of walking the node. This
+means that SpecialFunctions, which evaluate their arguments by calling
+interpret(), get the benefit of compilation without any changes.
+
+"""
+
+import opensdraw.lcad_language.folding as folding
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.lcadExceptions as lce
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+
+def compileConstant(tree):
+    """
+    Constants just return their (captured) value.
+    """
+    value = tree.value
+
+    def constant(model):
+        return value
+
+    return constant
+
+
+def compileExpression(tree):
+    """
+    Expressions evaluate the function and then dispatch the function call.
+    """
+    flist = tree.value
+
+    # Empty list is false.
+    if (len(flist) == 0):
+        def empty(model):
+            return interp.lcad_nil
+        return empty
+
+    head = flist[0]
+    if not (isinstance(head, lexerParser.LCadExpression) or isinstance(head, lexerParser.LCadSymbol)):
+        def notAFunction(model):
+            raise lce.NotAFunctionException(head.value)
+        return notAFunction
+
+    dispatch = interp.dispatch
+
+    # Calls in tail position of UserFunctions (see interpreter.markTailCalls()).
+    if tree.tail_call:
+        head_code = head.code
+        Symbol = interp.Symbol
+        UserFunction = interp.UserFunction
+        tailCall = interp.tailCall
+
+        def expression(model):
+            func = head_code(model)
+            if isinstance(func, Symbol):
+                func = func.getv()
+            try:
+                if (type(func) is UserFunction):
+                    return tailCall(func, model, tree)
+                return dispatch(func, model, tree)
+            except Exception as e:
+                interp.annotateError(e, func, tree)
+                raise
+
+        return expression
+
+    # Function symbols that are defined outside of a function, which includes
+    # all the built in functions, are always the same Symbol.
+    if isinstance(head, lexerParser.LCadSymbol) and isinstance(head.address, interp.Symbol) and (head.shadowed is None):
+        head_symbol = head.address
+
+        def expression(model):
+            func = head_symbol.getv()
+            try:
+                if (func is tree.cached_func) and (func is not None):
+                    return tree.cached_call(func, model, tree)
+                return dispatch(func, model, tree)
+            except Exception as e:
+                interp.annotateError(e, func, tree)
+                raise
+
+        return expression
+
+    head_code = head.code
+    Symbol = interp.Symbol
+
+    def expression(model):
+        func = head_code(model)
+        if isinstance(func, Symbol):
+            func = func.getv()
+        try:
+            return dispatch(func, model, tree)
+        except Exception as e:
+            interp.annotateError(e, func, tree)
+            raise
+
+    return expression
+
+
+def compileSymbol(tree):
+    """
+    Symbols with a static address are specialized on that address. Symbols
+    without one (i.e. symbols from imported modules) are resolved the first
+    time they are evaluated. The Symbol is then cached until a new symbol
+    shadows or replaces an existing symbol.
+    """
+    address = tree.address
+
+    # A symbol that shadows another symbol needs the full lookup.
+    if tree.shadowed is not None:
+        def symbol(model):
+            return interp.lookupSymbol(model, tree)
+
+    elif isinstance(address, interp.Symbol):
+        def symbol(model):
+            return address
+
+    elif address is not None:
+        [depth, slot] = address
+        if (depth == 0):
+            def symbol(model):
+                return model.frame.symbols[slot]
+        else:
+            def symbol(model):
+                frame = model.frame
+                for i in range(depth):
+                    frame = frame.parent
+                return frame.symbols[slot]
+
+    else:
+        lenv = tree.lenv
+        name = tree.value
+        cache = [None, -1]
+
+        def symbol(model):
+            if (cache[1] != interp.lexical_epoch):
+                cache[0] = interp.findSymbol(lenv, name)
+                cache[1] = interp.lexical_epoch
+            return cache[0]
+
+    return symbol
+
+
+def compileTree(tree):
+    """
+    Walks the AST creating the closure for each node. This must be
+    called after interpreter.createLexicalEnv(). The closure of an
+    expression uses the closures of its elements, so these are
+    created first. Expressions that already run on the virtual machine
+    (see vm.compileDeep()) are not compiled.
+    """
+    nodes = [[tree, False]]
+    while (len(nodes) > 0):
+        [tree, visited] = nodes.pop()
+        if isinstance(tree, list):
+            for node in reversed(tree):
+                nodes.append([node, False])
+
+        elif isinstance(tree, lexerParser.LCadExpression):
+            if (tree.engine == "vm"):
+                continue
+            if not visited:
+                nodes.append([tree, True])
+                for node in reversed(tree.value):
+                    nodes.append([node, False])
+                continue
+            tree.code = compileExpression(tree)
+            if tree.folded is not None:
+                tree.code = folding.foldedCode(tree, tree.code)
+            tree.engine = "compiled"
+
+        elif isinstance(tree, lexerParser.LCadSymbol):
+            tree.code = compileSymbol(tree)
+
+        elif isinstance(tree, lexerParser.LCadConstant):
+            tree.code = compileConstant(tree)
+
+
+def isCompiled(tree):
+    """
+    Returns True if tree has been compiled.
+    """
+    return (tree.code is not None)
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
@@ -7,7 +7,9 @@
 
 """
 
+import collections
 import copy
+import hashlib
 import importlib
 import numbers
 import numpy
@@ -20,10 +22,13 @@ except ImportError:
     # Python 3
     izip = zip
 
+import opensdraw.lcad_language.compiler as compiler
+import opensdraw.lcad_language.folding as folding
 import opensdraw.lcad_language.interpreter as interp
 import opensdraw.lcad_language.lcadExceptions as lce
 import opensdraw.lcad_language.lcadTypes as lcadTypes
 import opensdraw.lcad_language.lexerParser as lexerParser
+import opensdraw.lcad_language.vm as vm
 
 
 # Define the basestring type for Python 3.
@@ -35,6 +40,37 @@ except NameError:
 
 lcad_functions = {}
 
+# The number of evaluated modules that import keeps.
+max_modules = 64
+
+
+def fileState(filename):
+    """
+    Returns the modification time and size of filename, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+        return [stat.st_mtime, stat.st_size]
+    except OSError:
+        return None
+
+
+def isSame(a, b):
+    """
+    Returns True if a and b are the same, b is a copy (folding.copyValue())
+    of a if a is a list, vector or matrix.
+    """
+    if isinstance(a, list):
+        if not isinstance(b, list) or (len(a) != len(b)):
+            return False
+        for i in range(len(a)):
+            if not isSame(a[i], b[i]):
+                return False
+        return True
+    if isinstance(a, numpy.ndarray):
+        return isinstance(b, numpy.ndarray) and numpy.array_equal(a, b)
+    return (a is b)
+
 
 # This was useful for testing the import function.
 def printSymbolTableIds(lenv):
@@ -44,12 +80,48 @@ def printSymbolTableIds(lenv):
     print("-")
 
 
+def usesVolatile(tree):
+    """
+    Returns True if the AST tree uses a volatile built in function
+    (rand-*, print, pyimport, etc.), other than import.
+    """
+    nodes = [tree]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, lexerParser.LCadExpression):
+            nodes.extend(node.value)
+        elif isinstance(node, lexerParser.LCadSymbol) and isinstance(node.address, interp.BuiltinSymbol):
+            if (node.value != "import") and getattr(node.address.value, "volatile", False):
+                return True
+    return False
+
+
+def usesSymbol(tree, name):
+    """
+    Returns True if the AST tree uses the symbol name.
+    """
+    nodes = [tree]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, lexerParser.LCadExpression):
+            nodes.extend(node.value)
+        elif isinstance(node, lexerParser.LCadSymbol) and (node.value == name):
+            return True
+    return False
+
+
 class ArefSymbol(interp.Symbol):
     """
     These are created by aref as a "pointer" into a list, so that
     you can both get and change the value of a particular element
     in a list, vector or matrix.
     """
+    __slots__ = ("index", "tlist")
+
     def __init__(self, tlist, index):
         interp.Symbol.__init__(self, "aref-symbol", "na")
         self.tlist = tlist
@@ -171,6 +243,8 @@ class Concatenate(CoreFunction):
      (concatenate "as" "df")  ; Returns "asdf".
      (concatenate "as" 1)     ; Returns "as1".
     """
+    pure = True
+
     def __init__(self):
         CoreFunction.__init__(self, "cond")
         self.setSignature([[basestring, numbers.Number], ["optional", [basestring, numbers.Number]]])
@@ -269,16 +343,14 @@ class Def(interp.SpecialFunction):
     def call(self, model, tree):
         args = tree.value[1:]
 
-        # Symbols are created in the lexical environment of the parent expression.
-        lenv = tree.lenv.parent
-
         # Functions have already been created (so that they can be called out of
         # order), just return the function.
         if (len(args) == 3):
             tree.initialized = True
-            return lenv.symbols[args[0].value].getv()
+            return interp.interpret(model, args[0]).getv()
 
-        # Create Symbols.
+        # Set Symbols. These were created in the lexical environment of the 
+        # parent expression by createLexicalEnv().
         if ((len(args)%2) == 0):
             ret = None
             kv_pairs = izip(*[iter(args)]*2)
@@ -288,18 +360,14 @@ class Def(interp.SpecialFunction):
                 if not isinstance(key, lexerParser.LCadSymbol):
                     raise lce.CannotSetException(type(key))
 
-                symbol_name = key.value
-                if not tree.initialized:
-                    try:
-                        interp.checkOverride(lenv, symbol_name)
-                    except lce.SymbolNotDefined:
-                        pass
-
-                if not (symbol_name in lenv.symbols):
-                    lenv.symbols[symbol_name] = interp.Symbol(symbol_name, tree.filename)
+                # If the symbol has already been set the first time this def is 
+                # evaluated then it was set by a different def (or function).
+                symbol = interp.lookupAddress(model, key.address)
+                if not tree.initialized and symbol.is_set:
+                    raise lce.SymbolAlreadyExists(key.value)
 
                 val = interp.getv(interp.interpret(model, node))
-                lenv.symbols[symbol_name].setv(val)
+                symbol.setv(val)
                 ret = val
             tree.initialized = True
             return ret
@@ -307,6 +375,37 @@ class Def(interp.SpecialFunction):
 lcad_functions["def"] = Def()
 
 
+class DefMemo(Def):
+    """
+    **defmemo** - Create a memoized function.
+
+    This is the same as using def to create a function, except that the function
+    remembers the results of the most recent calls (up to interpreter.memo_size) and
+    returns the remembered result when it is called again with the same arguments.
+    It should only be used for functions whose result only depends on their arguments,
+    such as functions that create curves or do expensive calculations.
+
+    A memoized function can add parts to the current group. These are remembered
+    too and added again (in the current coordinate system) when the function is
+    called again with the same arguments. It cannot create groups, headers or
+    comments.
+
+    Usage::
+
+     (defmemo spring-coil (length turns) ; Create the memoized function spring-coil.
+      (spring length 22 2 turns 2))
+    """
+    def __init__(self):
+        interp.SpecialFunction.__init__(self, "defmemo")
+
+    def argCheck(self, tree):
+        # defmemo only creates functions.
+        if (len(tree.value) != 4):
+            raise lce.NumberArgumentsException("3", len(tree.value) - 1)
+
+lcad_functions["defmemo"] = DefMemo()
+
+
 class For(interp.SpecialFunction):
     """
     **for** - For statement.
@@ -317,6 +416,7 @@ class For(interp.SpecialFunction):
      (for (i 1 11) ..)         ; increment i from 1 to 11.
      (for (i 1 0.1 5) ..)      ; increment i from 1 to 5 in steps of 0.1.
      (for (i (list 1 3 4)) ..) ; increment i over the values in the list.
+     (for (i (arange 0 5 2)) ..) ; increment i over the values in the array.
     """
     def __init__(self):
         interp.SpecialFunction.__init__(self, "for")
@@ -340,22 +440,21 @@ class For(interp.SpecialFunction):
         elif (len(loop_args) > 4):
             raise lce.NumberArgumentsException("2,3 or 4", len(loop_args))
 
-        # Check for correct type of loop variable.
+        # Check for correct type of loop variable. The loop
+        # variable is created by createLexicalEnv().
         if not isinstance(loop_args[0], lexerParser.LCadSymbol):
             raise lce.LCadException("loop variable must be a symbol.")
-
-        # Create loop variable.
-        inc_name = loop_args[0].value
-        interp.checkOverride(tree.lenv, inc_name)
-        tree.lenv.symbols[inc_name] = interp.Symbol(inc_name, tree.filename)
         tree.initialized = True
 
     def call(self, model, tree):
         loop_args = tree.value[1].value
-        inc_var = tree.lenv.symbols[loop_args[0].value]
+        inc_var = interp.lookupAddress(model, loop_args[0].address)
 
-        # Iterate over list.
+        # Iterate over list (or array, the elements of a 1D array are numbers
+        # and the elements of a 2D array are lists of numbers).
         arg1 = interp.getv(interp.interpret(model, loop_args[1]))
+        if (len(loop_args)==2) and isinstance(arg1, lcadTypes.LCadArray):
+            arg1 = arg1.tolist()
         if ((len(loop_args)==2) and (isinstance(arg1, list))):
             ret = None
             for elt in arg1:
@@ -439,6 +538,17 @@ class Import(interp.SpecialFunction):
     Module are searched for in the current working directory first,
     then in the library folder of the opensdraw project. The modules
     are assumed to be in files that end with the ".lcad" extension.
+    The parsed modules are cached in the user's cache directory, or
+    in the directory in the LCAD_CACHE_DIR environment variable. Set
+    LCAD_CACHE_DIR to an empty string to turn off the cache.
+
+    Each module is only evaluated once, all the imports of a module
+    share the same symbols. Modules that use time-index (or that import
+    a module that does) are evaluated again when time-index changes.
+    Modules that use volatile functions such as rand-*, print or pyimport
+    (or that import a module that does) are evaluated by every import.
+    Modules are also evaluated again when a file that they read (an
+    imported module, a Python module, etc.) changes.
 
     Usage::
 
@@ -452,10 +562,19 @@ class Import(interp.SpecialFunction):
 
      (import mod1 mod2 :local) ; import mod1.lcad and mod2.lcad into the name space of current module.
     """
+    volatile = True
+
     def __init__(self):
         interp.SpecialFunction.__init__(self, "import")
         self.paths = ["./", os.path.dirname(__file__) + "/../library/"]
 
+        # The ImportedModules that are being evaluated.
+        self.loading = []
+
+        # ImportedModules by path, engine and constant folding, the
+        # least recently used module is removed after max_modules.
+        self.modules = collections.OrderedDict()
+
     def argCheck(self, tree):
 
         # Import needs at least 1 arguments.
@@ -474,17 +593,10 @@ class Import(interp.SpecialFunction):
         if local:
             args = args[:-1]
         for arg in args:
-
-            # Load module with it's own lexical environment and model.
-            module_lenv = interp.LEnv(add_built_ins = True)
-            module_model = interp.Model(False)
             for path in self.paths:
                 filename = path + arg.value + ".lcad"
                 if os.path.exists(filename):
-                    with open(filename) as fp:
-                        module_ast = lexerParser.parse(fp.read(), filename)
-                        interp.createLexicalEnv(module_lenv, module_ast)
-                        interp.interpret(module_model, module_ast)
+                    module_lenv = self.loadModule(model, tree, filename)
                     break
             else:
                 raise lce.FileNotFoundException(arg.value + ".lcad")
@@ -493,7 +605,7 @@ class Import(interp.SpecialFunction):
             # to the main lexical environment.
             lenv = tree.lenv.parent
             for sym_name in module_lenv.symbols:
-                if (not sym_name in interp.builtin_symbols) and (not sym_name in interp.builtin_functions):
+                if (not sym_name in interp.builtin_symbols) and (not sym_name in interp.builtin_modules):
                     if local:
                         interp.checkOverride(lenv, sym_name, module_lenv.symbols[sym_name].filename)
                         lenv.symbols[sym_name] = module_lenv.symbols[sym_name]
@@ -502,9 +614,134 @@ class Import(interp.SpecialFunction):
                         interp.checkOverride(lenv, full_name)
                         lenv.symbols[full_name] = module_lenv.symbols[sym_name]
 
+    def loadModule(self, model, tree, filename):
+        """
+        Return the lexical environment of the module in filename, evaluating
+        the module if there is no valid ImportedModule for it.
+        """
+        interp.addDependency(filename)
+        with open(filename) as fp:
+            code = fp.read()
+        code_hash = hashlib.sha1(code.encode("utf-8")).hexdigest()
+        time_index = interp.builtin_symbols["time-index"].getv()
+
+        key = (os.path.abspath(filename), tree.engine, model.fold_constants)
+        module = self.modules.get(key)
+        if (module is None) or not module.isValid(code_hash, time_index):
+
+            # Load module with it's own lexical environment and model.
+            module = ImportedModule(code_hash, time_index)
+            module_lenv = interp.LEnv(add_built_ins = True)
+            module_model = interp.Model(False)
+            module_model.fold_constants = model.fold_constants
+
+            # Record the files that the module depends on.
+            dependencies = interp.dependencies
+            interp.dependencies = module.dependencies
+
+            self.loading.append(module)
+            try:
+                module_ast = lexerParser.parse(code, filename, cache = True)
+                interp.createLexicalEnv(module_lenv, module_ast)
+                if usesSymbol(module_ast, "time-index"):
+                    module.time_dependent = True
+                if usesVolatile(module_ast):
+                    module.volatile = True
+                if model.fold_constants:
+                    folding.foldTree(module_ast)
+
+                # Modules imported by compiled code are also compiled.
+                if (tree.engine == "vm"):
+                    vm.compileTree(module_ast)
+                else:
+                    vm.compileDeep(module_ast)
+                if (tree.engine == "compiled"):
+                    compiler.compileTree(module_ast)
+                interp.interpret(module_model, module_ast)
+            finally:
+                self.loading.pop()
+                interp.dependencies = dependencies
+
+            module.setLEnv(module_lenv)
+            module.recordDependencies()
+            self.modules[key] = module
+        self.modules.move_to_end(key)
+        while (len(self.modules) > max_modules):
+            self.modules.popitem(last = False)
+
+        # A module that imports a module that depends on time-index (or
+        # that is volatile) also depends on time-index (or is volatile).
+        if (len(self.loading) > 0):
+            if module.time_dependent:
+                self.loading[-1].time_dependent = True
+            if module.volatile:
+                self.loading[-1].volatile = True
+
+        if interp.dependencies is not None:
+            interp.dependencies.update(module.dependencies)
+
+        return module.lenv
+
 lcad_functions["import"] = Import()
 
 
+class ImportedModule(object):
+    """
+    A module that has been evaluated by import.
+    """
+    def __init__(self, code_hash, time_index):
+        self.code_hash = code_hash
+        self.dependencies = set()
+        self.dependency_states = {}
+        self.lenv = None
+        self.time_dependent = False
+        self.time_index = time_index
+        self.values = None
+        self.volatile = False
+
+    def isValid(self, code_hash, time_index):
+        """
+        Returns True if the module can be used without evaluating it again.
+        """
+        if (code_hash != self.code_hash) or self.volatile:
+            return False
+        if self.time_dependent and (time_index != self.time_index):
+            return False
+
+        # Check that none of the files that the module read (imported
+        # modules, Python modules, etc.) have changed.
+        for filename in self.dependency_states:
+            if (fileState(filename) != self.dependency_states[filename]):
+                return False
+
+        # Check that none of the module's symbols have been set to
+        # something else, or changed (for example in a previous run).
+        for [symbol, value, saved] in self.values:
+            if (symbol.value is not value):
+                return False
+            if (saved is not None) and not isSame(value, saved):
+                return False
+        return True
+
+    def recordDependencies(self):
+        """
+        Record the modification time and size of the files that the module read.
+        """
+        for filename in self.dependencies:
+            self.dependency_states[filename] = fileState(filename)
+
+    def setLEnv(self, lenv):
+        self.lenv = lenv
+        self.values = []
+        for sym_name in lenv.symbols:
+            symbol = lenv.symbols[sym_name]
+            if not (sym_name in interp.builtin_symbols) and not isinstance(symbol, interp.BuiltinSymbol):
+                saved = None
+                if folding.isMutable(symbol.value):
+                    saved = folding.copyValue(symbol.value)
+                self.values.append([symbol, symbol.value, saved])
+
+
 class IsMain(CoreFunction):
     """
     **is-main** - Return t / nil if the module is the main module.
@@ -546,22 +783,25 @@ class Lambda(interp.SpecialFunction):
         tree.initialized = True
 
     def call(self, model, tree):
-        return interp.UserFunction(tree, "anonymous")
+        return tree.function.closure(model.frame)
 
 lcad_functions["lambda"] = Lambda()
 
 
 class Len(CoreFunction):
     """
-    **len** - Return the length of a list.
+    **len** - Return the length of a list or an array.
 
     Usage::
 
      (len (list 1 2 3)) ; returns 3
+     (len (arange 5))   ; returns 5
     """
+    pure = True
+
     def __init__(self):
         CoreFunction.__init__(self, "len")
-        self.setSignature([[list]])
+        self.setSignature([[list, lcadTypes.LCadArray]])
 
     def call(self, model, vals):
         return len(vals)
@@ -578,6 +818,8 @@ class List(CoreFunction):
      (list 1 2 3)  ; returns the list 1,2,3
      (list)        ; an empty list
     """
+    pure = True
+
     def __init__(self):
         CoreFunction.__init__(self, "list")
         self.setSignature([["optional", [object]]])
@@ -597,6 +839,8 @@ class Print(CoreFunction):
      (print x "=" 10)
 
     """
+    volatile = True
+
     def __init__(self):
         CoreFunction.__init__(self, "print")
         self.setSignature([["optional", [object]]])
@@ -620,6 +864,8 @@ class PyImport(interp.SpecialFunction):
    
      (pyimport mymodule)  ; Import the Python module mymodule.py.
     """
+    volatile = True
+
     def __init__(self):
         interp.SpecialFunction.__init__(self, "pyimport")
 
@@ -633,6 +879,8 @@ class PyImport(interp.SpecialFunction):
         lenv = tree.lenv.parent
         for arg in args:
             module = importlib.import_module(arg.value)
+            if getattr(module, "__file__", None) is not None:
+                interp.addDependency(module.__file__)
             if hasattr(module, "lcad_functions"):
                 for fn_name in module.lcad_functions.keys():
                     fn = module.lcad_functions[fn_name]
@@ -674,13 +922,7 @@ class Set(interp.SpecialFunction):
         for sym_node, val_node in kv_pairs:
 
             sym = interp.interpret(model, sym_node)
-            if not isinstance(sym, interp.Symbol):
-                raise lce.CannotSetException(type(sym))
-            if (sym.name in interp.builtin_functions):
-                print("Warning, overwriting builtin function:", sym.name, "!!")
-            if (sym.name in interp.builtin_symbols):
-                if not (sym.name in interp.mutable_symbols):
-                    raise lce.CannotOverrideBuiltIn()
+            interp.checkSet(sym)
 
             val = interp.getv(interp.interpret(model, val_node))
             sym.setv(val)
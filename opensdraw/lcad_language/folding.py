@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+.. module:: folding
+   :synopsis: Constant folding of the lcad AST.
+
+.. moduleauthor:: Hazen Babcock
+
+This pass finds the calls to built in functions that only depend on
+their arguments (the functions whose pure attribute is True) and whose
+arguments are all constants, for example (list 0 0 5) or (* 2 pi). Each
+of these calls is evaluated once and the result is stored in the folded
+attribute of the expression. All the engines use the folded value in
+place of the call.
+
+Built in functions can be replaced with set, so a folded value is only
+valid until the next time this happens (interpreter.fold_epoch).
+
+"""
+
+import numpy
+
+import opensdraw.lcad_language.compiler as compiler
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+# The built in symbols whose value never changes.
+constant_symbols = ["e", "nil", "pi", "t"]
+
+
+class Folded(object):
+    """
+    The constant value of a folded expression.
+    """
+    def __init__(self, value):
+        self.epoch = interp.fold_epoch
+        self.is_mutable = isMutable(value)
+
+        # Functions like rotate use this to store the transform
+        # matrix that they calculate from value.
+        self.matrix = None
+
+        self.value = value
+
+    def getv(self):
+        """
+        Lists, vectors and matrices can be modified, so each
+        evaluation gets its own copy of these.
+        """
+        if self.is_mutable:
+            return copyValue(self.value)
+        return self.value
+
+
+def copyValue(value):
+    """
+    Copy lists (and their contents), vectors and matrices.
+    """
+    if isinstance(value, list):
+        return [copyValue(elt) for elt in value]
+    if isMutable(value):
+        return value.copy()
+    return value
+
+
+def foldedCode(tree, code):
+    """
+    Return a function that returns the folded value of tree, or
+    the result of code(model) if the folded value is no longer valid.
+    """
+    folded = tree.folded
+
+    def constant(model):
+        if (folded.epoch == interp.fold_epoch):
+            return folded.getv()
+        return code(model)
+
+    return constant
+
+
+def foldTree(tree, model = None):
+    """
+    Walks the AST folding calls of pure built in functions with
+    constant arguments. This must be called after
+    interpreter.createLexicalEnv() and before the AST is compiled.
+
+    The expressions are found with a list of the nodes to visit instead
+    of recursion and then folded in the reverse of the order in which
+    they were found, so the arguments of an expression are always folded
+    before the expression itself and there is no limit on how deep the
+    AST can be.
+    """
+    expressions = []
+    nodes = [tree]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, lexerParser.LCadExpression):
+            expressions.append(node)
+            nodes.extend(node.value)
+
+    for expression in reversed(expressions):
+        foldExpression(expression, model)
+
+
+def foldExpression(tree, model):
+    """
+    Fold the expression tree if it is a call of a pure built in
+    function and all of its arguments are constants.
+    """
+    flist = tree.value
+    if (len(flist) == 0) or not isPure(flist[0]):
+        return
+    for node in flist[1:]:
+        if not isConstant(node):
+            return
+
+    # Errors are not raised here, the expression is just not folded
+    # and the error will happen (if it does) when it is evaluated.
+    if model is None:
+        model = interp.Model(False)
+    try:
+        value = interp.interpret(model, tree)
+    except Exception:
+        return
+
+    tree.folded = Folded(value)
+    tree.code = foldedCode(tree, compiler.compileExpression(tree))
+
+
+def getFolded(tree):
+    """
+    Return the Folded value of tree, or None if tree was not
+    folded or its folded value is no longer valid.
+    """
+    folded = tree.folded
+    if (folded is not None) and (folded.epoch == interp.fold_epoch):
+        return folded
+    return None
+
+
+def isConstant(tree):
+    """
+    Returns True if tree is a constant, a built in symbol whose value
+    never changes or an expression that has been folded.
+    """
+    if isinstance(tree, lexerParser.LCadConstant):
+        return True
+    if isinstance(tree, lexerParser.LCadSymbol):
+        return isConstantSymbol(tree)
+    if isinstance(tree, lexerParser.LCadExpression):
+        return (getFolded(tree) is not None)
+    return False
+
+
+def isConstantSymbol(tree):
+    """
+    Returns True if tree is one of the built in symbols whose value never changes.
+    """
+    if (tree.value in constant_symbols) and (tree.shadowed is None):
+        return (tree.address is interp.builtin_symbols[tree.value])
+    return False
+
+
+def isMutable(value):
+    """
+    Returns True if value is a list, vector or matrix.
+    """
+    return isinstance(value, list) or isinstance(value, numpy.ndarray)
+
+
+def isPure(head):
+    """
+    Returns True if head is the symbol for a pure built in function.
+    """
+    if not isinstance(head, lexerParser.LCadSymbol) or (head.shadowed is not None):
+        return False
+    if not isinstance(head.address, interp.Symbol):
+        return False
+    if not (head.value in interp.builtin_modules):
+        return False
+    func = head.address.value
+    return (func is interp.builtin_functions[head.value]) and func.pure
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
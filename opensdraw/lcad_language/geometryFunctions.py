@@ -11,6 +11,7 @@ import math
 import numbers
 import numpy
 
+import opensdraw.lcad_language.folding as folding
 import opensdraw.lcad_language.geometry as geometry
 import opensdraw.lcad_language.interpreter as interp
 import opensdraw.lcad_language.lcadExceptions as lce
@@ -19,8 +20,24 @@ import opensdraw.lcad_language.lcadTypes as lcadTypes
 lcad_functions = {}
 
 
+def getMatrix(func, model, tree, toMatrix):
+    """
+    Return the transform matrix for the first argument of the special
+    function func. If the argument was folded into a constant (see
+    folding.py) the matrix is only calculated the first time.
+    """
+    folded = folding.getFolded(tree.value[1])
+    if (folded is not None) and (folded.matrix is not None):
+        return folded.matrix
+
+    m = toMatrix(func.getArg(model, tree, 0))
+    if folded is not None:
+        folded.matrix = m
+    return m
+
+
 class GeometryFunction(interp.LCadFunction):
-    pass
+    pure = True
 
 
 class CrossProduct(GeometryFunction):
@@ -224,7 +241,7 @@ class Rotate(interp.SpecialFunction):
 
     def call(self, model, tree):
         if (self.numberArgs(tree) > 1):
-            m = geometry.rotationMatrix(*geometry.parseArgs(self.getArg(model, tree, 0)))
+            m = getMatrix(self, model, tree, lambda vals: geometry.rotationMatrix(*geometry.parseArgs(vals)))
             cur_matrix = model.curGroup().matrix().copy()
             model.curGroup().setMatrix(numpy.dot(cur_matrix, m))
             val = interp.interpret(model, tree.value[2:])
@@ -301,16 +318,7 @@ class Transform(interp.SpecialFunction):
 
     def call(self, model, tree):
         if (self.numberArgs(tree) > 1):
-            vals = self.getArg(model, tree, 0)
-
-            # Transform matrix.
-            if isinstance(vals, lcadTypes.LCadMatrix):
-                m = vals
-
-            # List.
-            if isinstance(vals, list):
-                m = geometry.listToMatrix(vals)
-            
+            m = getMatrix(self, model, tree, self.toMatrix)
             cur_matrix = model.curGroup().matrix().copy()
             model.curGroup().setMatrix(numpy.dot(cur_matrix, m))
             val = interp.interpret(model, tree.value[2:])
@@ -319,6 +327,16 @@ class Transform(interp.SpecialFunction):
         else:
             return None
 
+    def toMatrix(self, vals):
+
+        # Transform matrix.
+        if isinstance(vals, lcadTypes.LCadMatrix):
+            return vals
+
+        # List.
+        if isinstance(vals, list):
+            return geometry.listToMatrix(vals)
+
 lcad_functions["transform"] = Transform()
 
 
@@ -347,7 +365,7 @@ class Translate(interp.SpecialFunction):
     def call(self, model, tree):
 
         if (self.numberArgs(tree) > 1):
-            m = geometry.translationMatrix(*geometry.parseArgs(self.getArg(model, tree, 0)))
+            m = getMatrix(self, model, tree, lambda vals: geometry.translationMatrix(*geometry.parseArgs(vals)))
 
             cur_matrix = model.curGroup().matrix().copy()
             model.curGroup().setMatrix(numpy.dot(cur_matrix, m))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+.. module:: incremental
+   :synopsis: Re-uses the results of the top level forms of a Program
+              that do not change from one time index to the next.
+
+.. moduleauthor:: Hazen Babcock
+
+The first time that a top level form is evaluated the Symbol class
+is changed so that the Symbols that the form reads and sets are
+recorded in a Trace, along with the parts, groups and header lines
+that it adds to the model. The symbols in the frames of user functions
+are FrameSymbols which are not recorded, these are always created as
+part of the form.
+
+The next time the Program is executed, if all the Symbols that the form
+read still have the same value (time-index is a Symbol, so anything that
+uses it will not match) the form is not evaluated. Instead the recorded
+symbols are set and the recorded parts, groups and header lines are
+added to the model.
+
+Forms that call volatile functions (rand-*, print, import, etc.) or
+memoized functions (the function body is not evaluated when the result
+is in the cache, so its symbols are not recorded), that change a list,
+vector or matrix that they did not create, that set a symbol to a list,
+vector or matrix (other symbols can refer to the same value, which the
+Trace cannot record), that set a built in function or set a symbol to a
+closure, or whose Trace did not match are evaluated as usual from then on.
+
+"""
+
+import numbers
+import numpy
+
+import opensdraw.lcad_language.folding as folding
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+
+class Trace(object):
+    """
+    What a top level form read from and added to the model.
+    """
+    def __init__(self, model):
+        group = model.curGroup()
+
+        self.group_matrix = group.matrix().copy()
+        self.groups = []
+        self.have_comments = False
+        self.header = []
+        self.parts = None
+        self.volatile = False
+
+        # [Symbol, value, copy of the value] of the symbols read by the form.
+        self.reads = {}
+
+        # The symbols set by the form.
+        self.writes = {}
+
+        # The state of the model when the form started.
+        self.start = [len(model.groups()), len(group.header), group.checkpoint()]
+
+    def finish(self, model):
+        """
+        Record what the form added to the model. Returns False if the
+        form can not be re-used.
+        """
+        if self.volatile:
+            return False
+
+        # Lists, vectors and matrices that the form changed.
+        for [symbol, value, saved] in self.reads.values():
+            if (saved is not None) and not isEqual(value, saved):
+                return False
+
+        # Other symbols can refer to the same list, vector or matrix as a
+        # symbol that the form set. Setting a built in function also makes
+        # the folded constants invalid (see interpreter.checkSet()).
+        for symbol in self.writes.values():
+            if folding.isMutable(symbol.value) or hasClosure(symbol.value) or (symbol.name in interp.builtin_modules):
+                return False
+
+        group = model.curGroup()
+        [n_groups, n_headers, checkpoint] = self.start
+        self.groups = model.groups()[n_groups:]
+        self.have_comments = group.have_comments
+        self.header = group.header[n_headers:]
+        self.parts = group.since(checkpoint)
+
+        self.writes = [[symbol, symbol.value] for symbol in self.writes.values()]
+        return True
+
+    def isValid(self, model):
+        """
+        Returns True if the form would do the same thing again.
+        """
+        if (len(model.m_cur_group) != 1):
+            return False
+        if not numpy.array_equal(model.curGroup().matrix(), self.group_matrix):
+            return False
+        for group in self.groups:
+            if group.name in model.used_names:
+                return False
+
+        for [symbol, value, saved] in self.reads.values():
+            if not symbol.is_set:
+                return False
+            if not isEqual(symbol.value, value if (saved is None) else saved):
+                return False
+        return True
+
+    def replay(self, model):
+        """
+        Do what the form did without evaluating it.
+        """
+        for [symbol, value] in self.writes:
+            if isinstance(value, interp.MemoizedFunction):
+                value.cache.clear()
+            symbol.setv(value)
+
+        group = model.curGroup()
+        group.have_comments = group.have_comments or self.have_comments
+        group.header.extend(self.header)
+        group.extend(self.parts)
+
+        for new_group in self.groups:
+            model.m_groups.append(new_group)
+            model.used_names[new_group.name] = 1
+
+
+class Tracker(object):
+    """
+    Evaluates the top level forms of a Program, re-using the forms
+    that do the same thing as the last time.
+    """
+    def __init__(self, forms):
+        self.dynamic = [not isinstance(form, lexerParser.LCadExpression) for form in forms]
+        self.n_reused = 0
+        self.traces = [None] * len(forms)
+
+    def execute(self, model, forms):
+        self.n_reused = 0
+        for i, form in enumerate(forms):
+            if self.dynamic[i]:
+                interp.interpret(model, form)
+                continue
+
+            trace = self.traces[i]
+            if trace is None:
+                self.traces[i] = self.record(model, form)
+                self.dynamic[i] = self.traces[i] is None
+
+            elif trace.isValid(model):
+                trace.replay(model)
+                self.n_reused += 1
+
+            else:
+                self.traces[i] = None
+                self.dynamic[i] = True
+                interp.interpret(model, form)
+
+    def record(self, model, form):
+        """
+        Evaluate form, returning its Trace or None if it cannot be re-used.
+        """
+        if (len(model.m_cur_group) != 1):
+            interp.interpret(model, form)
+            return None
+
+        trace = Trace(model)
+        reads = trace.reads
+        writes = trace.writes
+        [getv, setv] = [interp.Symbol.getv, interp.Symbol.setv]
+
+        def traceGetv(symbol):
+            value = getv(symbol)
+            key = id(symbol)
+            if not (key in reads) and not (key in writes):
+                saved = None
+                if folding.isMutable(value):
+                    saved = folding.copyValue(value)
+                reads[key] = [symbol, value, saved]
+                if isinstance(value, interp.LCadFunction):
+                    if value.volatile or isinstance(value, interp.MemoizedFunction):
+                        trace.volatile = True
+            return value
+
+        def traceSetv(symbol, value):
+            setv(symbol, value)
+            writes[id(symbol)] = symbol
+
+        [interp.Symbol.getv, interp.Symbol.setv] = [traceGetv, traceSetv]
+        try:
+            interp.interpret(model, form)
+        finally:
+            [interp.Symbol.getv, interp.Symbol.setv] = [getv, setv]
+
+        if trace.finish(model):
+            return trace
+        return None
+
+
+def hasClosure(value):
+    """
+    Returns True if value is (or is a list that contains) a function that
+    was created inside of another function. These share the frame of the
+    function that created them, which other forms could change.
+    """
+    if isinstance(value, list):
+        for elt in value:
+            if hasClosure(elt):
+                return True
+        return False
+    return isinstance(value, interp.UserFunction) and (value.frame is not None)
+
+
+def isEqual(a, b):
+    """
+    Returns True if a and b have the same value. Numbers and strings are
+    compared by value, lists, vectors and matrices by their contents and
+    everything else by identity.
+    """
+    if a is b:
+        return True
+    if isinstance(a, list):
+        if not isinstance(b, list) or (len(a) != len(b)):
+            return False
+        for i in range(len(a)):
+            if not isEqual(a[i], b[i]):
+                return False
+        return True
+    if isinstance(a, numpy.ndarray):
+        return isinstance(b, numpy.ndarray) and (a.shape == b.shape) and numpy.array_equal(a, b)
+    if isinstance(a, numbers.Number) or isinstance(a, str):
+        return (type(a) is type(b)) and (a == b)
+    return False
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
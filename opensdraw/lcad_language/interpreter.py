@@ -8,6 +8,7 @@
 
 """
 
+import collections
 import copy
 import importlib
 import math
@@ -16,9 +17,13 @@ import numpy
 import os
 import xml.etree.ElementTree as ElementTree
 
+import opensdraw.lcad_language.compiler as compiler
+import opensdraw.lcad_language.folding as folding
 import opensdraw.lcad_language.lcadExceptions as lce
 import opensdraw.lcad_language.lexerParser as lexerParser
 import opensdraw.lcad_language.lcadTypes as lcadTypes
+import opensdraw.lcad_language.parts as parts
+import opensdraw.lcad_language.vm as vm
 
 # Define the basestring type for Python 3.
 try:
@@ -27,11 +32,40 @@ except NameError:
     basestring = str
     
 
-# Keeps track of all the built in symbols.
+# Keeps track of all the built in symbols. The built in functions are
+# added to builtin_functions when the module that defines them is imported,
+# builtin_modules is the name of this module for each function (from modules.xml).
 builtin_functions = {}
+builtin_modules = {}
 builtin_symbols = {}
 mutable_symbols = []
 
+# Concrete types that are checked first for abstract base classes, as
+# isinstance() is much slower for abstract base classes.
+concrete_types = {numbers.Number : [int, float, numpy.number]}
+
+# The files that the program reads (imported modules, Python modules and
+# parts files) are added to this set when it is not None, this is used by
+# lcad_to_ldraw --watch to know when the model needs to be built again.
+dependencies = None
+
+# This is incremented whenever set changes the value of a built in
+# function. Expressions that were folded into constants (see folding.py)
+# are only valid while it does not change.
+fold_epoch = 0
+
+# The number of results that each memoized function (defmemo) remembers.
+memo_size = 128
+
+# This is incremented whenever a new symbol shadows or replaces an existing
+# symbol. Code that caches the results of findSymbol() (see compiler.py)
+# uses it to know when the cached values are no longer valid.
+lexical_epoch = 0
+
+# The functions that create symbols in the lexical environment of the
+# expression that contains them (see needsLEnv()).
+scope_functions = ["def", "defmemo", "import", "pyimport"]
+
 #
 # Classes
 #
@@ -47,27 +81,135 @@ class EmptyTree(object):
 class Group(object):
     """
     A group of parts.
+
+    The parts are stored in columns, the transform of each part is a row of
+    12 numbers (x y z a b c d e f g h i, as in an LDraw line), the part IDs
+    and the colors are stored as indices into lists of the distinct part IDs
+    and colors. Comments and primitives are stored as objects. Each part,
+    comment and primitive also has its position in the insertion order.
+
+    If the group has a sink (see ldrawWriter.SpillSink) the parts are given
+    to the sink and removed from the group every sink.block_size parts.
     """
-    def __init__(self, name):
+    def __init__(self, name, sink = None):
         self.name = name
 
         self.have_comments = False
         self.header = []
+        self.holds = 0
+        self.sink = sink
         self.m = numpy.identity(4)
+        self.n_items = 0
         self.n_parts = 0
         self.n_primitives = 0
-        self.parts_list = []
+
+        # Columns, these grow by doubling (see reserve()).
+        self.n_rows = 0
+        self.color_codes = numpy.zeros(0, dtype = numpy.int32)
+        self.id_codes = numpy.zeros(0, dtype = numpy.int32)
+        self.order = numpy.zeros(0, dtype = numpy.int64)
+        self.steps = numpy.zeros(0)
+        self.transforms = numpy.zeros((0, 12))
+
+        # The distinct colors and part IDs.
+        self.colors = []
+        self.color_index = {}
+        self.part_ids = []
+        self.part_id_index = {}
+
+        # [insertion order, object] of the comments and primitives.
+        self.others = []
 
     def addComment(self, comment):
         self.have_comments = True
-        self.parts_list.append(comment)
+        self.others.append([self.n_items, comment])
+        self.n_items += 1
+
+    def addLDrawPart(self, matrix, part_id, ldraw_color, step):
+        """
+        Add a part without creating a parts.Part, ldraw_color has
+        already been converted with parts.toColor().
+        """
+        self.reserve(1)
+        i = self.n_rows
+        self.color_codes[i] = self.colorCode(ldraw_color)
+        self.id_codes[i] = self.partIdCode(part_id)
+        self.order[i] = self.n_items
+        self.steps[i] = step
+        self.transforms[i,:3] = matrix[:3,3]
+        self.transforms[i,3:] = matrix[:3,:3].ravel()
+        self.n_items += 1
+        self.n_parts += 1
+        self.n_rows += 1
+        if self.sink is not None:
+            self.spill()
 
     def addPart(self, part, is_primitive):
+        if isinstance(part, parts.Part):
+            self.addLDrawPart(part.matrix, part.part_id, part.part_color, part.step)
+            if is_primitive:
+                self.n_parts -= 1
+                self.n_primitives += 1
+            return
+
         if is_primitive:
             self.n_primitives += 1
         else:
             self.n_parts += 1
-        self.parts_list.append(part)
+        self.others.append([self.n_items, part])
+        self.n_items += 1
+        if self.sink is not None:
+            self.spill()
+
+    def checkpoint(self):
+        """
+        Returns the state of the group, for since() and truncate().
+        """
+        return [self.n_items, self.n_rows, len(self.others), self.n_parts, self.n_primitives]
+
+    def colorCode(self, ldraw_color):
+        code = self.color_index.get(ldraw_color)
+        if code is None:
+            code = len(self.colors)
+            self.colors.append(ldraw_color)
+            self.color_index[ldraw_color] = code
+        return code
+
+    def extend(self, group, matrix = None, step_offset = 0):
+        """
+        Add the parts, comments and primitives of another group (usually
+        from since()). If matrix is not None they are transformed by it,
+        and the steps of the parts are offset by step_offset.
+        """
+        n = group.n_rows
+        if (n > 0):
+            self.reserve(n)
+            rows = slice(self.n_rows, self.n_rows + n)
+            color_map = numpy.array([self.colorCode(color) for color in group.colors], dtype = numpy.int32)
+            id_map = numpy.array([self.partIdCode(part_id) for part_id in group.part_ids], dtype = numpy.int32)
+            self.color_codes[rows] = color_map[group.color_codes[:n]]
+            self.id_codes[rows] = id_map[group.id_codes[:n]]
+            self.order[rows] = group.order[:n] + self.n_items
+            self.steps[rows] = group.steps[:n] + step_offset
+            if matrix is None:
+                self.transforms[rows] = group.transforms[:n]
+            else:
+                rotation = matrix[:3,:3]
+                self.transforms[rows,:3] = numpy.dot(group.transforms[:n,:3], rotation.T) + matrix[:3,3]
+                self.transforms[rows,3:] = numpy.matmul(rotation, group.transforms[:n,3:].reshape(n,3,3)).reshape(n,9)
+            self.n_rows += n
+
+        for [order, item] in group.others:
+            if (matrix is not None) and not isinstance(item, parts.Comment):
+                item = item.transform(matrix, step_offset)
+            self.others.append([order + self.n_items, item])
+
+        self.have_comments = self.have_comments or group.have_comments
+        self.n_items += group.n_items
+        self.n_parts += group.n_parts
+        self.n_primitives += group.n_primitives
+        if self.sink is not None:
+            self.spill()
 
     def getNParts(self):
         return self.n_parts
@@ -75,30 +217,153 @@ class Group(object):
     def getNPrimitives(self):
         return self.n_primitives
 
+    def getPart(self, i):
+        """
+        Return the i-th (in insertion order) row as a parts.Part.
+        """
+        step = self.steps[i].item()
+        if step.is_integer():
+            step = int(step)
+        return parts.Part.fromColumns(self.transforms[i],
+                                      self.part_ids[self.id_codes[i]],
+                                      self.colors[self.color_codes[i]],
+                                      step)
+
     def getParts(self):
         """
         Return the parts list sorted by step, but only if there are no comments.
         """
-        if self.have_comments:
-            return self.parts_list
-        else:
-            return sorted(self.parts_list, key = lambda part: part.step)
+        items = []
+        for i in self.sortedIndex():
+            if (i < self.n_rows):
+                items.append(self.getPart(i))
+            else:
+                items.append(self.others[i - self.n_rows][1])
+        return items
 
     def matrix(self):
         return self.m
 
+    def partIdCode(self, part_id):
+        code = self.part_id_index.get(part_id)
+        if code is None:
+            code = len(self.part_ids)
+            self.part_ids.append(part_id)
+            self.part_id_index[part_id] = code
+        return code
+
+    def reserve(self, n):
+        """
+        Make room for n more rows, doubling the size of the columns.
+        """
+        size = len(self.order)
+        if ((self.n_rows + n) <= size):
+            return
+        size = max(self.n_rows + n, 2 * size, 16)
+        for name in ["color_codes", "id_codes", "order", "steps", "transforms"]:
+            old = getattr(self, name)
+            new = numpy.zeros((size,) + old.shape[1:], dtype = old.dtype)
+            new[:self.n_rows] = old[:self.n_rows]
+            setattr(self, name, new)
+
     def setMatrix(self, m):
         self.m = m
 
+    def spill(self, force = False):
+        """
+        Give the parts, comments and primitives to the sink if there are
+        block_size of them (or any of them if force is True), unless
+        something holds them (such as MemoizedFunction.record()).
+        """
+        n = self.n_rows + len(self.others)
+        if (self.holds > 0) or (n == 0) or ((n < self.sink.block_size) and not force):
+            return
+        self.sink.add(self, self.since([0, 0, 0, 0, 0]))
+        self.n_rows = 0
+        self.others = []
+
+    def since(self, checkpoint):
+        """
+        Returns a group with the parts, comments and primitives that were
+        added after checkpoint. The group matrix and the header are not copied.
+        """
+        [n_items, n_rows, n_others, n_parts, n_primitives] = checkpoint
+        group = Group(self.name)
+        n = self.n_rows - n_rows
+        if (n > 0):
+            rows = slice(n_rows, self.n_rows)
+            group.reserve(n)
+            [group.colors, group.color_index] = [list(self.colors), dict(self.color_index)]
+            [group.part_ids, group.part_id_index] = [list(self.part_ids), dict(self.part_id_index)]
+            group.color_codes[:n] = self.color_codes[rows]
+            group.id_codes[:n] = self.id_codes[rows]
+            group.order[:n] = self.order[rows] - n_items
+            group.steps[:n] = self.steps[rows]
+            group.transforms[:n] = self.transforms[rows]
+            group.n_rows = n
+
+        for [order, item] in self.others[n_others:]:
+            if isinstance(item, parts.Comment):
+                group.have_comments = True
+            group.others.append([order - n_items, item])
+
+        group.n_items = self.n_items - n_items
+        group.n_parts = self.n_parts - n_parts
+        group.n_primitives = self.n_primitives - n_primitives
+        return group
+
+    def sortedIndex(self):
+        """
+        Returns the rows (0 to n_rows - 1) and the others (n_rows and up) in
+        the order of getParts(), by step (stable) unless there are comments.
+        """
+        orders = numpy.concatenate((self.order[:self.n_rows],
+                                    numpy.array([order for [order, item] in self.others], dtype = numpy.int64)))
+        if self.have_comments:
+            return numpy.argsort(orders, kind = "stable")
+        steps = numpy.concatenate((self.steps[:self.n_rows],
+                                   numpy.array([item.step for [order, item] in self.others], dtype = float)))
+        return numpy.lexsort((orders, steps))
+
+    def truncate(self, checkpoint):
+        """
+        Remove the parts, comments and primitives that were added after checkpoint.
+        """
+        [self.n_items, self.n_rows, n_others, self.n_parts, self.n_primitives] = checkpoint
+        del self.others[n_others:]
+
+
+class Frame(object):
+    """
+    The symbols for a single call of a UserFunction. Each call gets its own
+    frame so that recursive calls do not overwrite each others arguments.
+    """
+    __slots__ = ("parent", "symbols")
+
+    def __init__(self, function):
+        self.parent = function.frame
+        self.symbols = [FrameSymbol(name, function.filename) for name in function.slot_names]
+
 
 class LEnv(object):
     """
     This keeps track of the current lexical environment.
+
+    Symbols that are defined outside of a function are stored in symbols,
+    symbols that are defined inside a function are assigned a slot in
+    the frame of the function.
     """
+    __slots__ = ("function", "parent", "slots", "symbols")
+
     def __init__(self, parent = None, add_built_ins = False):
+        self.function = None
         self.parent = parent
+        self.slots = {}
         self.symbols = {}
 
+        if parent is not None:
+            self.function = parent.function
+
         if add_built_ins:
             self.addBuiltIns()
 
@@ -110,23 +375,34 @@ class LEnv(object):
         for sym_name in builtin_symbols.keys():
             self.symbols[sym_name] = builtin_symbols[sym_name]
 
-        # Import function modules (from modules.xml) here.
-        xml = ElementTree.parse(os.path.dirname(__file__) + "/modules.xml").getroot()
-        fn_modules = []
-        for module in xml:
-            fn_modules.append(importlib.import_module(module.text))
+        # Functions (from modules.xml), the modules are imported the
+        # first time that one of their functions is used.
+        if (len(builtin_modules) == 0):
+            xml = ElementTree.parse(os.path.dirname(__file__) + "/modules.xml").getroot()
+            for module in xml:
+                for function in module:
+                    builtin_modules[function.text] = module.attrib["name"]
 
-        for module in fn_modules:
-            for fn_name in module.lcad_functions.keys():
-                builtin_functions[fn_name] = True
-                self.symbols[fn_name] = Symbol(fn_name, "builtin")
-                self.symbols[fn_name].setv(module.lcad_functions[fn_name])
+        for fn_name in builtin_modules:
+            self.symbols[fn_name] = BuiltinSymbol(fn_name)
+
+    def hasSymbol(self, symbol_name):
+        return (symbol_name in self.symbols) or (symbol_name in self.slots)
 
 
 class LCadFunction(object):
     """
     The base class for all functions.
     """
+    # Functions whose result only depends on their arguments. Calls of
+    # these functions with constant arguments are folded (see folding.py).
+    pure = False
+
+    # Functions that have side effects outside of the model, or whose result
+    # is not the same every time, such as the random number functions.
+    # Forms that call these are evaluated in every frame (see incremental.py).
+    volatile = False
+
     def __init__(self, name):
         self.has_keyword_args = False
         self.has_optional_args = False
@@ -153,7 +429,7 @@ class LCadFunction(object):
 
         # Standard arguments.
         if (index < self.minimum_args):
-            if not isType(val, self.signature[index]):
+            if not isPlanType(val, self.standard_types[index]):
                 raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[index])), typeToString(type(val)))
             return val
         
@@ -161,7 +437,7 @@ class LCadFunction(object):
         # have to have the type specified by the last argument of the signature.
         if (index >= len(self.signature)):
             index = len(self.signature) - 1
-        if not isType(val, self.signature[index][1]):
+        if not isPlanType(val, self.optional_types[index - self.minimum_args]):
             raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[index][1])), type(val))
         return val
 
@@ -177,55 +453,59 @@ class LCadFunction(object):
         The defaults for the keywords are filled in with the defaults if they are 
         not found.
         """
-        args = tree.value[1:]
-        index = 0
+        args = tree.value
+        n_args = len(args)
 
         # Standard arguments.
         standard_args = []
-        while (index < self.minimum_args):
+        index = 1
+        for plan in self.standard_types:
             val = getv(interpret(model, args[index]))
-            if not isType(val, self.signature[index]):
-                raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[index])), type(val))
+            if (plan is not None) and not isinstance(val, plan[0]):
+                if (plan[1] is None) or not isinstance(val, plan[1]):
+                    raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[index-1])), type(val))
             standard_args.append(val)
             index += 1
 
         # Optional arguments.
         if self.has_optional_args:
-            sig_index = index
-            while (index < len(args)):
+            plans = self.optional_types
+            last = len(plans) - 1
+            opt_index = 0
+            while (index < n_args):
                 val = getv(interpret(model, args[index]))
-                if not isType(val, self.signature[sig_index][1]):
-                    raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[sig_index][1])), type(val))
+                plan = plans[opt_index]
+                if (plan is not None) and not isinstance(val, plan[0]):
+                    if (plan[1] is None) or not isinstance(val, plan[1]):
+                        raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[self.minimum_args + opt_index][1])), type(val))
                 standard_args.append(val)
                 index += 1
-                if (sig_index < (len(self.signature) - 2)):
-                    sig_index += 1
+                if (opt_index < last):
+                    opt_index += 1
             return standard_args
 
         # Keyword arguments.
         if self.has_keyword_args:
-            sig_dict = self.signature[index][1]
+            keyword_types = self.keyword_types
 
-            # Fill in keyword dictionary.
-            keyword_dict = {}
-            if isinstance(self, UserFunction):
-                for key in sig_dict.keys():
-                    keyword_dict[key] = getv(interpret(model, sig_dict[key][1]))
-            else:
-                for key in sig_dict.keys():
-                    keyword_dict[key] = sig_dict[key][1]
+            # Fill in keyword dictionary with the defaults.
+            keyword_dict = self.keyword_defaults.copy()
 
             # Parse keywords.
-            while (index < len(args)):
+            while (index < n_args):
                 key = args[index].value
                 if (key[0] != ":"):
                     raise lce.KeywordException(args[index].value)
                 key = key[1:]
-                if not key in sig_dict.keys():
+                if not key in keyword_types:
                     raise lce.UnknownKeywordException(key)
+                if ((index + 1) == n_args):
+                    raise lce.KeywordValueException()
                 val = getv(interpret(model, args[index+1]))
-                if not isType(val, sig_dict[key][0]):
-                    raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[sig_index][1])), type(val))
+                plan = keyword_types[key]
+                if (plan is not None) and not isinstance(val, plan[0]):
+                    if (plan[1] is None) or not isinstance(val, plan[1]):
+                        raise lce.WrongTypeException(", ".join(map(typeToString, self.signature[-1][1][key][0])), type(val))
                 keyword_dict[key] = val
                 index += 2
             return [standard_args, keyword_dict]
@@ -251,29 +531,46 @@ class LCadFunction(object):
         Note you should either have (2) or (3) but not both. All the functions that
         are not internal only take keywords.
 
+        The signature is also compiled into the plan that getArgs() uses to bind
+        the arguments, so that it does not need to be re-interpretted every time
+        the function is called.
         """
+        self.keyword_defaults = {}
+        self.keyword_types = {}
         self.minimum_args = 0
+        self.optional_types = []
         self.signature = signature
+        self.standard_types = []
         for arg in self.signature:
             if (len(arg) > 0):
                 if not isinstance(arg[0], basestring):
                     self.minimum_args += 1
+                    self.standard_types.append(compileTypes(arg))
                 else:
                     if (arg[0] == "optional"):
                         self.has_optional_args = True
+                        self.optional_types.append(compileTypes(arg[1]))
                     elif (arg[0] == "keyword"):
                         self.has_keyword_args = True
+                        for key in arg[1]:
+                            self.keyword_types[key] = compileTypes(arg[1][key][0])
+                            self.keyword_defaults[key] = arg[1][key][1]
 
 
 class Model(object):
     """
     This keeps track of the current "model", i.e. the 
-    current transformation matrix and groups of parts.
+    current transformation matrix and groups of parts, as
+    well as the frame of the UserFunction that is being
+    evaluated.
     """
-    def __init__(self, is_main = True):
+    def __init__(self, is_main = True, sink = None):
+        self.fold_constants = True
+        self.frame = None
         self.is_main = is_main
         self.m_cur_group = []
         self.m_groups = []
+        self.sink = sink
         self.used_names = {}
 
         self.pushGroup("main")
@@ -290,12 +587,142 @@ class Model(object):
     def pushGroup(self, name):
         if name in self.used_names:
             raise lce.GroupExistsException(name)
-        new_group = Group(name)
+        new_group = Group(name, self.sink)
         self.m_cur_group.append(new_group)
         self.m_groups.append(new_group)
         self.used_names[name] = 1
 
 
+class Program(object):
+    """
+    lcad code that is parsed, has its lexical environment created and is
+    compiled once, and can then be executed many times, for example once
+    for each frame of an animation.
+    """
+    def __init__(self, lcad_code, filename = "NA", engine = "interpreted", fold_constants = True, incremental = False):
+        """
+        :param lcad_code: A string containing lcad code.
+        :type lcad_code: str.
+        :param filename: A string containing the filename of the file that contained the lcad code.
+        :type filename: str.
+        :param engine: "interpreted" to walk the AST, "compiled" to first compile the AST into closures, "vm" to run the AST as bytecode.
+        :type engine: str.
+        :param fold_constants: Evaluate calls of pure functions with constant arguments only once (see folding.py), this can be turned off for debugging.
+        :type fold_constants: bool.
+        :param incremental: Re-use the results of the top level forms that do the same thing each time the program is executed (see incremental.py).
+        :type incremental: bool.
+        """
+        if not (engine in ["interpreted", "compiled", "vm"]):
+            raise lce.LCadException("unknown engine '" + str(engine) + "'.")
+
+        self.engine = engine
+        self.fold_constants = fold_constants
+        self.n_runs = 0
+        self.tracker = None
+
+        self.lenv = LEnv(add_built_ins = True)
+        self.ast = lexerParser.parse(lcad_code, filename)
+        createLexicalEnv(self.lenv, self.ast)
+        if fold_constants:
+            folding.foldTree(self.ast)
+        if (engine == "vm"):
+            vm.compileTree(self.ast)
+        else:
+            vm.compileDeep(self.ast)
+        if (engine == "compiled"):
+            compiler.compileTree(self.ast)
+
+        # Record the state that executing the program changes, so that
+        # it can be restored before the next time it is executed.
+        self.expressions = []
+        self.lenvs = []
+        self.symbols = []
+        lenvs = set()
+        nodes = [self.ast]
+        while (len(nodes) > 0):
+            node = nodes.pop()
+            if isinstance(node, list):
+                nodes.extend(node)
+            elif isinstance(node, lexerParser.LCadExpression):
+                nodes.extend(node.value)
+                self.expressions.append(node)
+                lenv = node.lenv
+                while (lenv is not None) and not (id(lenv) in lenvs):
+                    lenvs.add(id(lenv))
+                    self.lenvs.append([lenv, dict(lenv.symbols)])
+                    lenv = lenv.parent
+
+        self.builtins = []
+        for [lenv, symbols] in self.lenvs:
+            for symbol in symbols.values():
+                if isinstance(symbol, BuiltinSymbol):
+                    self.builtins.append(symbol)
+                elif not (symbol.name in builtin_symbols):
+                    self.symbols.append([symbol, symbol.is_set, symbol.value])
+
+        if incremental:
+            import opensdraw.lcad_language.incremental
+            self.tracker = opensdraw.lcad_language.incremental.Tracker(self.ast)
+
+    def execute(self, time_index = 0, profiler = None, sink = None):
+        """
+        Execute the program and return the model.
+
+        :param time_index: A time index.
+        :type time_index: integer.
+        :param profiler: Record the time spent in each function and line, this only works with the interpreted engine.
+        :type profiler: profiler.Profiler.
+        :param sink: Write the parts to temporary files as they are added (see ldrawWriter.SpillSink).
+        :type sink: ldrawWriter.SpillSink.
+        :returns: Model.
+        """
+        global lexical_epoch
+
+        if (profiler is not None) and (self.engine != "interpreted"):
+            raise lce.LCadException("profiling requires the interpreted engine.")
+        if (sink is not None) and (self.tracker is not None):
+            raise lce.LCadException("a sink can not be used with incremental programs.")
+
+        # Restore the state of the program.
+        if (self.n_runs > 0):
+            for node in self.expressions:
+                node.initialized = False
+            for [lenv, symbols] in self.lenvs:
+                lenv.symbols.clear()
+                lenv.symbols.update(symbols)
+            for [symbol, is_set, value] in self.symbols:
+                symbol.is_set = is_set
+                symbol.used = False
+                symbol.value = value
+                if isinstance(value, MemoizedFunction):
+                    value.cache.clear()
+            for symbol in self.builtins:
+                symbol.reset()
+            lexical_epoch += 1
+        self.n_runs += 1
+
+        # Set the value of the time-index symbol (for animations).
+        builtin_symbols["time-index"].setv(time_index)
+
+        model = Model(sink = sink)
+        model.fold_constants = self.fold_constants
+        if profiler is not None:
+            profiler.start()
+        try:
+            if self.tracker is not None:
+                self.tracker.execute(model, self.ast)
+            else:
+                interpret(model, self.ast)
+        except Exception as e:
+            if hasattr(e, "lcad_err"):
+                print(e.lcad_err)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        return model
+
+
 class SpecialFunction(LCadFunction):
     """
     Functions that operate on the AST.
@@ -307,6 +734,8 @@ class Symbol(object):
     """
     Symbol class.
     """
+    __slots__ = ("filename", "is_set", "name", "used", "value")
+
     def __init__(self, name, filename):
         self.filename = filename
         self.is_set = False
@@ -325,6 +754,69 @@ class Symbol(object):
         self.value = value
 
 
+class BuiltinSymbol(Symbol):
+    """
+    The symbol of a built in function. The module that defines the
+    function is imported the first time that the value is used.
+    """
+    __slots__ = ()
+
+    def __init__(self, name):
+        Symbol.__init__(self, name, "builtin")
+        self.is_set = True
+        del self.value
+
+    def __getattr__(self, name):
+        # This is only called until value has been set.
+        if (name != "value"):
+            raise AttributeError(name)
+        self.value = builtinFunction(self.name)
+        return self.value
+
+    def reset(self):
+        """
+        Set the symbol back to the built in function.
+        """
+        self.used = False
+        if self.isLoaded():
+            self.value = builtin_functions[self.name]
+
+    def isLoaded(self):
+        """
+        Returns True if value has been set, without importing the module.
+        """
+        try:
+            Symbol.value.__get__(self)
+        except AttributeError:
+            return False
+        return True
+
+
+class FrameSymbol(Symbol):
+    """
+    The symbols in the frame of a UserFunction. These always use the
+    Symbol methods, even if they are replaced (see incremental.py).
+    """
+    __slots__ = ()
+
+    getv = Symbol.getv
+    setv = Symbol.setv
+
+
+class TailCall(object):
+    """
+    A call of a user defined function that is the last thing that another
+    user defined function does (see markTailCalls()). This is returned by
+    the calling function instead of making the call, then UserFunction.call()
+    makes the call so that the Python stack does not grow.
+    """
+    def __init__(self, function, args, kwargs, value):
+        self.args = args
+        self.function = function
+        self.kwargs = kwargs
+        self.value = value
+
+
 class UserFunction(LCadFunction):
     """
     'Normal' user defined functions.
@@ -345,8 +837,17 @@ class UserFunction(LCadFunction):
             self.arg_list = flist[0].value
             self.body = flist[1]
 
-        self.arg_names = []
+        self.arg_slots = []
+        self.filename = tree.filename
+        self.frame = None
+        self.functions = []
+        self.keyword_slots = {}
+        self.slot_names = []
+        self.start_line = tree.start_line
+
+        # All the symbols in the function's lexical environment are stored in its frame.
         self.lenv = tree.lenv
+        self.lenv.function = self
 
         i = 0
         standard_args = []
@@ -365,37 +866,190 @@ class UserFunction(LCadFunction):
                 if isinstance(arg_value, lexerParser.LCadSymbol):
                     if (arg_value.value[0] == ":"):
                         raise Exception("Keyword arguments must have a default value.")
-                createLexicalEnv(self.lenv, arg_value)
+                declareSymbols(self.lenv, arg_value)
                 keyword_dict[arg_name] = [[object], arg_value]
+                self.keyword_slots[arg_name] = declareSymbol(self.lenv, arg_name, tree.filename)
                 i += 2
             else:
-                self.arg_names.append(arg_name)
                 standard_args.append([object])
+                self.arg_slots.append(declareSymbol(self.lenv, arg_name, tree.filename))
                 i += 1
 
-            checkOverride(self.lenv, arg_name)
-            self.lenv.symbols[arg_name] = Symbol(arg_name, tree.filename)
-
         if (len(keyword_dict.keys()) > 0):
             standard_args.append(["keyword", keyword_dict])
         self.setSignature(standard_args)
 
+        # The default values are evaluated when the function is called, except
+        # for constants which are the same for every call.
+        self.keyword_defaults = {}
+        self.keyword_plan = []
+        for key in keyword_dict:
+            node = keyword_dict[key][1]
+            if isinstance(node, lexerParser.LCadConstant):
+                self.keyword_plan.append([key, self.keyword_slots[key], None, node.value])
+            else:
+                self.keyword_plan.append([key, self.keyword_slots[key], node, None])
+
     def call(self, model, *args, **kwargs):
 
+        # Python code, such as the curve functions in library/shapes.py,
+        # can call functions without a model, but a model is needed to
+        # keep track of the current frame.
+        if model is None:
+            model = Model(is_main = False)
+
+        cur_frame = model.frame
+        try:
+            function = self
+            value = False
+            while True:
+                function.enter(model, args, kwargs)
+
+                # Evaluate function.
+                ret = interpret(model, function.body)
+                if (type(ret) is not TailCall):
+                    if value:
+                        ret = getv(ret)
+                    return ret
+
+                # Tail call.
+                [function, args, kwargs] = [ret.function, ret.args, ret.kwargs]
+                value = value or ret.value
+
+        finally:
+            model.frame = cur_frame
+
+    def enter(self, model, args, kwargs):
+        """
+        Create the frame for a call of this function and make it the current
+        frame of the model. The caller is responsible for restoring the
+        previous frame.
+        """
         # Check argument count.
         if (len(args) != self.minimum_args):
             raise lce.NumberArgumentsException(self.minimum_args, len(args))
-            
+
         # Fill in arguments.
+        frame = Frame(self)
         for i in range(len(args)):
-            self.lenv.symbols[self.arg_names[i]].setv(args[i])
+            frame.symbols[self.arg_slots[i]].setv(args[i])
 
-        if self.has_keyword_args:
-            for key in kwargs.keys():
-                self.lenv.symbols[key].setv(kwargs[key])
+        # Create the functions that are defined inside this function.
+        for [slot, function] in self.functions:
+            frame.symbols[slot].setv(function.closure(frame))
+
+        model.frame = frame
+
+        # Keyword default values are evaluated in the frame of the
+        # function as they can refer to the other arguments.
+        for [key, slot, node, val] in self.keyword_plan:
+            if key in kwargs:
+                val = kwargs[key]
+            elif node is not None:
+                val = getv(interpret(model, node))
+            frame.symbols[slot].setv(val)
+
+    def closure(self, frame):
+        """
+        Return a copy of this function that will be evaluated in the context of frame.
+        """
+        if frame is None:
+            return self
+        function = copy.copy(self)
+        function.frame = frame
+        return function
+
+
+class MemoizedFunction(UserFunction):
+    """
+    User defined functions that remember their results (see defmemo).
+
+    The parts that the function adds to the current group are also
+    remembered. These are recorded relative to the current transform
+    matrix and step offset so that they can be added again in the right
+    place the next time that the function is called with the same arguments.
+    """
+    def __init__(self, tree, name):
+        UserFunction.__init__(self, tree, name)
+        self.cache = collections.OrderedDict()
 
-        # Evaluate function.
-        return interpret(model, self.body)        
+    def call(self, model, *args, **kwargs):
+        key = memoKey([args, kwargs])
+        if key is None:
+            return UserFunction.call(self, model, *args, **kwargs)
+
+        if model is None:
+            model = Model(is_main = False)
+
+        # The cache is ordered from least to most recently used. The parts
+        # of a result can not be added again if step-offset is a function,
+        # as each part needs its own step (see record()).
+        result = self.cache.pop(key, None)
+        if (result is not None) and (result[2] is not None) and not isinstance(getv(builtin_symbols["step-offset"]), numbers.Number):
+            result = None
+
+        step_offset = 0
+        if result is None:
+            result = self.record(model, args, kwargs)
+            if result[2] is False:
+                group = model.curGroup()
+                group.extend(result[1], group.matrix())
+                return result[0]
+            if (len(self.cache) >= memo_size):
+                self.cache.popitem(last = False)
+        elif result[2] is not None:
+            step_offset = getStepOffset(model) - result[2]
+        self.cache[key] = result
+
+        [value, emitted, recorded_step_offset] = result
+        group = model.curGroup()
+        group.extend(emitted, group.matrix(), step_offset)
+        return folding.copyValue(value)
+
+    def closure(self, frame):
+        function = UserFunction.closure(self, frame)
+        if function is not self:
+            function.cache = collections.OrderedDict()
+        return function
+
+    def record(self, model, args, kwargs):
+        """
+        Call the function with the current group matrix set to the identity
+        matrix, and return [value, parts, step offset]. The parts are removed
+        from the current group and returned as a Group (see Group.since()).
+        """
+        group = model.curGroup()
+        cur_matrix = group.matrix()
+        n_groups = len(model.groups())
+        n_headers = len(group.header)
+        checkpoint = group.checkpoint()
+
+        # The parts can not be given to the sink until they have been recorded.
+        group.holds += 1
+        group.setMatrix(numpy.identity(4))
+        try:
+            value = folding.copyValue(getv(UserFunction.call(self, model, *args, **kwargs)))
+        finally:
+            group.setMatrix(cur_matrix)
+            group.holds -= 1
+
+        if (model.curGroup() is not group) or (len(model.groups()) != n_groups) or (len(group.header) != n_headers):
+            raise lce.MemoizeException(self.name)
+        emitted = group.since(checkpoint)
+        if emitted.have_comments:
+            raise lce.MemoizeException(self.name)
+        group.truncate(checkpoint)
+
+        # Parts (but not primitives) have a step. If step-offset is a
+        # function each part has already been given its own step by calling
+        # it, so the result can not be remembered (the step offset is False).
+        step_offset = None
+        if (emitted.n_rows > 0):
+            if isinstance(getv(builtin_symbols["step-offset"]), numbers.Number):
+                step_offset = getStepOffset(model)
+            else:
+                step_offset = False
+        return [value, emitted, step_offset]
 
 
 # t and nil are objects so that we can do comparisons using 'is' and
@@ -424,18 +1078,83 @@ builtin_symbols["time-index"] = Symbol("time-index", "builtin")
 builtin_symbols["time-index"].setv(0)
 
 
+def addDependency(filename):
+    """
+    Record that the program read the file filename (see dependencies).
+    """
+    if dependencies is not None:
+        dependencies.add(os.path.abspath(filename))
+
+
+def annotateError(e, func, tree):
+    """
+    Add the function name and the location of tree to the lcad error message of e.
+    """
+    if hasattr(func, "name"):
+        err_string = "!Error in function '" + func.name + "' at line " + str(tree.start_line) + " in file '" + str(tree.filename) + "'\n"
+    else:
+        err_string = "!Error at line "  + str(tree.start_line) + " in file '" + str(tree.filename) + "'\n"
+    if hasattr(e, "lcad_err"):
+        e.lcad_err = err_string + e.lcad_err
+    else:
+        e.lcad_err = err_string
+
+
+def builtinName(tree):
+    """
+    Return the name of the built in function that the symbol tree
+    refers to, or None if it does not refer to a built in function.
+    """
+    if not isinstance(tree, lexerParser.LCadSymbol) or (tree.shadowed is not None):
+        return None
+    if not isinstance(tree.address, Symbol) or not (tree.value in builtin_modules):
+        return None
+    if (tree.address.value is builtin_functions[tree.value]):
+        return tree.value
+    return None
+
+
+def builtinFunction(fn_name):
+    """
+    Return the built in function fn_name, importing the module that
+    defines it if this has not been done already.
+    """
+    if not (fn_name in builtin_functions):
+        module_name = builtin_modules[fn_name]
+        module = importlib.import_module(module_name)
+        for name in builtin_modules:
+            if (builtin_modules[name] == module_name):
+                if not (name in module.lcad_functions):
+                    raise lce.LCadException("function '" + name + "' is not defined in " + module_name + " (see modules.xml).")
+                builtin_functions[name] = module.lcad_functions[name]
+    return builtin_functions[fn_name]
+
+
+def callKeyword(func, model, tree):
+    [args, kwargs] = func.getArgs(model, tree)
+    return func.call(model, *args, **kwargs)
+
+
+def callSpecial(func, model, tree):
+    return func.call(model, tree)
+
+
+def callStandard(func, model, tree):
+    return func.call(model, *func.getArgs(model, tree))
+
+
 def checkOverride(lenv, symbol_name, external_filename = False):
     """
     Check if symbol_name overrides a builtin or user defined symbol.
     """
+    global lexical_epoch
 
     # Error for shadowing built in symbols.
     if (symbol_name in builtin_symbols):
         raise lce.CannotOverrideBuiltIn()
 
     # Error for shadowing symbols at the same level of scope.
-    if symbol_name in lenv.symbols:
-        symbol = lenv.symbols[symbol_name]
+    if lenv.hasSymbol(symbol_name):
 
         # This the standard check.
         if not external_filename:
@@ -444,98 +1163,224 @@ def checkOverride(lenv, symbol_name, external_filename = False):
         # Import uses this to not give errors for multiple 
         # imports of same symbol from the same package.
         else:
-            if (external_filename != symbol.filename):
+            if (symbol_name in lenv.slots) or (external_filename != lenv.symbols[symbol_name].filename):
                 raise lce.SymbolAlreadyExists(symbol_name)
+            lexical_epoch += 1
 
     # Warning for shadowing other existing symbols in higher level of scope.
-    try:
-        findSymbol(lenv.parent, symbol_name)
-    except lce.SymbolNotDefined:
-        return
+    parent = lenv.parent
+    while parent is not None:
+        if parent.hasSymbol(symbol_name):
+            lexical_epoch += 1
+            print("Warning", symbol_name, "shadows existing symbol with the same name!!")
+            return
+        parent = parent.parent
+
+
+def checkSet(symbol):
+    """
+    Check that symbol (the result of interpreting the first argument of set) can be set.
+    """
+    global fold_epoch
+
+    if not isinstance(symbol, Symbol):
+        raise lce.CannotSetException(type(symbol))
+    if (symbol.name in builtin_modules):
+        print("Warning, overwriting builtin function:", symbol.name, "!!")
+        fold_epoch += 1
+    if (symbol.name in builtin_symbols):
+        if not (symbol.name in mutable_symbols):
+            raise lce.CannotOverrideBuiltIn()
 
-    print("Warning", symbol_name, "shadows existing symbol with the same name!!")
+
+def compileTypes(types):
+    """
+    Convert a list of types into a type checking plan. This is None if
+    any type is allowed, otherwise it is a tuple of concrete types for
+    a fast isinstance() check and a tuple of the original types (or None
+    if they are the same) to check if the fast check fails.
+    """
+    if object in types:
+        return None
+
+    fast_types = []
+    for a_type in types:
+        if a_type in concrete_types:
+            fast_types.extend(concrete_types[a_type])
+        else:
+            fast_types.append(a_type)
+
+    if (fast_types == list(types)):
+        return (tuple(fast_types), None)
+    return (tuple(fast_types), tuple(types))
 
 
 def createLexicalEnv(lenv, tree):
     """
-    Recursively walk the AST creating the a lexical environment in which to
-    evaluate all the symbols.
+    Create the lexical environment in which to evaluate all the
+    symbols in the AST, then resolve each of the symbols and find
+    the tail calls.
     """
-    if isinstance(tree, lexerParser.LCadExpression):
-        try:
-            # Every expression has it's own lexical environment whose parent
-            # is the lexical environment of the enclosing expression.
-            tree.lenv = LEnv(lenv)
-            flist = tree.value
-
-            # Empty list.
-            if (len(flist) == 0):
-                return
-
-            start = 0
-            if isinstance(flist[0], lexerParser.LCadSymbol):
-                start = 1
-                flist[0].lenv = tree.lenv
-
-                # First element is def.
-                #
-                # Create symbols for functions. Functions are created and initialized 
-                # at this time so that they can be called out of order.
-                #
-                if (flist[0].value == "def"):
-
-                    # 4 arguments means this is a function definition.
-                    #
-                    # def creates symbols in the lexical environment of the parent expression
-                    # so that they are visible outside of the def statement.
-                    #
-                    # functions are evaluated in lexical environment of the def statement, so
-                    # that their variables are not visible outside of the def statement.
-                    #
-                    if (len(flist)==4):
-                        start = len(flist) - 1
-                        checkOverride(lenv, flist[1].value)
-                        lenv.symbols[flist[1].value] = Symbol(flist[1].value, tree.filename)
-                        lenv.symbols[flist[1].value].setv(UserFunction(tree, flist[1].value))
-
-            if (start != len(flist)):
-                for node in flist[start:]:
-                    createLexicalEnv(tree.lenv, node)
-
-        except Exception:
-            print("!Error in expression '" + tree.value[0].value + "' at line " + str(tree.start_line) + ":")
-            raise
+    declareSymbols(lenv, tree)
+    resolveSymbols(tree)
+    markTailCalls(tree)
 
-    elif isinstance(tree, lexerParser.LCadSymbol):
+
+def declareExpression(lenv, tree):
+    """
+    Create the lexical environment for the expression tree and declare
+    the symbols that it creates. Returns the nodes of the expression
+    that are in the lexical environment of the expression.
+    """
+    # Expressions that create symbols have their own lexical environment
+    # whose parent is the lexical environment of the enclosing expression,
+    # other expressions use the lexical environment of the enclosing expression.
+    if needsLEnv(tree):
+        tree.lenv = LEnv(lenv)
+    else:
         tree.lenv = lenv
+    flist = tree.value
+
+    # Empty list.
+    if (len(flist) == 0):
+        return []
+
+    start = 0
+    if isinstance(flist[0], lexerParser.LCadSymbol):
+        start = 1
+        flist[0].lenv = tree.lenv
+
+        # First element is def (or defmemo).
+        #
+        # Create symbols for functions. Functions are created and initialized 
+        # at this time so that they can be called out of order.
+        #
+        if (flist[0].value == "def") or (flist[0].value == "defmemo"):
+
+            # 4 arguments means this is a function definition.
+            #
+            # def creates symbols in the lexical environment of the parent expression
+            # so that they are visible outside of the def statement.
+            #
+            # functions are evaluated in lexical environment of the def statement, so
+            # that their variables are not visible outside of the def statement.
+            #
+            # Functions that are defined inside of another function are created
+            # each time the other function is called.
+            #
+            if (len(flist)==4):
+                start = len(flist) - 1
+                flist[1].lenv = lenv
+                slot = declareSymbol(lenv, flist[1].value, tree.filename, is_function = True)
+                if (flist[0].value == "defmemo"):
+                    function = MemoizedFunction(tree, flist[1].value)
+                else:
+                    function = UserFunction(tree, flist[1].value)
+                if slot is None:
+                    lenv.symbols[flist[1].value].setv(function)
+                else:
+                    lenv.function.functions.append([slot, function])
 
-    elif isinstance(tree, list):
-        for node in tree:
-            createLexicalEnv(lenv, node)
+            # Variables.
+            elif ((len(flist)%2) == 1):
+                for key in flist[1::2]:
+                    if isinstance(key, lexerParser.LCadSymbol):
+                        declareSymbol(lenv, key.value, tree.filename)
 
+        # First element is for, declare the loop variable.
+        elif (flist[0].value == "for"):
+            if (len(flist) > 1) and isinstance(flist[1], lexerParser.LCadExpression):
+                loop_args = flist[1].value
+                if (len(loop_args) > 0) and isinstance(loop_args[0], lexerParser.LCadSymbol):
+                    declareSymbol(tree.lenv, loop_args[0].value, tree.filename)
 
-def dispatch(func, model, tree):
+        # First element is lambda, create the function.
+        elif (flist[0].value == "lambda"):
+            if (len(flist) == 3):
+                start = 2
+                tree.function = UserFunction(tree, "anonymous")
+
+    return flist[start:]
+
+
+def declareSymbol(lenv, symbol_name, filename, is_function = False):
     """
-    This handles function calls to both user-defined and built-in functions.
+    Declare a symbol in lenv. Outside of functions this creates the Symbol, 
+    inside a function the symbol is assigned a slot in the function's frame
+    and the slot is returned.
+
+    Variables can be declared multiple times in the same lexical environment,
+    for example in the different branches of an if statement. Def checks that
+    they are only set once when the program is evaluated.
     """
-    if not isinstance(func, LCadFunction):
-        raise lce.NotAFunctionException(func)
-    if not tree.initialized:
-        func.argCheck(tree)
+    if lenv.hasSymbol(symbol_name) and not is_function:
+        return lenv.slots.get(symbol_name)
 
-    if isinstance(func, SpecialFunction):
-        return func.call(model, tree)
+    checkOverride(lenv, symbol_name)
+    if lenv.function is None:
+        lenv.symbols[symbol_name] = Symbol(symbol_name, filename)
+        return None
     else:
-        if func.has_keyword_args:
-            [args, kwargs] = func.getArgs(model, tree)
-            return func.call(model, *args, **kwargs)
-        else:
-            return func.call(model, *func.getArgs(model, tree))
+        slot = len(lenv.function.slot_names)
+        lenv.function.slot_names.append(symbol_name)
+        lenv.slots[symbol_name] = slot
+        return slot
+
+
+def declareSymbols(lenv, tree):
+    """
+    Walk the AST creating the a lexical environment for each
+    expression and declaring the symbols created by def, for
+    and function arguments.
+
+    This uses a list of the nodes to visit instead of recursion so
+    that there is no limit on how deep the AST can be.
+    """
+    # [lexical environment, node, enclosing expressions]
+    nodes = [[lenv, tree, None]]
+    while (len(nodes) > 0):
+        [lenv, tree, parents] = nodes.pop()
+
+        if isinstance(tree, lexerParser.LCadExpression):
+            try:
+                children = declareExpression(lenv, tree)
+            except Exception:
+
+                # Print the location of the error and of the expressions that contain it.
+                expressions = [tree, parents]
+                while expressions is not None:
+                    [tree, expressions] = expressions
+                    print("!Error in expression '" + tree.value[0].value + "' at line " + str(tree.start_line) + ":")
+                raise
+
+            for node in reversed(children):
+                nodes.append([tree.lenv, node, [tree, parents]])
+
+        elif isinstance(tree, lexerParser.LCadSymbol):
+            tree.lenv = lenv
+
+        elif isinstance(tree, list):
+            for node in reversed(tree):
+                nodes.append([lenv, node, parents])
+
+
+def dispatch(func, model, tree):
+    """
+    This handles function calls to both user-defined and built-in functions.
+
+    The function and the way to call it are cached in the expression, so that
+    the next call of the same function from this expression can skip the
+    checks. Any change to the function (for example by set) is a cache miss.
+    """
+    if (func is tree.cached_func) and (func is not None):
+        return tree.cached_call(func, model, tree)
+    return findCall(func, tree)(func, model, tree)
 
 
-def execute(lcad_code, filename = "NA", time_index = 0):
+def execute(lcad_code, filename = "NA", time_index = 0, engine = "interpreted", fold_constants = True, profiler = None, sink = None):
     """
-    Parses and executes the lcad code in the string lcad_code and returns the model.
+    Parses and executes the lcad code in the string lcad_code and returns the
+    model. Use a Program to execute the same code more than once.
 
     :param lcad_code: A string containing lcad code.
     :type lcad_code: str.
@@ -543,27 +1388,129 @@ def execute(lcad_code, filename = "NA", time_index = 0):
     :type filename: str.
     :param time_index: A time index.
     :type time_index: integer.
+    :param engine: "interpreted" to walk the AST, "compiled" to first compile the AST into closures, "vm" to run the AST as bytecode.
+    :type engine: str.
+    :param fold_constants: Evaluate calls of pure functions with constant arguments only once (see folding.py), this can be turned off for debugging.
+    :type fold_constants: bool.
+    :param profiler: Record the time spent in each function and line, this only works with the interpreted engine.
+    :type profiler: profiler.Profiler.
+    :param sink: Write the parts to temporary files as they are added (see ldrawWriter.SpillSink).
+    :type sink: ldrawWriter.SpillSink.
     :returns: Model.
     """
-    # Set the value of the time-index symbol (for animations).
-    builtin_symbols["time-index"].setv(time_index)
+    if (profiler is not None) and (engine != "interpreted"):
+        raise lce.LCadException("profiling requires the interpreted engine.")
+    program = Program(lcad_code, filename, engine, fold_constants)
+    return program.execute(time_index, profiler, sink)
+
+
+def executeStream(fp, filename = "NA", time_index = 0, engine = "interpreted", fold_constants = True, profiler = None, sink = None):
+    """
+    Parses and executes the lcad code in the file object fp one top level
+    form at a time and returns the model. Each form is evaluated as soon as
+    it has been read, then its AST is released, so the AST of the whole
+    file is never in memory. This is for very large (machine generated)
+    files, use a Program to execute the same code more than once.
+
+    As with execute(), functions can be called before they are defined. A
+    form that refers to a symbol that has not been defined yet, directly or
+    through the functions that it calls, waits until the symbol is defined.
+    The forms after it also wait, so the forms are evaluated in order. Any
+    forms that are still waiting at the end of the file are then evaluated.
+
+    :param fp: A file object containing lcad code.
+    :type fp: file.
+    :param filename: A string containing the filename of the file that contained the lcad code.
+    :type filename: str.
+    :param time_index: A time index.
+    :type time_index: integer.
+    :param engine: "interpreted" to walk the AST, "compiled" to first compile the AST into closures, "vm" to run the AST as bytecode.
+    :type engine: str.
+    :param fold_constants: Evaluate calls of pure functions with constant arguments only once (see folding.py), this can be turned off for debugging.
+    :type fold_constants: bool.
+    :param profiler: Record the time spent in each function and line, this only works with the interpreted engine.
+    :type profiler: profiler.Profiler.
+    :param sink: Write the parts to temporary files as they are added (see ldrawWriter.SpillSink).
+    :type sink: ldrawWriter.SpillSink.
+    :returns: Model.
+    """
+    if not (engine in ["interpreted", "compiled", "vm"]):
+        raise lce.LCadException("unknown engine '" + str(engine) + "'.")
+    if (profiler is not None) and (engine != "interpreted"):
+        raise lce.LCadException("profiling requires the interpreted engine.")
 
     lenv = LEnv(add_built_ins = True)
-    model = Model()
-    ast = lexerParser.parse(lcad_code, filename)
-    createLexicalEnv(lenv, ast)
+    builtin_symbols["time-index"].setv(time_index)
+
+    model = Model(sink = sink)
+    model.fold_constants = fold_constants
+
+    def evaluate(form):
+        if fold_constants:
+            folding.foldTree(form)
+        if (engine == "vm"):
+            vm.compileTree(form)
+        else:
+            vm.compileDeep(form)
+        if (engine == "compiled"):
+            compiler.compileTree(form)
+        interpret(model, form)
+
+    # The ids of the functions whose symbols are all defined.
+    resolved = set()
+
+    if profiler is not None:
+        profiler.start()
     try:
-        interpret(model, ast)
+        pending = collections.deque()
+        for form in lexerParser.parseStream(fp, filename):
+            createLexicalEnv(lenv, form)
+            pending.append(form)
+            while (len(pending) > 0) and isResolved(pending[0], resolved):
+                evaluate(pending.popleft())
+
+        # Symbols that are never defined are errors when they are used.
+        while (len(pending) > 0):
+            form = pending.popleft()
+            isResolved(form, resolved)
+            evaluate(form)
+
     except Exception as e:
         if hasattr(e, "lcad_err"):
             print(e.lcad_err)
         raise
+    finally:
+        if profiler is not None:
+            profiler.stop()
     return model
 
 
+def findCall(func, tree):
+    """
+    Check that func can be called from the expression tree and return the
+    function (callKeyword, callSpecial or callStandard) to use to call it.
+    This is also cached in tree.
+    """
+    if not isinstance(func, LCadFunction):
+        raise lce.NotAFunctionException(func)
+    if not tree.initialized:
+        func.argCheck(tree)
+
+    if isinstance(func, SpecialFunction):
+        call = callSpecial
+    elif func.has_keyword_args:
+        call = callKeyword
+    else:
+        call = callStandard
+
+    tree.cached_call = call
+    tree.cached_func = func
+    return call
+
+
 def findSymbol(lenv, symbol_name):
     """
-    Recursively searchs up the tree of lexical environments to find
+    Searchs up the tree of lexical environments to find
     a symbol_name.
 
     :param lenv: A lexical environment.
@@ -573,11 +1520,11 @@ def findSymbol(lenv, symbol_name):
     :returns: Symbol.
     :raises: SymbolNotDefined.
     """
-    if lenv is None:
-        raise lce.SymbolNotDefined(symbol_name)
-    if symbol_name in lenv.symbols:
-        return lenv.symbols[symbol_name]
-    return findSymbol(lenv.parent, symbol_name)
+    while lenv is not None:
+        if symbol_name in lenv.symbols:
+            return lenv.symbols[symbol_name]
+        lenv = lenv.parent
+    raise lce.SymbolNotDefined(symbol_name)
 
 
 def getStepOffset(model):
@@ -597,6 +1544,7 @@ def getStepOffset(model):
     return step_offset
     
 
+
 def getv(node):
     """
     A convenience function, interpret() will return a symbol or a 
@@ -615,15 +1563,29 @@ def interpret(model, tree):
     of the their lexical environment and the current context.
 
     Variables and functions have lexical scope.
+
+    Expressions that are nested too deeply to evaluate this way are run
+    on the virtual machine instead (see vm.compileDeep()).
     """
 
+    # List
+    if isinstance(tree, list):
+        ret = None
+        for node in tree:
+            ret = interpret(model, node)
+        return ret
+
+    # Compiled node (see compiler.py).
+    if tree.code is not None:
+        return tree.code(model)
+
     # Fixed value terminal node.
     if isinstance(tree, lexerParser.LCadConstant):
         return tree.value
 
     # Symbol.
     elif isinstance(tree, lexerParser.LCadSymbol):
-        return findSymbol(tree.lenv, tree.value)
+        return lookupSymbol(model, tree)
 
     # Expression.
     #
@@ -642,27 +1604,15 @@ def interpret(model, tree):
             raise lce.NotAFunctionException(flist[0].value)
 
         try:
+            if tree.tail_call and (type(func) is UserFunction):
+                return tailCall(func, model, tree)
             val = dispatch(func, model, tree)
         except Exception as e:
-            if hasattr(func, "name"):
-                err_string = "!Error in function '" + func.name + "' at line " + str(tree.start_line) + " in file '" + str(tree.filename) + "'\n"
-            else:
-                err_string = "!Error at line "  + str(tree.start_line) + " in file '" + str(tree.filename) + "'\n"
-            if hasattr(e, "lcad_err"):
-                e.lcad_err = err_string + e.lcad_err
-            else:
-                e.lcad_err = err_string
+            annotateError(e, func, tree)
             raise
 
         return val
 
-    # List
-    else:
-        ret = None
-        for node in tree:
-            ret = interpret(model, node)
-        return ret
-
 
 def isTrue(val):
     """
@@ -675,6 +1625,55 @@ def isTrue(val):
     raise lce.BooleanException()
 
 
+def isPlanType(val, plan):
+    """
+    Check if val is of a type in a plan from compileTypes().
+    """
+    if (plan is None) or isinstance(val, plan[0]):
+        return True
+    return (plan[1] is not None) and isinstance(val, plan[1])
+
+
+def isResolved(tree, resolved):
+    """
+    Returns True if all the symbols in tree, and in the user functions
+    that it refers to, have been declared (see executeStream()). The
+    symbols that were not declared when tree was resolved are resolved
+    again. resolved is the set of the ids of the functions that are known
+    to be resolved, the functions that were checked are added to it.
+    """
+    functions = set()
+    nodes = [tree]
+    while (len(nodes) > 0):
+        tree = nodes.pop()
+        if isinstance(tree, lexerParser.LCadExpression):
+            nodes.extend(tree.value)
+        elif isinstance(tree, list):
+            nodes.extend(tree)
+        elif isinstance(tree, lexerParser.LCadSymbol) and (tree.lenv is not None):
+            if tree.address is None:
+                resolveSymbol(tree)
+
+            # Symbols that are created when the program is evaluated, such
+            # as those created by import, are found by name.
+            if tree.address is None:
+                try:
+                    findSymbol(tree.lenv, tree.value)
+                except lce.SymbolNotDefined:
+                    return False
+
+            # This does not load built in functions.
+            elif isinstance(tree.address, Symbol) and not isinstance(tree.address, BuiltinSymbol):
+                value = tree.address.value
+                if isinstance(value, UserFunction) and not (id(value) in resolved) and not (id(value) in functions):
+                    functions.add(id(value))
+                    nodes.append(value.arg_list)
+                    nodes.append(value.body)
+
+    resolved.update(functions)
+    return True
+
+
 def isType(val, types):
     """
     Check if val is of a type in types.
@@ -685,6 +1684,209 @@ def isType(val, types):
     return False
 
 
+def lookupAddress(model, address):
+    """
+    Return the Symbol at address.
+
+    :param model: The current model.
+    :type model: Model.
+    :param address: A Symbol or a (depth, slot) address.
+    :returns: Symbol.
+    """
+    # Symbols defined outside of a function.
+    if isinstance(address, Symbol):
+        return address
+
+    # Symbols in the frame of a function.
+    [depth, slot] = address
+    frame = model.frame
+    while (depth > 0):
+        frame = frame.parent
+        depth -= 1
+    return frame.symbols[slot]
+
+
+def lookupSymbol(model, tree):
+    """
+    Return the Symbol that the symbol tree refers to.
+
+    :param model: The current model.
+    :type model: Model.
+    :param tree: A symbol in the AST.
+    :type tree: LCadSymbol.
+    :returns: Symbol.
+    :raises: SymbolNotDefined.
+    """
+    # Symbols that are created when the program is evaluated, such as
+    # those created by import, are found by name.
+    if tree.address is None:
+        return findSymbol(tree.lenv, tree.value)
+
+    symbol = lookupAddress(model, tree.address)
+
+    # Until a def sets a symbol that shadows another symbol with the
+    # same name, the name refers to the shadowed symbol.
+    if tree.shadowed is not None and not symbol.is_set:
+        for address in tree.shadowed:
+            shadowed = lookupAddress(model, address)
+            if shadowed.is_set:
+                return shadowed
+    return symbol
+
+
+def markTailCalls(tree):
+    """
+    Walk the AST marking the calls in the bodies of user defined functions
+    that are the last thing that the function does. These are the body
+    itself, or the last expression of a block, if or cond that is in this
+    position. When the function being called is a UserFunction these calls
+    return a TailCall instead of making the call.
+
+    tail_value is set if the result of the call is the value of a block,
+    as block returns values, not symbols.
+    """
+    nodes = [tree]
+    bodies = []
+    while (len(nodes) > 0):
+        tree = nodes.pop()
+        if isinstance(tree, list):
+            nodes.extend(tree)
+        elif isinstance(tree, lexerParser.LCadExpression):
+            nodes.extend(tree.value)
+            if (len(tree.value) > 0):
+                name = builtinName(tree.value[0])
+                if ((name == "def") or (name == "defmemo")) and (len(tree.value) == 4):
+                    bodies.append([tree.value[3], False])
+                elif (name == "lambda") and (len(tree.value) == 3):
+                    bodies.append([tree.value[2], False])
+
+    while (len(bodies) > 0):
+        [tree, value] = bodies.pop()
+        if not isinstance(tree, lexerParser.LCadExpression) or (len(tree.value) == 0):
+            continue
+
+        flist = tree.value
+        name = builtinName(flist[0])
+        if (name == "block"):
+            if (len(flist) > 1):
+                bodies.append([flist[-1], True])
+        elif (name == "if"):
+            if (len(flist) == 3) or (len(flist) == 4):
+                for node in flist[2:]:
+                    bodies.append([node, value])
+        elif (name == "cond"):
+            for node in flist[1:]:
+                if isinstance(node, lexerParser.LCadExpression) and (len(node.value) > 1):
+                    bodies.append([node.value[-1], value])
+        elif name is None:
+            tree.tail_call = True
+            tree.tail_value = value
+
+
+def memoKey(val):
+    """
+    Return a key for val for the cache of a MemoizedFunction, or None if
+    val cannot be used as a key. Vectors and matrices are keyed by their
+    contents. The type is part of the key so that, for example, 1 and 1.0
+    are different keys.
+    """
+    if isinstance(val, dict):
+        val = sorted(val.items())
+
+    if isinstance(val, list) or isinstance(val, tuple):
+        key = []
+        for elt in val:
+            elt_key = memoKey(elt)
+            if elt_key is None:
+                return None
+            key.append(elt_key)
+        return (type(val), tuple(key))
+
+    if isinstance(val, numpy.ndarray):
+        return (type(val), val.shape, val.dtype.str, val.tobytes())
+
+    try:
+        hash(val)
+    except TypeError:
+        return None
+    return (type(val), val)
+
+
+def needsLEnv(tree):
+    """
+    Returns True if the expression tree needs its own lexical environment.
+    These are for, lambda, function definitions, import, pyimport and
+    any expression (such as block) that contains a def, import or pyimport.
+    """
+    flist = tree.value
+    if (len(flist) > 0) and isinstance(flist[0], lexerParser.LCadSymbol):
+        name = flist[0].value
+        if (name == "for") or (name == "lambda") or (name == "import") or (name == "pyimport"):
+            return True
+        if ((name == "def") or (name == "defmemo")) and (len(flist) == 4):
+            return True
+
+    for node in flist:
+        if isinstance(node, lexerParser.LCadExpression) and (len(node.value) > 0):
+            head = node.value[0]
+            if isinstance(head, lexerParser.LCadSymbol) and (head.value in scope_functions):
+                return True
+    return False
+
+
+def resolveSymbol(tree):
+    """
+    Resolve a single symbol, see resolveSymbols().
+    """
+    addresses = []
+    depth = 0
+    lenv = tree.lenv
+    while lenv is not None:
+        if tree.value in lenv.slots:
+            addresses.append([depth, lenv.slots[tree.value]])
+        elif tree.value in lenv.symbols:
+            addresses.append(lenv.symbols[tree.value])
+        if (lenv.parent is not None) and (lenv.parent.function is not lenv.function):
+            depth += 1
+        lenv = lenv.parent
+
+    if (len(addresses) > 0):
+        tree.address = addresses[0]
+    if (len(addresses) > 1):
+        tree.shadowed = addresses[1:]
+
+
+def resolveSymbols(tree):
+    """
+    Walk the AST resolving each symbol to either a Symbol or to a
+    (depth, slot) address in the frame of a function. Depth is the
+    number of functions between the symbol and the function that it
+    was defined in.
+    """
+    nodes = [tree]
+    while (len(nodes) > 0):
+        tree = nodes.pop()
+        if isinstance(tree, lexerParser.LCadExpression):
+            nodes.extend(tree.value)
+        elif isinstance(tree, list):
+            nodes.extend(tree)
+        elif isinstance(tree, lexerParser.LCadSymbol) and (tree.lenv is not None):
+            resolveSymbol(tree)
+
+
+def tailCall(func, model, tree):
+    """
+    Evaluate the arguments of the call of the UserFunction func in tail
+    position and return the TailCall (see markTailCalls()).
+    """
+    if findCall(func, tree) is callKeyword:
+        [args, kwargs] = func.getArgs(model, tree)
+    else:
+        args = func.getArgs(model, tree)
+        kwargs = {}
+    return TailCall(func, args, kwargs, tree.tail_value)
+
+
 def typeToString(a_type):
     """
     Convert a type name to the corresponding lcad string.
@@ -694,6 +1896,8 @@ def typeToString(a_type):
         return "string"
     if (a_string == "CurveFunction"):
         return "curve function"
+    if (a_string == "LCadArray"):
+        return "array"
     if (a_string == "LCadBoolean"):
         return "t, nil"
     if (a_string == "Symbol"):
@@ -711,16 +1915,19 @@ def typeToString(a_type):
 
 def walk(tree, func, indent = ""):
     """
-    Recursively walks the AST evaluating func on each of the nodes.
+    Walks the AST evaluating func on each of the nodes.
     """
-    if isinstance(tree, list):
-        for node in tree:
-            walk(node, func, indent)
-    else:
-        func(tree, indent)
-        if isinstance(tree, lexerParser.LCadExpression):
-            for node in tree.value:
-                walk(node, func, indent + " ")
+    nodes = [[tree, indent]]
+    while (len(nodes) > 0):
+        [tree, indent] = nodes.pop()
+        if isinstance(tree, list):
+            for node in reversed(tree):
+                nodes.append([node, indent])
+        else:
+            func(tree, indent)
+            if isinstance(tree, lexerParser.LCadExpression):
+                for node in reversed(tree.value):
+                    nodes.append([node, indent + " "])
 
 
 #
@@ -42,6 +42,10 @@ class KeywordValueException(LCadException):
     def __init__(self):
         LCadException.__init__(self, "Keyword with no corresponding value")
 
+class MemoizeException(LCadException):
+    def __init__(self, name):
+        LCadException.__init__(self, "memoized function '" + name + "' can only add parts to the current group.")
+
 class NotAFunctionException(LCadException):
     def __init__(self, name):
         LCadException.__init__(self, "'" + str(name) + "' is not a function. The first element of a form must be a function.")
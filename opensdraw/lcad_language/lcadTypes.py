@@ -10,6 +10,12 @@
 import numpy
 
 
+class LCadArray(numpy.ndarray):
+    """
+    numpy array of numbers of any size (see arrayFunctions.py).
+    """
+    pass
+
 class LCadBoolean(object):
     """
     boolean type, t/nil
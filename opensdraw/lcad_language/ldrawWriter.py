@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+"""
+.. module:: ldrawWriter
+   :synopsis: Writes a model in LDraw format.
+
+.. moduleauthor:: Hazen Babcock
+
+The parts of a group are formatted a block at a time from the columns of
+the group (see interpreter.Group). Each distinct number, part ID and
+color is only formatted once per block. The output is the same as
+formatting each part with parts.Part.toLDraw().
+
+A SpillSink writes the parts of a model to temporary files while the model
+is being built, so that the memory that is used does not depend on the
+number of parts. The files are merged by step when the model is written.
+
+saveModel() writes a model to a file, optionally compressed with gzip, or
+each group to its own file in a directory. modelBytes() returns the file
+as bytes.
+"""
+
+import concurrent.futures
+import gzip
+import heapq
+import io
+import itertools
+import json
+import numpy
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+import opensdraw.lcad_language.parts as parts
+
+# The number of lines that are formatted and written at a time.
+block_size = 65536
+
+# The maximum number of runs that SpillSink merges at a time, so that it
+# does not run out of file handles.
+merge_fan_in = 64
+
+# The gzip compression level, 6 is much faster than the default (9)
+# and the files are only slightly larger.
+gzip_level = 6
+
+
+def formatColumn(values, precision):
+    """
+    Returns a numpy object array with the values formatted as
+    parts.formatNumber() would format them.
+    """
+    [unique, inverse] = numpy.unique(values, return_inverse = True)
+    text = numpy.array([parts.formatNumber(value, precision) for value in unique.tolist()], dtype = object)
+    return text[inverse.reshape(-1)]
+
+
+def formatRows(group, rows, names = None):
+    """
+    Returns the LDraw lines of the parts in rows. If names is None the
+    lines do not include the file names of the parts.
+    """
+    columns = [numpy.array(group.colors, dtype = object)[group.color_codes[rows]]]
+    for i in range(12):
+        columns.append(formatColumn(group.transforms[rows, i], 2 if (i < 3) else 3))
+    if names is not None:
+        columns.append(names[group.id_codes[rows]])
+    return list(map(" ".join, zip(itertools.repeat("1"), *columns)))
+
+
+def groupBlocks(group, group_names, main_name):
+    """
+    Yields the text of the parts, comments and primitives of group in
+    blocks of up to block_size lines. Parts that refer to other groups
+    in the file are given the file name of the group.
+    """
+    if group.sink is not None:
+        for block in group.sink.groupBlocks(group, group_names, main_name):
+            yield block
+        return
+
+    index = group.sortedIndex()
+    n_rows = group.n_rows
+    names = partNames(group, group_names, main_name)
+
+    # Add a step between the parts that have different steps.
+    step_breaks = numpy.zeros(len(index), dtype = bool)
+    if not group.have_comments and (len(index) > 1):
+        steps = numpy.concatenate((group.steps[:n_rows],
+                                   numpy.array([item.step for [order, item] in group.others], dtype = float)))[index]
+        step_breaks[:-1] = (steps[1:] != steps[:-1])
+
+    for start in range(0, len(index), block_size):
+        block = index[start:start + block_size]
+        lines = numpy.empty(len(block), dtype = object)
+
+        is_row = (block < n_rows)
+        rows = block[is_row]
+        if (len(rows) > 0):
+            lines[is_row] = formatRows(group, rows, names)
+
+        for i in numpy.nonzero(~is_row)[0]:
+            lines[i] = group.others[block[i] - n_rows][1].toLDraw()
+
+        breaks = step_breaks[start:start + block_size]
+        lines[breaks] = lines[breaks] + "\n0 STEP"
+        yield "\n".join(lines) + "\n"
+
+
+def partNames(group, group_names, main_name):
+    """
+    Returns a numpy object array with the file name of each part ID of
+    group. Parts that refer to other groups in the file are given the
+    file name of the group.
+    """
+    names = []
+    for part_id in group.part_ids:
+        name = parts.partFilename(part_id)
+        if name in group_names:
+            name = main_name + " - " + name
+        names.append(name)
+    return numpy.array(names, dtype = object)
+
+
+def readRun(filename):
+    """
+    Yields the [step, order, part ID code, text] of each line of a run
+    file (see SpillSink.writeRun()).
+    """
+    with open(filename) as fp:
+        for line in fp:
+            [step, order, code, text] = line[:-1].split(" ", 3)
+            code = int(code)
+            if (code < 0):
+                text = json.loads(text)
+            yield [float(step), int(order), code, text]
+
+
+class SpillSink(object):
+    """
+    Writes the parts of the groups of a model to temporary files (runs) as
+    they are added. The groups give their parts to the sink every block_size
+    parts (see interpreter.Group.spill()). A background thread formats and
+    writes each block, sorted by step, while the model is being built, the
+    runs are merged by step when the model is written.
+
+    Create a new SpillSink for each model, and call close() once the model
+    has been written to remove the temporary files.
+    """
+    def __init__(self, directory = None, block_size = block_size, queue_size = 2):
+        """
+        :param directory: Where to create the temporary directory for the runs (default is the system temporary directory).
+        :type directory: str.
+        :param block_size: The number of parts in each run.
+        :type block_size: int.
+        :param queue_size: The number of blocks that can wait to be written.
+        :type queue_size: int.
+        """
+        self.block_size = block_size
+        self.directory = tempfile.mkdtemp(prefix = "lcad_spill_", dir = directory)
+        self.error = None
+        self.n_runs = 0
+        self.queue = queue.Queue(queue_size)
+        self.runs = {}
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, group, block):
+        """
+        Queue a block of parts (a Group, see interpreter.Group.since())
+        to be written, this waits if the queue is full.
+        """
+        self.checkError()
+        self.queue.put([group.name, block])
+
+    def checkError(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Stop the background thread and remove the temporary files.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def groupBlocks(self, group, group_names, main_name):
+        """
+        Yields the text of the parts, comments and primitives of group in
+        blocks of up to block_size lines, see groupBlocks().
+        """
+        group.spill(force = True)
+        self.queue.join()
+        self.checkError()
+
+        names = partNames(group, group_names, main_name)
+
+        # The runs are in insertion order, but each run is sorted by step.
+        if group.have_comments:
+            runs = [readRun(filename) for filename in self.runs.get(group.name, [])]
+            records = itertools.chain.from_iterable(sorted(run, key = lambda record: record[1]) for run in runs)
+        else:
+            runs = [readRun(filename) for filename in self.mergeRuns(group.name)]
+            records = heapq.merge(*runs)
+
+        lines = []
+        last_step = None
+        for [step, order, code, text] in records:
+            if (last_step is not None) and (step != last_step) and not group.have_comments:
+                lines.append("0 STEP")
+            last_step = step
+
+            if (code >= 0):
+                lines.append(text + " " + names[code])
+            else:
+                lines.append(text)
+
+            if (len(lines) >= self.block_size):
+                yield "\n".join(lines) + "\n"
+                lines = []
+
+        if (len(lines) > 0):
+            yield "\n".join(lines) + "\n"
+
+    def mergeRuns(self, name):
+        """
+        Merge the runs of the group name, merge_fan_in runs at a time,
+        until there are at most merge_fan_in runs. Returns the file
+        names of these runs.
+        """
+        filenames = self.runs.get(name, [])
+        while (len(filenames) > merge_fan_in):
+            merged = []
+            for i in range(0, len(filenames), merge_fan_in):
+                records = heapq.merge(*[readRun(filename) for filename in filenames[i:i + merge_fan_in]])
+                merged.append(self.writeRecords(records))
+                for filename in filenames[i:i + merge_fan_in]:
+                    os.remove(filename)
+            filenames = merged
+            self.runs[name] = filenames
+        return filenames
+
+    def run(self):
+        """
+        Write the blocks in the queue, this is the background thread.
+        """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.writeRun(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def runFilename(self):
+        """
+        Returns the file name for a new run.
+        """
+        filename = os.path.join(self.directory, "run_" + str(self.n_runs))
+        self.n_runs += 1
+        return filename
+
+    def writeRecords(self, records):
+        """
+        Write the [step, order, part ID code, text] records from readRun()
+        to a new run, returns the file name of the run.
+        """
+        filename = self.runFilename()
+        with open(filename, "w") as fp:
+            lines = []
+            for [step, order, code, text] in records:
+                if (code < 0):
+                    text = json.dumps(text)
+                lines.append("{0!r} {1:d} {2:d} {3:s}\n".format(step, order, code, text))
+                if (len(lines) >= block_size):
+                    fp.write("".join(lines))
+                    lines = []
+            fp.write("".join(lines))
+        return filename
+
+    def writeRun(self, name, block):
+        """
+        Write a block of parts sorted by step (then by insertion order).
+        Each line is the step, the insertion order, the part ID code and
+        the LDraw line without the file name of the part. Comments and
+        primitives have a part ID code of -1 and are JSON encoded.
+        """
+        n_rows = block.n_rows
+        orders = numpy.concatenate((block.order[:n_rows],
+                                    numpy.array([order for [order, item] in block.others], dtype = numpy.int64)))
+        steps = numpy.concatenate((block.steps[:n_rows],
+                                   numpy.array([getattr(item, "step", 0) for [order, item] in block.others], dtype = float)))
+        codes = numpy.concatenate((block.id_codes[:n_rows],
+                                   numpy.full(len(block.others), -1, dtype = numpy.int32)))
+        texts = numpy.empty(len(orders), dtype = object)
+        if (n_rows > 0):
+            texts[:n_rows] = formatRows(block, numpy.arange(n_rows))
+        for i in range(len(block.others)):
+            texts[n_rows + i] = json.dumps(block.others[i][1].toLDraw())
+
+        index = numpy.lexsort((orders, steps))
+        filename = self.runFilename()
+        with open(filename, "w") as fp:
+            fp.write("".join(map("{0!r} {1:d} {2:d} {3:s}\n".format,
+                                 steps[index].tolist(),
+                                 orders[index].tolist(),
+                                 codes[index].tolist(),
+                                 texts[index])))
+        if not (name in self.runs):
+            self.runs[name] = []
+        self.runs[name].append(filename)
+
+def groupFilename(main_name, group):
+    """
+    Returns the file name of a group when each group is written to its
+    own file. Parts that refer to the group use this file name.
+    """
+    filename = main_name + " - " + group.name
+    if not any(x in group.name for x in [".dat", ".ldr", ".mpd"]):
+        filename += ".ldr"
+    return filename
+
+
+def modelBytes(model, main_name, source_name = None, compress = False):
+    """
+    Returns the model in LDraw format as bytes (UTF-8), for example for
+    programs that do not want to write the model to a file.
+
+    :param model: The model.
+    :type model: interpreter.Model.
+    :param main_name: The name of the model, this is used to name the groups.
+    :type main_name: str.
+    :param source_name: The name of the lcad file (default is main_name + ".lcad").
+    :type source_name: str.
+    :param compress: Compress the bytes with gzip.
+    :type compress: bool.
+    :returns: bytes.
+    """
+    if source_name is None:
+        source_name = main_name + ".lcad"
+    fp = io.StringIO()
+    writeModel(model, fp, main_name, source_name)
+    data = fp.getvalue().encode("utf-8")
+    if compress:
+        data = gzip.compress(data, compresslevel = gzip_level)
+    return data
+
+
+def openFile(filename, compress):
+    if compress:
+        return gzip.open(filename, "wt", compresslevel = gzip_level)
+    else:
+        return open(filename, "w")
+
+
+def saveModel(model, path, main_name = None, source_name = None, compress = None, split = False, n_threads = 4):
+    """
+    Write the model to the file path in LDraw (.mpd) format. The model is
+    written to a temporary file first so that programs like LDView never
+    read a partially written file.
+
+    If split is True path is a directory, each group is written to its
+    own .ldr file in this directory (see groupFilename()) by a pool of
+    n_threads threads.
+
+    :param model: The model.
+    :type model: interpreter.Model.
+    :param path: The name of the file (or directory if split is True).
+    :type path: str.
+    :param main_name: The name of the model, this is used to name the groups (default is the name of path without the extension).
+    :type main_name: str.
+    :param source_name: The name of the lcad file (default is main_name + ".lcad").
+    :type source_name: str.
+    :param compress: Compress the file(s) with gzip (default is True if path ends with .gz).
+    :type compress: bool.
+    :param split: Write each group to its own file in the directory path.
+    :type split: bool.
+    :param n_threads: The number of threads that write the files of the groups if split is True.
+    :type n_threads: int.
+    """
+    basename = os.path.basename(os.path.normpath(path))
+    if compress is None:
+        compress = basename.endswith(".gz")
+    if basename.endswith(".gz"):
+        basename = basename[:-3]
+    if main_name is None:
+        main_name = os.path.splitext(basename)[0]
+    if source_name is None:
+        source_name = main_name + ".lcad"
+
+    if not split:
+        tmp_fname = path + "." + str(os.getpid())
+        with openFile(tmp_fname, compress) as fp:
+            writeModel(model, fp, main_name, source_name)
+        os.replace(tmp_fname, path)
+        return
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    def saveGroup(group, first):
+        filename = os.path.join(path, groupFilename(main_name, group))
+        if compress:
+            filename += ".gz"
+        tmp_fname = filename + "." + str(os.getpid())
+        with openFile(tmp_fname, compress) as fp:
+            writeGroup(fp, group, model.used_names, main_name, source_name if first else None, False)
+        os.replace(tmp_fname, filename)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = n_threads) as executor:
+        futures = []
+        for [i, group] in enumerate(model.groups()):
+            futures.append(executor.submit(saveGroup, group, (i == 0)))
+        for future in futures:
+            future.result()
+
+
+def writeGroup(fp, group, group_names, main_name, source_name, add_file):
+    """
+    Write a group to the file object fp in LDraw format. The program
+    identifier is only added if source_name is not None, and the FILE
+    line is only added if add_file is True.
+    """
+    text = []
+
+    # Add File name.
+    if add_file:
+        text.append("0 FILE " + main_name + " - " + group.name + "\n")
+
+    # Add header.
+    for header in group.header:
+        text.append("0 " + header + "\n")
+
+    # Add program identifier.
+    if source_name is not None:
+        text.append("0 // Generated by opensdraw from " + source_name + "\n")
+
+    text.append("\n")
+    fp.write("".join(text))
+
+    # Add parts.
+    for block in groupBlocks(group, group_names, main_name):
+        fp.write(block)
+
+    fp.write("\n\n")
+
+
+def writeModel(model, fp, main_name, source_name):
+    """
+    Write model to the file object fp in LDraw format. Each group is
+    a FILE named after main_name, source_name is the lcad file.
+    """
+    for [i, group] in enumerate(model.groups()):
+
+        # Add program identifier (only to the first group).
+        writeGroup(fp, group, model.used_names, main_name, source_name if (i == 0) else None, True)
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2014 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
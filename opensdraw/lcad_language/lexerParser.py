@@ -9,10 +9,22 @@
 # Hazen 07/14
 #
 
+import gc
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
 from functools import wraps
 
 # Lexer.
 from rply import LexerGenerator
+from rply.errors import LexingError
+from rply.grammar import Grammar
+from rply.parser import LRParser
+from rply.parsergenerator import LRTable
+from rply.token import SourcePosition
 
 lg = LexerGenerator()
 
@@ -25,43 +37,94 @@ lg.add('IDENTIFIER', r'[^()\[\]{}\'"\s;]+')
 lg.ignore(r';.*(?=\r|\n|$)')
 lg.ignore(r'\s+')
 
-lexer = lg.build()
+# This is built by getParser(), only the parser needs it.
+lexer = None
 
 
 # Model.
+#
+# The AST of a large model has a very large number of these, so they use
+# __slots__ instead of a __dict__, and the symbol names, strings and file
+# names are interned so that only one copy of each is stored.
+#
 class LCadObject(object):
-    pass
+    __slots__ = ("code", "end_column", "end_line", "filename", "start_column", "start_line", "value")
+
+    def __init__(self, value):
+        # This is set by compiler.compileTree() or vm.compileTree().
+        self.code = None
+        self.value = value
 
 class LCadConstant(LCadObject):
-    pass
+    __slots__ = ()
+
+    # These are only set for expressions.
+    engine = None
+    folded = None
+    vm_body = None
 
 class LCadExpression(LCadObject):
+    __slots__ = ("cached_call", "cached_func", "engine", "folded", "function", "initialized", "lenv", "tail_call", "tail_value", "vm_body")
+    simple_type_name = "Expression"
+
     def __init__(self, expression):
+        LCadObject.__init__(self, expression)
+
+        # These are the inline cache for interpreter.dispatch().
+        self.cached_call = None
+        self.cached_func = None
+
+        # This is set by compiler.compileTree() or vm.compileTree().
+        self.engine = None
+
+        # This is set by folding.foldTree().
+        self.folded = None
+
         self.initialized = False
         self.lenv = None
-        self.simple_type_name = "Expression"
-        self.value = expression
+
+        # These are set by interpreter.markTailCalls().
+        self.tail_call = False
+        self.tail_value = False
+
+        # This is set by vm.functionCode().
+        self.vm_body = None
 
 class LCadFloat(LCadConstant):
+    __slots__ = ()
+    simple_type_name = "Float"
+
     def __init__(self, value):
-        self.simple_type_name = "Float"
-        self.value = float(value)
+        LCadConstant.__init__(self, float(value))
 
 class LCadInteger(LCadConstant):
+    __slots__ = ()
+    simple_type_name = "Integer"
+
     def __init__(self, value):
-        self.simple_type_name = "Integer"
-        self.value = int(value)
+        LCadConstant.__init__(self, int(value))
 
 class LCadString(LCadConstant):
+    __slots__ = ()
+    simple_type_name = "String"
+
     def __init__(self, value):
-        self.simple_type_name = "String"
-        self.value = str(value[1:-1])
+        LCadConstant.__init__(self, sys.intern(str(value[1:-1])))
 
 class LCadSymbol(LCadObject):
+    __slots__ = ("address", "lenv", "shadowed")
+    simple_type_name = "Symbol"
+
+    # These are only set for expressions.
+    engine = None
+    folded = None
+    vm_body = None
+
     def __init__(self, value):
+        LCadObject.__init__(self, sys.intern(str(value)))
+        self.address = None
         self.lenv = None
-        self.simple_type_name = "Symbol"
-        self.value = str(value)
+        self.shadowed = None
 
 
 # Parser.
@@ -85,18 +148,18 @@ def set_boundaries(fun):
         return ret
     return wrapped
 
-pg = ParserGenerator(
-    [rule.name for rule in lexer.rules],
-    cache_id="lcad_parser"
-)
+pg = ParserGenerator([rule.name for rule in lg.rules])
 
 @pg.production('main : list')
 def main(state, p):
     return p[0]
 
-@pg.production('list : term list')
+# Left recursion, so that the parser stack does not grow with the length
+# of the list, and the terms are appended to a single list.
+@pg.production('list : list term')
 def list(state, p):
-    return [p[0]] + p[1]
+    p[0].append(p[1])
+    return p[0]
 
 @pg.production('list : term')
 def single_list(state, p):
@@ -116,19 +179,7 @@ def string(state, p):
 @pg.production("identifier : IDENTIFIER")
 @set_boundaries
 def identifier(state, p):
-    text = p[0].getstr()
-
-    try:
-        return LCadInteger(text)
-    except ValueError:
-        pass
-
-    try:
-        return LCadFloat(text)
-    except ValueError:
-        pass
-
-    return LCadSymbol(text)
+    return atom(p[0].getstr())
 
 @pg.production('parens : LPAREN list RPAREN')
 @set_boundaries
@@ -148,15 +199,383 @@ def error_handler(state, token):
                                                                                                token.source_pos.lineno, 
                                                                                                token.source_pos.colno))
 
-parser = pg.build()
+# The LR tables of the parser are shipped with the package in this file,
+# scripts/make_parser_tables.py creates it again when the grammar changes.
+tables_file = os.path.join(os.path.dirname(__file__), "lcad_parser.json")
+
+def buildGrammar():
+    """
+    Build the rply Grammar of the parser.
+    """
+    grammar = Grammar(pg.tokens)
+    for [prod_name, syms, func, precedence] in pg.productions:
+        grammar.add_production(prod_name, syms, func, precedence)
+    grammar.set_start()
+    grammar.build_lritems()
+    grammar.compute_first()
+    grammar.compute_follow()
+    return grammar
+
+def buildParser():
+    """
+    Build the parser, using the LR tables in tables_file if they are for
+    the current grammar. This is the same as pg.build(), but without
+    rply's cache directory. If the tables are missing or are for a
+    different grammar they are generated again, but not saved.
+    """
+    grammar = buildGrammar()
+
+    table = None
+    try:
+        with open(tables_file) as fp:
+            data = json.load(fp)
+        if pg.data_is_valid(grammar, data):
+            table = LRTable.from_cache(grammar, data)
+    except (IOError, ValueError):
+        pass
+
+    if table is None:
+        table = LRTable.from_grammar(grammar)
+
+    return LRParser(table, pg.error_handler)
+
+def saveTables(filename = tables_file):
+    """
+    Generate the LR tables of the parser and save them in filename.
+    """
+    table = LRTable.from_grammar(buildGrammar())
+    with open(filename, "w") as fp:
+        json.dump(pg.serialize_table(table), fp)
+
+# The rply lexer and parser are only built when use_rply is set, the
+# hand written parser does not need them.
+parser = None
+
+def getParser():
+    """
+    Return the rply lexer and parser, building them the first time
+    that they are used.
+    """
+    global lexer, parser
+    if parser is None:
+        lexer = lg.build()
+        parser = buildParser()
+    return [lexer, parser]
 
 class ParserState(object):
     def __init__(self, filename):
-        self.filename = filename
+        self.filename = sys.intern(filename)
+
+
+# Hand written parser.
+#
+# This uses a single regular expression to find the tokens and builds the
+# AST directly, without rply. It gives the same AST (including the source
+# positions) and the same errors as the rply lexer and parser, which are
+# kept as the reference (see use_rply).
+#
+token_re = re.compile(r"""(?P<ignore>;[^\r\n]*|\s+)|(?P<lparen>\()|(?P<rparen>\))|(?P<string>"[^"]*"|'[^']*')|(?P<identifier>[^()\[\]{}'"\s;]+)""")
+
+# Group numbers in token_re.
+[IGNORE, LPAREN, RPAREN, STRING, IDENTIFIER] = range(1, 6)
+
+use_rply = False
 
-def parse(string, filename = "na"):
-    return parser.parse(lexer.lex(string), 
-                        state = ParserState(filename))
+def atom(text):
+    """
+    Return the LCadInteger, LCadFloat or LCadSymbol for an identifier.
+    """
+    try:
+        return LCadInteger(text)
+    except ValueError:
+        pass
+
+    try:
+        return LCadFloat(text)
+    except ValueError:
+        pass
+
+    return LCadSymbol(text)
+
+def parseFast(string, filename):
+    """
+    Parse the lcad code in string with the hand written parser.
+    """
+    return [form for form in parseForms([string], filename)]
+
+def parseForms(chunks, filename):
+    """
+    Parse the lcad code in the strings in chunks with the hand written
+    parser. This is a generator that yields each top level form as soon
+    as it is complete. A token can be split between chunks.
+    """
+    atom_types = {}
+    filename = sys.intern(filename)
+    n_forms = 0
+    offset = 0
+    terms = None
+    stack = []
+    string = ""
+
+    # The new lines are counted up to the start of each token.
+    counted = 0
+    line = 1
+    line_start = 0
+
+    chunks = iter(chunks)
+    more = True
+    while more:
+        chunk = next(chunks, None)
+        if chunk is None:
+            more = False
+        else:
+            string += chunk
+
+        index = 0
+        for m in token_re.finditer(string):
+            start = m.start()
+            if (start != index):
+                break
+
+            # A token that ends at the end of the chunk may continue in the next chunk.
+            if more and (m.end() == len(string)):
+                break
+            index = m.end()
+            kind = m.lastindex
+            if (kind == IGNORE):
+                continue
+
+            n_lines = string.count("\n", counted, start)
+            if (n_lines > 0):
+                line += n_lines
+                line_start = string.rfind("\n", counted, start) + 1
+            counted = start
+            column = start - line_start + 1
+
+            if (kind == LPAREN):
+                stack.append([terms, line, column])
+                terms = []
+                continue
+
+            elif (kind == RPAREN):
+                if (len(stack) == 0):
+                    raise ValueError("Ran into a RPAREN where it wasn't expected at row {!s} column {!s}".format(line, column))
+                node = LCadExpression(terms)
+                [terms, node.start_line, node.start_column] = stack.pop()
+                node.filename = filename
+                node.end_line = line
+                node.end_column = column
+
+            else:
+                text = m.group()
+                if (kind == STRING):
+                    node = LCadString(text)
+                else:
+                    # Remember the type of each identifier, so that atom() is
+                    # only needed the first time that an identifier is used.
+                    node_type = atom_types.get(text)
+                    if node_type is None:
+                        node = atom(text)
+                        atom_types[text] = type(node)
+                    else:
+                        node = node_type(text)
+                node.filename = filename
+                node.start_line = line
+                node.start_column = column
+                node.end_line = line
+                node.end_column = column + len(text)
+
+            if terms is None:
+                n_forms += 1
+                yield node
+            else:
+                terms.append(node)
+
+        n_lines = string.count("\n", counted, index)
+        if (n_lines > 0):
+            line += n_lines
+            line_start = string.rfind("\n", counted, index) + 1
+        counted = index
+
+        # Characters that are not part of any token.
+        if not more and (index != len(string)):
+            raise LexingError(None, SourcePosition(offset + index, line, index - line_start + 1))
+
+        # Drop the part of string that was parsed, so that string is only
+        # the tokens that may continue in the next chunk.
+        if (index > 0):
+            string = string[index:]
+            counted = 0
+            line_start -= index
+            offset += index
+
+    if (len(stack) > 0) or (n_forms == 0):
+        raise Exception("Unexpected EOF. Empty file? Unbalanced Parenthesis?")
+
+def parseStream(fp, filename, chunk_size = 65536):
+    """
+    Parse the lcad code in the file object fp. This is a generator that
+    yields each top level form as soon as it has been read, so only the
+    current form needs to be in memory.
+    """
+    return parseForms(iter(lambda : fp.read(chunk_size), ""), filename)
+
+def parse(string, filename = "na", cache = False):
+    """
+    Parse the lcad code in string. If cache is True and filename is a
+    file the AST is cached (see cachedParse()).
+    """
+    if cache and use_cache and os.path.isfile(filename):
+        return cachedParse(string, filename)
+    return parseString(string, filename)
+
+def parseString(string, filename):
+
+    # The AST is a large number of small objects, none of which can be freed
+    # while parsing. The garbage collector would examine all of them again
+    # and again, making the time to parse a large file grow faster than the
+    # size of the file.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if use_rply:
+            [rply_lexer, rply_parser] = getParser()
+            return rply_parser.parse(rply_lexer.lex(string),
+                                     state = ParserState(filename))
+        return parseFast(string, filename)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+# Parse cache.
+#
+# The AST of each file is pickled into the cache directory, along with
+# the hash of the code it was parsed from. A cached AST is only used if
+# the hash of the code and the version match.
+#
+# The cache directory is the user's cache directory, this can be changed
+# with the LCAD_CACHE_DIR environment variable. Setting LCAD_CACHE_DIR to
+# an empty string turns off the cache.
+#
+def userCacheDir():
+    """
+    Return the directory for the cache in the user's cache directory.
+    """
+    if (sys.platform == "win32"):
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif (sys.platform == "darwin"):
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "opensdraw", "lcadcache")
+
+cache_dir = os.environ.get("LCAD_CACHE_DIR", userCacheDir())
+
+# Change this when the AST classes or the parser change.
+cache_version = 4
+
+# The first line of each cache file, this is checked before the rest of
+# the file is unpickled.
+cache_header = ("lcadcache " + str(cache_version) + "\n").encode("ascii")
+
+# The classes that a cache file can contain.
+cache_classes = ["LCadExpression", "LCadFloat", "LCadInteger", "LCadString", "LCadSymbol"]
+
+use_cache = (cache_dir != "")
+
+class CacheUnpickler(pickle.Unpickler):
+    """
+    Unpickles cache records, these can only contain the AST classes.
+    """
+    def find_class(self, module, name):
+        if (module == __name__) and (name in cache_classes):
+            return globals()[name]
+        raise pickle.UnpicklingError("'" + module + "." + name + "' is not allowed in the parse cache.")
+
+def cachedParse(string, filename):
+    """
+    Return the AST for string from the cache, or parse it and add it
+    to the cache.
+    """
+    code_hash = hashlib.sha1(string.encode("utf-8")).hexdigest()
+    record = loadCache(filename)
+    if (record is not None) and (record["hash"] == code_hash):
+        return record["ast"]
+
+    ast = parseString(string, filename)
+    saveCache(filename, {"ast" : ast,
+                         "filename" : filename,
+                         "hash" : code_hash,
+                         "version" : cache_version})
+    return ast
+
+def cachePath(filename):
+    """
+    Return the path of the cache file for filename, the name of the
+    cache file is the hash of the absolute path of filename.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, path_hash + ".pickle")
+
+def isValidRecord(record, filename):
+    """
+    Returns True if record is a cache record for filename.
+    """
+    if not isinstance(record, dict) or (record.get("version") != cache_version):
+        return False
+
+    # The AST records the filename that was used to parse it.
+    if (record.get("filename") != filename):
+        return False
+    if not isinstance(record.get("hash"), str):
+        return False
+
+    # list is one of the parser rules in this module.
+    if not isinstance(record.get("ast"), type([])):
+        return False
+    for node in record["ast"]:
+        if not isinstance(node, LCadObject):
+            return False
+    return True
+
+def loadCache(filename):
+    """
+    Return the cache record for filename, or None if there is no
+    valid record.
+    """
+    try:
+        with open(cachePath(filename), "rb") as fp:
+            if (fp.readline() != cache_header):
+                return None
+            record = CacheUnpickler(fp).load()
+    except Exception:
+        return None
+    if not isValidRecord(record, filename):
+        return None
+    return record
+
+def saveCache(filename, record):
+    """
+    Save the cache record for filename. This is written to a temporary
+    file first so that other processes never see a partial record. Errors,
+    such as a directory that is not writeable or an AST that is too deep
+    to pickle, mean that the AST is just not cached.
+    """
+    path = cachePath(filename)
+    tmp_path = path + "." + str(os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, "wb") as fp:
+            fp.write(cache_header)
+            pickle.dump(record, fp, pickle.HIGHEST_PROTOCOL)
+        getattr(os, "replace", os.rename)(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
 # For testing purposes.
 if (__name__ == '__main__'):
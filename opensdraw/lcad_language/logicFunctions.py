@@ -20,7 +20,7 @@ class LogicFunction(interp.LCadFunction):
     """
     Logic functions, and, or, not
     """
-    pass
+    pure = True
 
 class And(interp.SpecialFunction):
     """
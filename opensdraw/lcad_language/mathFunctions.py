@@ -23,14 +23,14 @@ class MathFunction(interp.LCadFunction):
     """
     Math functions.
     """
-    pass
+    pure = True
 
 
 class Absolute(MathFunction):
     """
     **abs**
 
-    Return the absolute value of a number.
+    Return the absolute value of a number (or of each element of an array).
 
     Usage::
 
@@ -40,7 +40,7 @@ class Absolute(MathFunction):
     """
     def __init__(self, name):
         MathFunction.__init__(self, name)
-        self.setSignature([[numbers.Number]]),
+        self.setSignature([[numbers.Number, lcadTypes.LCadArray]]),
 
     def call(self, model, val):
         return abs(val)
@@ -79,7 +79,8 @@ class Minus(MathFunction):
     **-** 
 
     Subtract one or more numbers, vectors or matrices from the first 
-    number, vector or matrix.
+    number, vector or matrix. Arrays are subtracted pointwise, and numbers
+    are subtracted from each element of an array.
 
     Usage::
 
@@ -97,12 +98,11 @@ class Minus(MathFunction):
             return -total
         else:
 
-            # If this a numpy array, make a copy to avoid destroying the original.
-            if isinstance(total, numpy.ndarray):
-                total = total.copy()
-
+            # This makes a new numpy array, so the original is not changed, with
+            # the type of the result (i.e. an integer array minus a float is a
+            # float array).
             for val in vals:
-                total -= val
+                total = total - val
             return total
 
 lcad_functions["-"] = Minus("-")
@@ -116,12 +116,13 @@ class Modulo(MathFunction):
 
     Usage::
 
-     (% 10 2) ; 0
+     (% 10 2)          ; 0
+     (% (arange 5) 2)  ; 0, 1, 0, 1, 0
 
     """
     def __init__(self, name):
         MathFunction.__init__(self, name)
-        self.setSignature([[numbers.Number], [numbers.Number]])
+        self.setSignature([[numbers.Number, lcadTypes.LCadArray], [numbers.Number, lcadTypes.LCadArray]])
 
     def call(self, model, val1, val2):
         return val1 % val2
@@ -169,11 +170,13 @@ class Plus(MathFunction):
     """
     **+** 
 
-    Add together two or more numbers, vectors or matrices.
+    Add together two or more numbers, vectors or matrices. Arrays are
+    added pointwise, and numbers are added to each element of an array.
 
     Usage::
 
      (+ 10 20 y) ; 30 + y
+     (+ (arange 3) 1) ; 1, 2, 3
 
     """
     def __init__(self, name):
@@ -185,7 +188,7 @@ class Plus(MathFunction):
     def call(self, model, *vals):
         total = 0
         for val in vals:
-            total += val
+            total = total + val
         return total
 
 lcad_functions["+"] = Plus("+")
@@ -193,16 +196,39 @@ lcad_functions["+"] = Plus("+")
 
 # "Advanced" math functions.
 
+# The numpy functions for the functions in Python's math module whose name is different.
+numpy_names = {"acos" : "arccos",
+               "acosh" : "arccosh",
+               "asin" : "arcsin",
+               "asinh" : "arcsinh",
+               "atan" : "arctan",
+               "atan2" : "arctan2",
+               "atanh" : "arctanh",
+               "pow" : "power"}
+
 class AdvMathFunction(MathFunction):
     """
-    The functions in Python's math module.
+    The functions in Python's math module. If any of the arguments is an
+    array the function is applied to each element, using the numpy version
+    of the function if there is one.
     """
     def __init__(self, name, py_func):
         MathFunction.__init__(self, name)
         self.py_func = py_func
-        self.setSignature([[numbers.Number], ["optional", [numbers.Number]]])
+        self.setSignature([[numbers.Number, lcadTypes.LCadArray], ["optional", [numbers.Number, lcadTypes.LCadArray]]])
+
+        self.np_func = getattr(numpy, numpy_names.get(name, name), None)
+        if not isinstance(self.np_func, numpy.ufunc):
+            self.np_func = None
 
     def call(self, model, *vals):
+        for val in vals:
+            if isinstance(val, numpy.ndarray):
+                if (self.np_func is not None) and (self.np_func.nin == len(vals)):
+                    result = self.np_func(*vals)
+                else:
+                    result = numpy.vectorize(self.py_func)(*vals)
+                return numpy.asarray(result).view(lcadTypes.LCadArray)
         return self.py_func(*vals)
 
 for name in dir(math):
@@ -255,7 +255,7 @@ class Part(PartFunction):
         else:
             part_step = step_offset
         group = model.curGroup()
-        group.addPart(parts.Part(group.matrix(), args[0], args[1], part_step), False)
+        group.addLDrawPart(group.matrix(), args[0], parts.toColor(args[1]), part_step)
         return None
 
 lcad_functions["part"] = Part()
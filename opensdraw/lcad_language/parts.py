@@ -6,17 +6,14 @@
 .. moduleauthor:: Hazen Babcock
 """
 
+import copy
 import numpy
 
 import opensdraw.lcad_lib.colorsParser as colorsParser
 
-# Load colors and create dictionaries.
-all_colors = colorsParser.loadColorGroups()
-
-lcad_name_dict = {}
-for color_group in all_colors:
-    for color in color_group:
-        lcad_name_dict[color.name.lower()] = color
+# The colors by (lower case) name, these are loaded the first
+# time that a color is specified by name (see toColor()).
+lcad_name_dict = None
 
 def formatNumber(a_number, precision):
     f_string = "{0:." + str(precision) + "f}"
@@ -30,7 +27,35 @@ def formatNumber(a_number, precision):
         s = "0"
     return s
 
+def fromRow(row):
+    """
+    Returns the 4x4 transform matrix of a row of a columnar
+    parts store (see interpreter.Group).
+    """
+    matrix = numpy.identity(4)
+    matrix[:3,3] = row[:3]
+    matrix[:3,:3] = row[3:].reshape(3,3)
+    return matrix
+
+def toRow(matrix):
+    """
+    Returns the transform matrix as a row of a columnar parts store. This
+    has the 12 numbers in the order of an LDraw line (x y z a b c d e f g h i).
+    """
+    return numpy.concatenate((matrix[:3,3], matrix[:3,:3].ravel()))
+
+def partFilename(part_id):
+    """
+    Returns the file name of a part in an LDraw line.
+    """
+    #if not (".dat" in part_id) and not (".ldr" in part_id):
+    if not any(x in part_id for x in [".dat", ".ldr", ".mpd"]):
+        return part_id + ".dat"
+    else:
+        return part_id
+
 def toColor(color):
+    global lcad_name_dict
 
     # Integer color.
     if isinstance(color, int):
@@ -42,6 +67,11 @@ def toColor(color):
 
     # Look up the color based on the name.
     else:
+        if lcad_name_dict is None:
+            lcad_name_dict = {}
+            for color_group in colorsParser.loadColorGroups():
+                for color_obj in color_group:
+                    lcad_name_dict[color_obj.name.lower()] = color_obj
         return lcad_name_dict[color.lower()].code
 
 
@@ -68,6 +98,21 @@ class Part(object):
         #self.loc = numpy.array([0.0, 0.0, 0.0, 1.0])
         #self.loc = numpy.dot(self.model_matrix, self.loc)
 
+    @staticmethod
+    def fromColumns(row, part_id, ldraw_color, step):
+        """
+        Return a Part from the columns of a columnar parts store,
+        ldraw_color has already been converted with toColor().
+
+        :returns: Part.
+        """
+        part = Part.__new__(Part)
+        part.matrix = fromRow(row)
+        part.part_color = ldraw_color
+        part.part_id = part_id
+        part.step = step
+        return part
+
     def toLDraw(self):
         """
         Return a string in ldraw format.
@@ -90,14 +135,22 @@ class Part(object):
                 ld_str += formatNumber(self.matrix[i,j], 3) + " "
 
         # part
-        #if not (".dat" in self.part_id) and not (".ldr" in self.part_id):
-        if not any(x in self.part_id for x in [".dat", ".ldr", ".mpd"]):
-            ld_str += self.part_id + ".dat"
-        else:
-            ld_str += self.part_id
+        ld_str += partFilename(self.part_id)
 
         return ld_str
 
+    def transform(self, matrix, step_offset):
+        """
+        Return a copy of this part that is transformed by matrix
+        and whose step is offset by step_offset.
+
+        :returns: Part.
+        """
+        part = copy.copy(self)
+        part.matrix = numpy.dot(matrix, self.matrix)
+        part.step = self.step + step_offset
+        return part
+
 
 # LDraw primitives.
 class LDraw(object):
@@ -109,15 +162,30 @@ class LDraw(object):
 
         # Transform coordinates using transformation matrix.
         if matrix is not None:
-            for i in range(int(len(coords)/3)):
-                vec = numpy.array([self.coords[3*i],
-                                   self.coords[3*i+1],
-                                   self.coords[3*i+2],
-                                   1.0])
-                loc = numpy.dot(matrix, vec)
-                self.coords[3*i] = loc[0]
-                self.coords[3*i+1] = loc[1]
-                self.coords[3*i+2] = loc[2]
+            self.transformCoords(matrix)
+
+    def transform(self, matrix, step_offset):
+        """
+        Return a copy of this primitive that is transformed by matrix.
+        Primitives do not have a step so step_offset is ignored.
+
+        :returns: LDraw.
+        """
+        primitive = copy.copy(self)
+        primitive.coords = list(self.coords)
+        primitive.transformCoords(matrix)
+        return primitive
+
+    def transformCoords(self, matrix):
+        for i in range(int(len(self.coords)/3)):
+            vec = numpy.array([self.coords[3*i],
+                               self.coords[3*i+1],
+                               self.coords[3*i+2],
+                               1.0])
+            loc = numpy.dot(matrix, vec)
+            self.coords[3*i] = loc[0]
+            self.coords[3*i+1] = loc[1]
+            self.coords[3*i+2] = loc[2]
 
     def toLDraw(self):
         ld_str = self.prefix + self.color + " "
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+.. module:: profiler
+   :synopsis: Records where the time goes when running lcad code.
+
+.. moduleauthor:: Hazen Babcock
+
+A Profiler is passed to interpreter.execute(). While the code runs it
+replaces interpreter.dispatch() with a version that times each function
+call, so there is no cost when the code is not being profiled. For each
+function and for each source line with a function call it records the
+number of calls, the inclusive time (including the functions that it
+called) and the exclusive time. It also records the exclusive time of
+each call stack, which can be written in the collapsed stack format
+used by flamegraph tools.
+
+Profiling only works with the interpreted engine, and tail calls are
+made as normal calls so that the call stacks are complete. Expressions
+that are nested too deeply for the interpreter are run on the virtual
+machine (see vm.compileDeep()), the time spent running their bytecode
+is recorded as a function called "(vm)".
+
+"""
+
+import time
+
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.vm as vm
+
+# The name of the time spent in the virtual machine.
+vm_name = "(vm)"
+
+
+class Stats(object):
+    """
+    The call count and times for a function or a line.
+    """
+    def __init__(self):
+        self.active = 0
+        self.count = 0
+        self.exclusive = 0.0
+        self.inclusive = 0.0
+
+
+class Profiler(object):
+    """
+    Collects the profile of one or more runs of interpreter.execute().
+    """
+    def __init__(self):
+        self.functions = {}
+        self.lines = {}
+        self.saved = None
+
+        # [name, stack, child time] for the calls that are in progress.
+        self.calls = []
+
+        # Exclusive time of each call stack.
+        self.stacks = {}
+
+    def collapsedStacks(self):
+        """
+        Return the call stacks in the collapsed stack format, one stack
+        per line followed by the exclusive time in microseconds.
+        """
+        lines = []
+        for stack in sorted(self.stacks):
+            lines.append(stack + " " + str(int(round(1.0e6 * self.stacks[stack]))))
+        return "\n".join(lines) + "\n"
+
+    def dispatch(self, func, model, tree):
+        """
+        Replaces interpreter.dispatch() while profiling.
+        """
+        return self.timeCall(functionName(func), (tree.filename, tree.start_line), self.saved[0], func, model, tree)
+
+    def report(self, n = 20):
+        """
+        Return a table of the n functions and the n lines with the
+        most exclusive time.
+        """
+        lines = []
+        tables = [["function", self.functions, lambda key: key],
+                  ["line", self.lines, lambda key: key[0] + ":" + str(key[1])]]
+        for [title, table, toString] in tables:
+            lines.append("{0:>10s} {1:>12s} {2:>12s}  {3:s}".format("calls", "inclusive", "exclusive", title))
+            keys = sorted(table, key = lambda key: table[key].exclusive, reverse = True)
+            for key in keys[:n]:
+                stats = table[key]
+                lines.append("{0:10d} {1:12.6f} {2:12.6f}  {3:s}".format(stats.count, stats.inclusive, stats.exclusive, toString(key)))
+            lines.append("")
+        return "\n".join(lines)
+
+    def run(self, model, ops):
+        """
+        Replaces vm.run() while profiling.
+        """
+        return self.timeCall(vm_name, None, self.saved[2], model, ops)
+
+    def start(self):
+        """
+        Start profiling, this is called by interpreter.execute().
+        """
+        self.saved = [interp.dispatch, interp.tailCall, vm.run]
+        interp.dispatch = self.dispatch
+        interp.tailCall = self.tailCall
+        vm.run = self.run
+
+    def stop(self):
+        """
+        Stop profiling, this is called by interpreter.execute().
+        """
+        [interp.dispatch, interp.tailCall, vm.run] = self.saved
+        self.saved = None
+        self.calls = []
+
+    def tailCall(self, func, model, tree):
+        """
+        Replaces interpreter.tailCall() while profiling.
+        """
+        return self.dispatch(func, model, tree)
+
+    def timeCall(self, name, line, func, *args):
+        """
+        Call func with args, recording the time as a call of the function
+        name from line. line is (filename, line number), or None if the
+        call is not from a line.
+        """
+        if (len(self.calls) > 0):
+            stack = self.calls[-1][1] + ";" + name
+        else:
+            stack = name
+        call = [name, stack, 0.0]
+        self.calls.append(call)
+
+        all_stats = [self.functions.setdefault(name, Stats())]
+        if line is not None:
+            all_stats.append(self.lines.setdefault(line, Stats()))
+        for stats in all_stats:
+            stats.active += 1
+
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            exclusive = elapsed - call[2]
+            self.calls.pop()
+            if (len(self.calls) > 0):
+                self.calls[-1][2] += elapsed
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + exclusive
+
+            # Recursive calls only add to the inclusive time of the outermost call.
+            for stats in all_stats:
+                stats.active -= 1
+                stats.count += 1
+                stats.exclusive += exclusive
+                if (stats.active == 0):
+                    stats.inclusive += elapsed
+
+    def writeCollapsed(self, filename):
+        """
+        Write the call stacks in the collapsed stack format to filename.
+        """
+        with open(filename, "w") as fp:
+            fp.write(self.collapsedStacks())
+
+
+def functionName(func):
+    """
+    Return the name to use for func. User functions also include
+    where they were defined as different functions can have the same name.
+    """
+    if isinstance(func, interp.UserFunction):
+        return func.name + " (" + func.filename + ":" + str(func.start_line) + ")"
+    if isinstance(func, interp.LCadFunction):
+        return func.name
+    return str(func)
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
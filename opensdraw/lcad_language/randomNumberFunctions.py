@@ -16,7 +16,7 @@ import opensdraw.lcad_language.lcadExceptions as lce
 lcad_functions = {}
 
 class RandomNumberFunction(interp.LCadFunction):
-    pass
+    volatile = True
 
 
 class RandSeed(RandomNumberFunction):
@@ -21,6 +21,9 @@ except NameError:
 lcad_functions = {}
 
 
+def isArray(obj):
+    return isinstance(obj, lcadTypes.LCadArray)
+
 def isBoolean(obj):
     return isinstance(obj, lcadTypes.LCadBoolean)
 
@@ -38,10 +41,31 @@ def isVector(obj):
 
 
 class TypeFunction(interp.LCadFunction):
+    pure = True
+
     def __init__(self, name):
         interp.LCadFunction.__init__(self, name)
         self.setSignature([[object]])
 
+
+
+class IsArray(TypeFunction):
+    """
+    **array?** - Returns t/nil if argument is an array.
+
+    Usage::
+
+     (array? (arange 5))       ; t
+     (array? (vector 0 0 0))   ; nil
+    """
+    def call(self, model, obj):
+        if isArray(obj):
+            return interp.lcad_t
+        else:
+            return interp.lcad_nil
+
+lcad_functions["array?"] = IsArray("array?")
+
         
 class IsBoolean(TypeFunction):
     """
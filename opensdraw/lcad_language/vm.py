@@ -0,0 +1,889 @@
+#!/usr/bin/env python
+"""
+.. module:: vm
+   :synopsis: Compiles the lcad AST into bytecode and runs it on a stack based virtual machine.
+
+.. moduleauthor:: Hazen Babcock
+
+The bytecode is a list of (opcode, argument) tuples. The virtual machine
+keeps values, the function calls that are in progress and the return
+addresses in lists instead of on the Python stack, so nested expressions,
+block, cond, for, if, while and calls to user defined functions do not
+use Python recursion.
+
+Other special functions (translate, group, import, etc.) are called as
+usual and evaluate their arguments with interpreter.interpret(). To
+handle this each expression has a code attribute that runs the bytecode
+for the expression on a new virtual machine.
+
+The bytecode is also compiled without recursion (see build()), so the
+depth of the AST is not limited by the Python recursion limit.
+
+"""
+
+import opensdraw.lcad_language.folding as folding
+import opensdraw.lcad_language.interpreter as interp
+import opensdraw.lcad_language.lcadExceptions as lce
+import opensdraw.lcad_language.lcadTypes as lcadTypes
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+
+#
+# Opcodes.
+#
+# Symbols are pushed as Symbols unless the opcode says that it pushes the
+# value, the same as interpreter.interpret().
+#
+ARG = 0            # Check the type of argument number arg of the current call.
+CALL = 1           # Get (or pop) the function and start a call.
+CONST = 2          # Push arg.
+DEF_CHECK = 3      # Check that the symbol (tree, key) of def has not already been set.
+DEF_DONE = 4       # Mark the def expression arg as initialized.
+DEF_STORE = 5      # Set the symbol at address arg to the top of the stack.
+EXIT = 6           # End a special function.
+FOLDED = 7         # Push the value of the folded expression (folded, end) and jump to end if it is valid.
+FOR_INIT = 8       # Pop the loop arguments and push the loop state.
+FOR_NEXT = 9       # Set the loop variable to the next value or jump to arg.
+FRAME_SLOT = 10    # Push the Symbol at address (depth, slot) arg.
+HALT = 11          # Stop and return the top of the stack.
+INVOKE = 12        # Call the function with the arguments on the stack, arg is (n_args, value, tail).
+JUMP = 13          # Jump to arg.
+LOOKUP = 14        # Push the Symbol for the LCadSymbol arg (imported symbols, etc.).
+NOT_A_FUNCTION = 15 # Raise NotAFunctionException.
+POP = 16           # Pop.
+RETURN = 17        # Return from a user function.
+SET_CHECK = 18     # Check that the top of the stack can be set.
+SET_STORE = 19     # Pop the value and the Symbol, set the Symbol and push the value.
+SLOT = 20          # Push the Symbol in slot arg of the current frame.
+SLOT_VALUE = 21    # Push the value of the Symbol in slot arg of the current frame.
+SPECIAL = 22       # Start a special function that is compiled into bytecode.
+SYMBOL = 23        # Push the Symbol arg.
+SYMBOL_VALUE = 24  # Push the value of the Symbol arg.
+TEST = 25          # Pop, jump to arg if nil, error if not t or nil.
+VALUE = 26         # Replace the top of the stack with its value.
+
+opnames = ["ARG", "CALL", "CONST", "DEF_CHECK", "DEF_DONE", "DEF_STORE", "EXIT",
+           "FOLDED", "FOR_INIT", "FOR_NEXT", "FRAME_SLOT", "HALT", "INVOKE", "JUMP", "LOOKUP",
+           "NOT_A_FUNCTION", "POP", "RETURN", "SET_CHECK", "SET_STORE", "SLOT",
+           "SLOT_VALUE", "SPECIAL", "SYMBOL", "SYMBOL_VALUE", "TEST", "VALUE"]
+
+# The interpreted and compiled engines run expressions that contain
+# expressions nested more deeply than this on the virtual machine
+# (see compileDeep()).
+max_depth = 50
+
+
+def argSpec(tree):
+    """
+    Return how to get the value of a function argument without running
+    any bytecode, or None if this is not possible.
+    """
+    if isinstance(tree, lexerParser.LCadConstant):
+        return [CONST, tree.value]
+    if isinstance(tree, lexerParser.LCadSymbol) and (tree.shadowed is None):
+        if isinstance(tree.address, interp.Symbol):
+            return [SYMBOL_VALUE, tree.address]
+        if (tree.address is not None) and (tree.address[0] == 0):
+            return [SLOT_VALUE, tree.address[1]]
+    return None
+
+
+def build(code):
+    """
+    Run one of the compile functions and return its result. The compile
+    functions are generators that yield the generator for each node that
+    they contain instead of calling it, so this builds the bytecode for
+    an AST of any depth with a list of generators instead of recursion.
+    The result of each generator is sent to the generator that yielded it.
+    """
+    generators = [code]
+    result = None
+    while (len(generators) > 0):
+        try:
+            code = generators[-1].send(result)
+        except StopIteration as e:
+            generators.pop()
+            result = e.value
+            continue
+        generators.append(code)
+        result = None
+    return result
+
+
+def checkArg(func, index, val):
+    """
+    Check the type of argument index of func, this matches getArgs().
+    """
+    if (index < func.minimum_args):
+        plan = func.standard_types[index]
+    else:
+        plan = func.optional_types[min(index - func.minimum_args, len(func.optional_types) - 1)]
+    if (plan is None) or isinstance(val, plan[0]):
+        return
+    if (plan[1] is not None) and isinstance(val, plan[1]):
+        return
+
+    if (index < func.minimum_args):
+        types = func.signature[index]
+    else:
+        types = func.signature[min(index, len(func.signature) - 1)][1]
+    raise lce.WrongTypeException(", ".join(map(interp.typeToString, types)), type(val))
+
+
+def compileBlock(tree, ops, value):
+    """
+    (block ..)
+    """
+    flist = tree.value
+    special = startSpecial(ops)
+    if (len(flist) == 1):
+        ops.append((CONST, interp.lcad_nil))
+    for i in range(1, len(flist)):
+        if (i > 1):
+            ops.append((POP, None))
+        yield compileNode(flist[i], ops, True)
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileCall(tree, ops, value):
+    """
+    Function calls. The arguments are evaluated by the virtual machine for
+    functions that only have standard and optional arguments. Functions
+    with keyword arguments evaluate their arguments with getArgs().
+    """
+    flist = tree.value
+
+    # A function that is a symbol is looked up by CALL.
+    head = argSpec(flist[0])
+    if head is None:
+        yield compileNode(flist[0], ops, True)
+
+    # Arguments that are constants or symbols are evaluated by CALL.
+    specs = list(map(argSpec, flist[1:]))
+    if (None in specs):
+        specs = None
+
+    call = len(ops)
+    ops.append(None)
+    if specs is None:
+        for i in range(1, len(flist)):
+            yield compileNode(flist[i], ops, True)
+            ops.append((ARG, i - 1))
+    ops.append((INVOKE, (len(flist) - 1, value, None)))
+    ops[call] = (CALL, (tree, len(flist) - 1, len(ops), value, specs, head))
+
+
+def compileCond(tree, ops, value):
+    """
+    (cond (test ..) ..)
+    """
+    flist = tree.value
+    if (len(flist) < 2):
+        return False
+    for clause in flist[1:]:
+        if not isinstance(clause, lexerParser.LCadExpression) or (len(clause.value) == 0):
+            return False
+
+    special = startSpecial(ops)
+    jumps = []
+    for clause in flist[1:]:
+        nodes = clause.value
+        yield compileNode(nodes[0], ops, True)
+        test = len(ops)
+        ops.append(None)
+        if (len(nodes) == 1):
+            ops.append((CONST, interp.lcad_nil))
+        for i in range(1, len(nodes)):
+            if (i > 1):
+                ops.append((POP, None))
+            yield compileNode(nodes[i], ops, False)
+        jumps.append(len(ops))
+        ops.append(None)
+        ops[test] = (TEST, len(ops))
+    ops.append((CONST, interp.lcad_nil))
+    for jump in jumps:
+        ops[jump] = (JUMP, len(ops))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileDeep(tree):
+    """
+    Walks the AST compiling the expressions that contain expressions
+    nested more than max_depth deep, so that these are evaluated without
+    recursion. The interpreted and compiled engines evaluate each nested
+    expression with a Python call, so they call this before they compile
+    the rest of the AST. This must be called after
+    interpreter.createLexicalEnv().
+    """
+    # Find the height of each expression, the expressions are found
+    # before the expressions that they contain.
+    expressions = []
+    nodes = [tree]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, lexerParser.LCadExpression):
+            expressions.append(node)
+            nodes.extend(node.value)
+
+    heights = {}
+    for expression in reversed(expressions):
+        height = 0
+        nodes = list(expression.value)
+        while (len(nodes) > 0):
+            node = nodes.pop()
+            if isinstance(node, list):
+                nodes.extend(node)
+            elif isinstance(node, lexerParser.LCadExpression):
+                height = max(height, heights[id(node)])
+        heights[id(expression)] = height + 1
+
+    # Compile the outermost expressions that are too deep.
+    nodes = [tree]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, lexerParser.LCadExpression):
+            if (heights[id(node)] > max_depth):
+                compileTree(node)
+            else:
+                nodes.extend(node.value)
+
+
+def compileDef(tree, ops, value):
+    """
+    (def x 1 ..), functions are created by createLexicalEnv() so function
+    definitions are left to Def.
+    """
+    flist = tree.value
+    if (len(flist) < 3) or ((len(flist)%2) != 1):
+        return False
+    for key in flist[1::2]:
+        if not isinstance(key, lexerParser.LCadSymbol) or (key.address is None):
+            return False
+
+    special = startSpecial(ops)
+    for i in range(1, len(flist), 2):
+        if (i > 1):
+            ops.append((POP, None))
+        ops.append((DEF_CHECK, (tree, flist[i])))
+        yield compileNode(flist[i+1], ops, True)
+        ops.append((DEF_STORE, flist[i].address))
+    ops.append((DEF_DONE, tree))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileExpression(tree, ops, value):
+    """
+    Expressions are either one of the special functions in special_forms,
+    or a function call.
+    """
+    flist = tree.value
+
+    # Empty list is false.
+    if (len(flist) == 0):
+        ops.append((CONST, interp.lcad_nil))
+        return
+
+    head = flist[0]
+    if not (isinstance(head, lexerParser.LCadExpression) or isinstance(head, lexerParser.LCadSymbol)):
+        ops.append((NOT_A_FUNCTION, head.value))
+        return
+
+    # Expressions that were folded into a constant (see folding.py) still
+    # need the bytecode for the call in case the folded value is not valid.
+    if tree.folded is not None:
+        folded = len(ops)
+        ops.append(None)
+        yield compileCall(tree, ops, value)
+        ops[folded] = (FOLDED, (tree.folded, len(ops)))
+        return
+
+    if isinstance(head, lexerParser.LCadSymbol) and isinstance(head.address, interp.Symbol) and (head.shadowed is None):
+        name = head.address.name
+        if (name in special_forms) and (head.address.value is interp.builtin_functions.get(name)):
+            if (yield special_forms[name](tree, ops, value)):
+                return
+
+    yield compileCall(tree, ops, value)
+
+
+def compileFor(tree, ops, value):
+    """
+    (for (i ..) ..)
+    """
+    flist = tree.value
+    if (len(flist) < 3) or not isinstance(flist[1], lexerParser.LCadExpression):
+        return False
+    loop_args = flist[1].value
+    if (len(loop_args) < 2) or (len(loop_args) > 4):
+        return False
+    if not isinstance(loop_args[0], lexerParser.LCadSymbol) or (loop_args[0].address is None):
+        return False
+
+    special = startSpecial(ops)
+
+    # This matches For, the first argument is evaluated twice when there
+    # is more than one argument.
+    yield compileNode(loop_args[1], ops, True)
+    if (len(loop_args) > 2):
+        for node in loop_args[1:]:
+            yield compileNode(node, ops, True)
+    ops.append((FOR_INIT, (len(loop_args), loop_args[0].address)))
+    ops.append((CONST, None))
+
+    start = len(ops)
+    ops.append(None)
+    for i in range(2, len(flist)):
+        ops.append((POP, None))
+        yield compileNode(flist[i], ops, False)
+    ops.append((JUMP, start))
+    ops[start] = (FOR_NEXT, len(ops))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileIf(tree, ops, value):
+    """
+    (if test a b)
+    """
+    flist = tree.value
+    if (len(flist) != 3) and (len(flist) != 4):
+        return False
+
+    special = startSpecial(ops)
+    yield compileNode(flist[1], ops, True)
+    test = len(ops)
+    ops.append(None)
+    yield compileNode(flist[2], ops, False)
+    jump = len(ops)
+    ops.append(None)
+    ops[test] = (TEST, len(ops))
+    if (len(flist) == 4):
+        yield compileNode(flist[3], ops, False)
+    else:
+        ops.append((CONST, interp.lcad_nil))
+    ops[jump] = (JUMP, len(ops))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileNode(tree, ops, value):
+    """
+    Append the bytecode for tree to ops. If value is True the bytecode
+    leaves the value of tree on the stack, otherwise it leaves what
+    interpreter.interpret() would return, which can be a Symbol.
+
+    This and the other compile functions are run with build().
+    """
+    if isinstance(tree, lexerParser.LCadExpression):
+        yield compileExpression(tree, ops, value)
+
+    elif isinstance(tree, lexerParser.LCadSymbol):
+        compileSymbol(tree, ops, value)
+
+    elif isinstance(tree, lexerParser.LCadConstant):
+        ops.append((CONST, tree.value))
+
+
+def compileSet(tree, ops, value):
+    """
+    (set x 1 ..)
+    """
+    flist = tree.value
+    if (len(flist) < 3) or ((len(flist)%2) != 1):
+        return False
+
+    special = startSpecial(ops)
+    for i in range(1, len(flist), 2):
+        if (i > 1):
+            ops.append((POP, None))
+        yield compileNode(flist[i], ops, False)
+        ops.append((SET_CHECK, None))
+        yield compileNode(flist[i+1], ops, True)
+        ops.append((SET_STORE, None))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def compileSymbol(tree, ops, value):
+    """
+    Symbols are specialized on their address.
+    """
+    address = tree.address
+    if (tree.shadowed is not None) or (address is None):
+        ops.append((LOOKUP, tree))
+        if value:
+            ops.append((VALUE, None))
+
+    elif isinstance(address, interp.Symbol):
+        ops.append((SYMBOL_VALUE if value else SYMBOL, address))
+
+    elif (address[0] == 0):
+        ops.append((SLOT_VALUE if value else SLOT, address[1]))
+
+    else:
+        ops.append((FRAME_SLOT, address))
+        if value:
+            ops.append((VALUE, None))
+
+
+def compileTree(tree):
+    """
+    Walks the AST setting the code of each expression to a function that
+    runs the bytecode for the expression. The bytecode is compiled the
+    first time it is needed. This must be called after
+    interpreter.createLexicalEnv().
+    """
+    nodes = [tree]
+    while (len(nodes) > 0):
+        tree = nodes.pop()
+        if isinstance(tree, list):
+            nodes.extend(tree)
+
+        elif isinstance(tree, lexerParser.LCadExpression):
+            nodes.extend(tree.value)
+            tree.code = entryCode(tree)
+            if tree.folded is not None:
+                tree.code = folding.foldedCode(tree, tree.code)
+            tree.engine = "vm"
+
+
+def compileWhile(tree, ops, value):
+    """
+    (while test ..)
+    """
+    flist = tree.value
+    if (len(flist) < 3):
+        return False
+
+    special = startSpecial(ops)
+    ops.append((CONST, None))
+    start = len(ops)
+    yield compileNode(flist[1], ops, True)
+    test = len(ops)
+    ops.append(None)
+    for i in range(2, len(flist)):
+        ops.append((POP, None))
+        yield compileNode(flist[i], ops, False)
+    ops.append((JUMP, start))
+    ops[test] = (TEST, len(ops))
+    endSpecial(tree, ops, special, value)
+    return True
+
+
+def disassemble(ops):
+    """
+    Return ops as a string, for debugging.
+    """
+    lines = []
+    for i, [op, arg] in enumerate(ops):
+        lines.append("{0:5d} {1:15s} {2!s}".format(i, opnames[op], arg))
+    return "\n".join(lines)
+
+
+def endSpecial(tree, ops, special, value):
+    """
+    End the bytecode for a special function that started at index special.
+    """
+    ops.append((EXIT, None))
+    if value:
+        ops.append((VALUE, None))
+    head = tree.value[0].address
+    ops[special] = (SPECIAL, (head, head.value, tree, len(ops), value))
+
+
+def entryCode(tree):
+    """
+    Return a function that runs the bytecode for tree.
+    """
+    ops = []
+
+    def entry(model):
+        if (len(ops) == 0):
+            build(compileNode(tree, ops, False))
+            ops.append((HALT, None))
+        return run(model, ops)
+
+    return entry
+
+
+def findTailCalls(ops):
+    """
+    Find the calls in the bytecode for the body of a user function that
+    are followed only by the ends of special functions, jumps and a return.
+    The tail argument of the INVOKE for these calls is set to (n_exits,
+    needs_value), where n_exits is the number of special functions that
+    end before the return.
+    """
+    for i, [op, arg] in enumerate(ops):
+        if (op != INVOKE):
+            continue
+
+        n_exits = 0
+        needs_value = False
+        pc = i + 1
+        while True:
+            [next_op, next_arg] = ops[pc]
+            if (next_op == JUMP):
+                pc = next_arg
+                continue
+            if (next_op == EXIT):
+                n_exits += 1
+            elif (next_op == VALUE):
+                needs_value = True
+            elif (next_op == RETURN):
+                [n_args, value, tail] = arg
+                ops[i] = (INVOKE, (n_args, value, (n_exits, value or needs_value)))
+                break
+            else:
+                break
+            pc += 1
+
+
+def forRange(start, inc, stop):
+    """
+    The values of a "normal" for loop.
+    """
+    cur = start
+    while (cur < stop):
+        yield cur
+        cur += inc
+
+
+def functionCode(function):
+    """
+    Return the bytecode for the body of a user function.
+    """
+    body = function.body
+    if body.vm_body is None:
+        ops = []
+        build(compileNode(body, ops, False))
+        ops.append((RETURN, None))
+        findTailCalls(ops)
+
+        # Only expressions store the bytecode, the bytecode of a
+        # function whose body is a symbol or a constant is a single op.
+        if not isinstance(body, lexerParser.LCadExpression):
+            return ops
+        body.vm_body = ops
+    return body.vm_body
+
+
+def run(model, ops):
+    """
+    Run the bytecode in ops and return the value that it leaves on the stack.
+    """
+    Symbol = interp.Symbol
+    UserFunction = interp.UserFunction
+    callKeyword = interp.callKeyword
+    callStandard = interp.callStandard
+    lcad_nil = interp.lcad_nil
+    lcad_t = interp.lcad_t
+
+    # Values.
+    stack = []
+
+    # [function, expression] for the function calls and special
+    # functions that are in progress, for error messages.
+    calls = []
+
+    # [ops, pc, value, frame] to return to from user functions. Calls in
+    # tail position replace the function that is returning (see
+    # findTailCalls()) instead of adding to this.
+    returns = []
+
+    entry_frame = model.frame
+    pc = 0
+    try:
+        while True:
+            [op, arg] = ops[pc]
+            pc += 1
+
+            # The opcodes are tested in (roughly) the order of how often
+            # they are executed.
+            if (op == ARG):
+                func = calls[-1][0]
+                if (arg < func.minimum_args):
+                    plan = func.standard_types[arg]
+                    if (plan is None) or isinstance(stack[-1], plan[0]):
+                        continue
+                checkArg(func, arg, stack[-1])
+
+            elif (op == CALL):
+                [tree, n_args, end, value, specs, head] = arg
+                if head is None:
+                    func = stack.pop()
+                elif (head[0] == SYMBOL_VALUE):
+                    func = head[1].getv()
+                else:
+                    func = model.frame.symbols[head[1]].getv()
+                calls.append([func, tree])
+                if (func is tree.cached_func) and (func is not None):
+                    call = tree.cached_call
+                else:
+                    call = interp.findCall(func, tree)
+
+                # Evaluate the arguments with the bytecode that follows, or
+                # here if they are all constants or symbols.
+                if (call is callStandard):
+                    if (n_args == func.minimum_args) or (func.has_optional_args and (n_args > func.minimum_args)):
+                        if specs is not None:
+                            args = []
+                            minimum_args = func.minimum_args
+                            for [kind, val] in specs:
+                                if (kind == SYMBOL_VALUE):
+                                    val = val.getv()
+                                elif (kind == SLOT_VALUE):
+                                    val = model.frame.symbols[val].getv()
+                                index = len(args)
+                                if (index < minimum_args):
+                                    plan = func.standard_types[index]
+                                    if (plan is not None) and not isinstance(val, plan[0]):
+                                        checkArg(func, index, val)
+                                else:
+                                    checkArg(func, index, val)
+                                args.append(val)
+
+                            # Call built in functions here instead of with INVOKE.
+                            if (type(func) is not UserFunction):
+                                val = func.call(model, *args)
+                                calls.pop()
+                                if value and isinstance(val, Symbol):
+                                    val = val.getv()
+                                stack.append(val)
+                                pc = end
+                                continue
+                            stack.extend(args)
+                        continue
+
+                # User functions with keyword arguments.
+                if (call is callKeyword) and (type(func) is UserFunction):
+                    [args, kwargs] = func.getArgs(model, tree)
+                    tail = ops[end - 1][1][2]
+                    if tail is None:
+                        returns.append([ops, end, value, model.frame])
+                    else:
+                        del calls[-2 - tail[0]:-1]
+                        if tail[1]:
+                            returns[-1][2] = True
+                    func.enter(model, args, kwargs)
+                    ops = func.body.vm_body or functionCode(func)
+                    pc = 0
+                    continue
+
+                # Everything else, including the special functions.
+                val = call(func, model, tree)
+                calls.pop()
+                if value and isinstance(val, Symbol):
+                    val = val.getv()
+                stack.append(val)
+                pc = end
+
+            elif (op == SYMBOL_VALUE):
+                stack.append(arg.getv())
+
+            elif (op == INVOKE):
+                [n_args, value, tail] = arg
+                func = calls[-1][0]
+                if (n_args > 0):
+                    args = stack[-n_args:]
+                    del stack[-n_args:]
+                else:
+                    args = []
+
+                if (type(func) is UserFunction):
+                    if tail is None:
+                        returns.append([ops, pc, value, model.frame])
+                    else:
+                        del calls[-2 - tail[0]:-1]
+                        if tail[1]:
+                            returns[-1][2] = True
+                    func.enter(model, args, {})
+                    ops = func.body.vm_body or functionCode(func)
+                    pc = 0
+                else:
+                    val = func.call(model, *args)
+                    calls.pop()
+                    if value and isinstance(val, Symbol):
+                        val = val.getv()
+                    stack.append(val)
+
+            elif (op == SLOT_VALUE):
+                stack.append(model.frame.symbols[arg].getv())
+
+            elif (op == CONST):
+                stack.append(arg)
+
+            elif (op == RETURN):
+                [ops, pc, value, model.frame] = returns.pop()
+                calls.pop()
+                if value and isinstance(stack[-1], Symbol):
+                    stack[-1] = stack[-1].getv()
+
+            elif (op == VALUE):
+                val = stack[-1]
+                if isinstance(val, Symbol):
+                    stack[-1] = val.getv()
+
+            elif (op == TEST):
+                val = stack.pop()
+                if (val is lcad_nil):
+                    pc = arg
+                elif not (val is lcad_t):
+                    raise lce.BooleanException()
+
+            elif (op == JUMP):
+                pc = arg
+
+            elif (op == POP):
+                stack.pop()
+
+            elif (op == SPECIAL):
+                [symbol, special, tree, end, value] = arg
+                func = symbol.getv()
+                calls.append([func, tree])
+                if (func is special):
+                    if not tree.initialized:
+                        func.argCheck(tree)
+
+                # The symbol no longer refers to the special function.
+                else:
+                    val = interp.dispatch(func, model, tree)
+                    calls.pop()
+                    if value and isinstance(val, Symbol):
+                        val = val.getv()
+                    stack.append(val)
+                    pc = end
+
+            elif (op == EXIT):
+                calls.pop()
+
+            elif (op == FOR_NEXT):
+                [values, symbol] = stack[-2]
+                try:
+                    symbol.setv(next(values))
+                except StopIteration:
+                    stack[-2] = stack[-1]
+                    stack.pop()
+                    pc = arg
+
+            elif (op == SYMBOL):
+                stack.append(arg)
+
+            elif (op == SLOT):
+                stack.append(model.frame.symbols[arg])
+
+            elif (op == SET_CHECK):
+                interp.checkSet(stack[-1])
+
+            elif (op == SET_STORE):
+                val = stack.pop()
+                stack[-1].setv(val)
+                stack[-1] = val
+
+            elif (op == LOOKUP):
+                stack.append(interp.lookupSymbol(model, arg))
+
+            elif (op == FRAME_SLOT):
+                stack.append(interp.lookupAddress(model, arg))
+
+            elif (op == HALT):
+                return stack[-1]
+
+            elif (op == FOLDED):
+                [folded, end] = arg
+                if (folded.epoch == interp.fold_epoch):
+                    stack.append(folded.getv())
+                    pc = end
+
+            elif (op == FOR_INIT):
+                [n_args, address] = arg
+                if (n_args == 2):
+                    arg1 = stack.pop()
+                    if isinstance(arg1, list):
+                        values = iter(arg1)
+                    elif isinstance(arg1, lcadTypes.LCadArray):
+                        values = iter(arg1.tolist())
+                    else:
+                        values = forRange(0, 1, arg1)
+                elif (n_args == 3):
+                    stop = stack.pop()
+                    start = stack.pop()
+                    stack.pop()
+                    values = forRange(start, 1, stop)
+                else:
+                    stop = stack.pop()
+                    inc = stack.pop()
+                    start = stack.pop()
+                    stack.pop()
+                    values = forRange(start, inc, stop)
+                stack.append([values, interp.lookupAddress(model, address)])
+
+            elif (op == DEF_CHECK):
+                [tree, key] = arg
+                if not tree.initialized and interp.lookupAddress(model, key.address).is_set:
+                    raise lce.SymbolAlreadyExists(key.value)
+
+            elif (op == DEF_STORE):
+                interp.lookupAddress(model, arg).setv(stack[-1])
+
+            elif (op == DEF_DONE):
+                arg.initialized = True
+
+            elif (op == NOT_A_FUNCTION):
+                raise lce.NotAFunctionException(arg)
+
+    except Exception as e:
+        for [func, tree] in reversed(calls):
+            interp.annotateError(e, func, tree)
+        model.frame = entry_frame
+        raise
+
+
+def startSpecial(ops):
+    """
+    Start the bytecode for a special function. The SPECIAL opcode is
+    filled in by endSpecial().
+    """
+    ops.append(None)
+    return len(ops) - 1
+
+
+special_forms = {"block" : compileBlock,
+                 "cond" : compileCond,
+                 "def" : compileDef,
+                 "for" : compileFor,
+                 "if" : compileIf,
+                 "set" : compileSet,
+                 "while" : compileWhile}
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
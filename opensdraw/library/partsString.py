@@ -66,9 +66,9 @@ def addParts(model, parts_string):
                     
                 # Add the part to the model.
                 if (len(data) == 8):
-                    group.addPart(parts.Part(curm, data[6], color, step_offset), False)
+                    group.addLDrawPart(curm, data[6], parts.toColor(color), step_offset)
                 else:
-                    group.addPart(parts.Part(curm, data[6], color, step_offset + int(data[8])), False)
+                    group.addLDrawPart(curm, data[6], parts.toColor(color), step_offset + int(data[8]))
             else:
                 # Warning for non blank lines.
                 if (len(data) > 1):
@@ -94,6 +94,7 @@ class PartsFile(interpreter.LCadFunction):
         self.setSignature([[basestring]])
         
     def call(self, model, filename):
+        interpreter.addDependency(filename)
         with open(filename) as fp:
             addParts(model, fp.read())
 
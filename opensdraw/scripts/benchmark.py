@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+.. module:: benchmark
+   :synopsis: Prints the parse times, startup time and memory use of the lcad interpreter.
+
+.. moduleauthor:: Hazen Babcock
+
+Timings depend on the machine, so these are only printed, nothing is
+checked.
+"""
+
+import gc
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import opensdraw.lcad_language.interpreter as interpreter
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+
+def assemblyCode(n_parts):
+    """
+    Return the code for a group of n_parts parts, one per line.
+    """
+    code = "(group 'main'\n"
+    for i in range(n_parts):
+        code += "(tb " + str(i) + " 0 1.5 0 90 0 '3001' 4) ; part\n"
+    code += ")\n"
+    return code
+
+def formsCode(n_forms):
+    """
+    Return the code for n_forms top level forms.
+    """
+    return "".join(["(sbs " + str(i) + " 0 1 0 0 0 '3001' 4)\n" for i in range(n_forms)])
+
+def parseTime(code, use_rply = False):
+    """
+    Return the time to parse code in seconds.
+    """
+    lexerParser.use_rply = use_rply
+    try:
+        start = time.perf_counter()
+        lexerParser.parseString(code, "benchmark")
+        return time.perf_counter() - start
+    finally:
+        lexerParser.use_rply = False
+
+def parsers():
+    """
+    The hand written parser and rply on a 5000 line assembly.
+    """
+    code = assemblyCode(5000)
+
+    # Build the rply parser before timing it.
+    lexerParser.getParser()
+    rply_time = parseTime(code, use_rply = True)
+    fast_time = parseTime(code)
+    print("5000 line file, hand written parser {0:.3f}s, rply {1:.3f}s ({2:.1f}x)".format(fast_time, rply_time, rply_time/fast_time))
+
+def scaling():
+    """
+    The parse time of files with 10k and 100k top level forms, and of a
+    long list with rply. These should grow linearly.
+    """
+    for use_rply in [False, True]:
+        name = "rply" if use_rply else "hand written parser"
+        times = [parseTime(formsCode(n_forms), use_rply) for n_forms in [10000, 100000]]
+        print("10k forms {0:.3f}s, 100k forms {1:.3f}s ({2:.1f}x), {3:s}".format(times[0], times[1], times[1]/times[0], name))
+
+    times = []
+    for n_terms in [2000, 20000]:
+        times.append(parseTime("(list " + " ".join(map(str, range(n_terms))) + ")", use_rply = True))
+    print("2k term list {0:.3f}s, 20k term list {1:.3f}s ({2:.1f}x), rply".format(times[0], times[1], times[1]/times[0]))
+
+def startup(repeats = 5):
+    """
+    The time to start Python, import the interpreter and run a trivial
+    program in a new process. The best of repeats runs.
+    """
+    code = "import opensdraw.lcad_language.interpreter as i; i.execute('(def x 1) (+ x 2)')"
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", code])
+        times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", "pass"])
+    python_time = time.perf_counter() - start
+    print("startup {0:.3f}s (python alone {1:.3f}s)".format(min(times), python_time))
+
+def memory(n_forms = 5000):
+    """
+    The memory used by the AST and by the lexical environment for each
+    top level form, measured with tracemalloc.
+    """
+    code = "(def f (x y) (+ x y))\n"
+    code += "".join(["(f " + str(i) + " (* 2 " + str(i) + "))\n" for i in range(n_forms)])
+    gc.collect()
+    tracemalloc.start()
+    try:
+        ast = lexerParser.parseString(code, "benchmark")
+        ast_size = tracemalloc.get_traced_memory()[0]
+        lenv = interpreter.LEnv(add_built_ins = True)
+        start = tracemalloc.get_traced_memory()[0]
+        interpreter.createLexicalEnv(lenv, ast)
+        lenv_size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    print("memory per form, AST {0:d} bytes, lexical environment {1:d} bytes".format(ast_size//n_forms, lenv_size//n_forms))
+
+
+if (__name__ == "__main__"):
+    parsers()
+    scaling()
+    startup()
+    memory()
+
+
+#
+# The MIT License
+#
+# Copyright (c) 2015 Hazen Babcock
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
@@ -6,143 +6,364 @@
 .. moduleauthor:: Hazen Babcock
 """
 
+import importlib
+import multiprocessing
 import os
 import sys
+import time
+import traceback
 
 import opensdraw.lcad_language.interpreter as interpreter
+import opensdraw.lcad_language.ldrawWriter as ldrawWriter
+import opensdraw.lcad_language.profiler as profiler
 
-if (len(sys.argv) < 2):
-    print("usage: <lcad file> <ldraw file (optional)> <time points (optional)>")
-    print("       If you want to specify time points you also have to specify the ldraw file.")
-    exit()
-
-# Parse arguments.
-output_fname = sys.argv[1][:-4]
-time_points = 1
-if (len(sys.argv) == 3):
-    output_fname = sys.argv[2]
-elif (len(sys.argv) == 4):
-    output_fname = sys.argv[2]
-    try:
-        time_points = int(sys.argv[3])
-    except ValueError as e:
-        print("Third argument (time points) is not an integer.")
-        raise
-
-# Read input file.
-with open(sys.argv[1]) as fp:
-    ldraw_file_contents = fp.read()
-
-# Add the directory where the .lcad file is located to the Python path 
-# so that pyimport() will work as expected.
-path = os.path.abspath(os.path.dirname(sys.argv[1]))
-if not path in sys.path:
-    sys.path.insert(1, path)
-
-# Generate output files.
-cur_dir = os.getcwd()    
-index = 0
-n_parts = 0
-while (index < time_points):
-
-    # Change current working directory to the location of the lcad file (so that imported files will be found correctly).
-    if not (os.path.dirname(sys.argv[1]) == ""):
-        os.chdir(os.path.dirname(sys.argv[1]))
-
-    # Generate model.
-    if (index == 0):
-        print("Building model.")
-    model = interpreter.execute(ldraw_file_contents, filename = sys.argv[1], time_index = index)
+# How often to check if the files that the model depends on have changed (seconds).
+watch_interval = 0.25
+
+# The Program of each process that is used to generate the time points of
+# an animation, see initWorker().
+worker = None
+
+
+def buildFrame(index):
+    """
+    Generate and write a time point in a worker process. Returns the
+    time point, the number of parts and the feedback for the user.
+    """
+    [program, lcad_fname, output_fname, split] = worker
+    model = program.execute(time_index = index)
+    [n_parts, feedback] = modelFeedback(model)
+
+    # Time points other than the first are always written, like when
+    # they are generated by the main process.
+    if (index > 0) or (n_parts > 0):
+        writeModel(model, frameFilename(output_fname, index), lcad_fname, split)
+    return [index, n_parts, feedback]
+
+
+def frameFilename(output_fname, index):
+    """
+    Add the time point to the file name for animations.
+    """
+    [name, ext] = os.path.splitext(output_fname)
+    if (ext == ".gz"):
+        [name, ext] = os.path.splitext(name)
+        ext += ".gz"
+    return name + "_" + "{0:05d}".format(index) + ext
+
+
+def generate(lcad_fname, output_fname, time_points, lcad_profiler = None, stream = False, spill = False, split = False):
+    """
+    Generate and write the model for each time point. If stream is True
+    the top level forms are evaluated as they are read from the lcad file
+    (see interpreter.executeStream()), and the file is read again for each
+    time point. If spill is True the parts are written to temporary files
+    as they are added (see ldrawWriter.SpillSink). If split is True each
+    group is written to its own file in the directory output_fname.
+    """
+    program = None
+    if not stream:
+        with open(lcad_fname) as fp:
+            ldraw_file_contents = fp.read()
+
+        # Parse the model once, it is then executed for each time point. The parts
+        # of the top level forms that do not change are re-used from the last time point,
+        # this keeps their parts in memory so it is not done when spilling.
+        incremental = (time_points > 1) and not spill
+        program = interpreter.Program(ldraw_file_contents, filename = lcad_fname, incremental = incremental)
+
+    # Generate output files.
+    cur_dir = os.getcwd()
+    lcad_path = os.path.abspath(os.path.dirname(lcad_fname))
+    lcad_abs_fname = os.path.abspath(lcad_fname)
+    index = 0
+    n_parts = 0
+    while (index < time_points):
+
+        # Change current working directory to the location of the lcad file (so that imported files will be found correctly).
+        setPaths(lcad_path)
+
+        # Generate model.
+        if (index == 0):
+            print("Building model.")
+        sink = None
+        if spill:
+            sink = ldrawWriter.SpillSink()
+        try:
+            try:
+                if program is None:
+                    with open(lcad_abs_fname) as fp:
+                        model = interpreter.executeStream(fp, filename = lcad_fname, time_index = index, profiler = lcad_profiler, sink = sink)
+                else:
+                    model = program.execute(time_index = index, profiler = lcad_profiler, sink = sink)
+            finally:
+                os.chdir(cur_dir)
+
+            # Some feedback.
+            if (index == 0):
+                [n_parts, feedback] = modelFeedback(model)
+                for text in feedback:
+                    print(text)
+            elif ((index % 10) == 0):
+                print(" time step", index)
+
+            # Only write the file if there are parts.
+            if (n_parts > 0):
 
-    # Check for single or multi-part model.
-    mp_model = False
+                # Add file number for animations.
+                dat_fname = output_fname
+                if (time_points > 1):
+                    dat_fname = frameFilename(output_fname, index)
+
+                # Write the file.
+                writeModel(model, dat_fname, lcad_fname, split)
+        finally:
+            if sink is not None:
+                sink.close()
+
+        index += 1
+
+
+def initWorker(lcad_fname, lcad_code, output_fname, split):
+    """
+    Parse the model once in each worker process, it is then executed
+    for each of the time points that the process generates.
+    """
+    global worker
+
+    setPaths(os.path.dirname(lcad_fname))
+    program = interpreter.Program(lcad_code, filename = lcad_fname, incremental = True)
+    worker = [program, lcad_fname, output_fname, split]
+
+
+def modelFeedback(model):
+    """
+    Returns the number of parts and primitives in model and a
+    description of the model for the user.
+    """
+    n_parts = 0
+    feedback = []
     if (len(model.groups()) > 1):
-        mp_model = True
-
-    # Some feedback.
-    if (index == 0):
-        if mp_model:
-            for group in model.groups():
-                if (group.getNParts() > 0):
-                    n_parts += group.getNParts()
-                    print("Group:", group.name, "has", group.getNParts(), "parts.")
-                if (group.getNPrimitives() > 0):
-                    n_parts += group.getNPrimitives()
-                    print("Group:", group.name, "has", group.getNPrimitives(), "primitives.")
-        else:
-            group = model.groups()[0]
+        for group in model.groups():
             if (group.getNParts() > 0):
                 n_parts += group.getNParts()
-                print("Model has", group.getNParts(), "parts.")
+                feedback.append("Group: " + group.name + " has " + str(group.getNParts()) + " parts.")
             if (group.getNPrimitives() > 0):
                 n_parts += group.getNPrimitives()
-                print("Model has", group.getNPrimitives(), "primitives.")
-    elif ((index % 10) == 0):
-        print(" time step", index)
+                feedback.append("Group: " + group.name + " has " + str(group.getNPrimitives()) + " primitives.")
+    else:
+        group = model.groups()[0]
+        if (group.getNParts() > 0):
+            n_parts += group.getNParts()
+            feedback.append("Model has " + str(group.getNParts()) + " parts.")
+        if (group.getNPrimitives() > 0):
+            n_parts += group.getNPrimitives()
+            feedback.append("Model has " + str(group.getNPrimitives()) + " primitives.")
+    return [n_parts, feedback]
 
-    # Go to next iteration if there are no parts.
-    if (n_parts == 0):
-        index += 1
-        continue
-
-    # Reset working directory.
-    os.chdir(cur_dir)
-
-    # If the user provided a filename, then we just use it. If not then
-    # use the .mpd extension.
-    dat_fname = output_fname
-    if (len(sys.argv) == 2):
-        dat_fname += "mpd"
-
-    # And file number for animations.
-    if (time_points > 1):
-        [name, ext] = os.path.splitext(output_fname)
-        dat_fname = name + "_" + "{0:05d}".format(index) + ext
-        
-    # Write the file.
-    main_name = os.path.splitext(os.path.basename(sys.argv[1]))[0]
-    group_names = model.used_names
-    with open(dat_fname, "w") as fp_out:
-
-        added_opensdraw = False
-        for group in model.groups():
 
-            # Add File name.
-            fp_out.write("0 FILE " + main_name + " - " + group.name + "\n")
-
-            # Add header.
-            for text in group.header:
-                fp_out.write("0 " + text + "\n")
-
-            # Add program identifier (only to the first group).
-            if not added_opensdraw:
-                fp_out.write("0 // Generated by opensdraw from " + os.path.basename(sys.argv[1]) + "\n")
-                added_opensdraw = True
-
-            fp_out.write("\n")
-            # Add parts.
-            parts = group.getParts()
-            for i in range(len(parts)):
-
-                # Some fiddling to splice in the file name for parts
-                # that refer to other parts (groups) in the file.
-                part_text = parts[i].toLDraw()
-                if (part_text[0] == "1"):
-                    part_data = part_text.split(" ")
-                    part_name = " ".join(part_data[14:])
-                    if (part_name in group_names):
-                        part_text = " ".join(part_data[:14]) + " " + main_name + " - " + part_name
-                  
-                # Write part.
-                fp_out.write(part_text + "\n")
-
-                # Check if we need to add a step.
-                if (i < (len(parts)-1)) and not group.have_comments:
-                    if (parts[i].step != parts[i+1].step):
-                        fp_out.write("0 STEP\n")
-
-            fp_out.write("\n\n")
-
-    index += 1
-
-print("Done.")
+def modificationTime(filename):
+    """
+    Returns the modification time and size of filename, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(filename)
+        return [stat.st_mtime, stat.st_size]
+    except OSError:
+        return None
+
+
+def setPaths(path):
+    """
+    Change the current working directory to the location of the lcad file
+    so that imported files will be found correctly, and add it to the Python
+    path so that pyimport() will work as expected.
+    """
+    if not path in sys.path:
+        sys.path.insert(1, path)
+    os.chdir(path)
+
+
+def watchModel(lcad_fname, output_fname, time_points, stream = False, spill = False, split = False):
+    """
+    Generate the model, then wait for the lcad file or one of the files
+    that it depends on to change and generate it again. This runs until
+    it is interrupted.
+    """
+    lcad_fname = os.path.abspath(lcad_fname)
+    output_fname = os.path.abspath(output_fname)
+    while True:
+
+        # Errors are printed and the model is generated again after the next change.
+        interpreter.dependencies = set([lcad_fname])
+        try:
+            generate(lcad_fname, output_fname, time_points, stream = stream, spill = spill, split = split)
+            print("Done.")
+        except Exception:
+            traceback.print_exc()
+        files = interpreter.dependencies
+        interpreter.dependencies = None
+
+        print("Watching", len(files), "files for changes.")
+        mtimes = {}
+        for filename in files:
+            mtimes[filename] = modificationTime(filename)
+
+        changed = []
+        while (len(changed) == 0):
+            time.sleep(watch_interval)
+            changed = [filename for filename in files if (modificationTime(filename) != mtimes[filename])]
+
+        # Python modules are only imported once, so load the modules that changed again.
+        for module in list(sys.modules.values()):
+            if (getattr(module, "__file__", None) is not None) and (os.path.abspath(module.__file__) in changed):
+                importlib.reload(module)
+
+        print("")
+        print(", ".join(map(os.path.basename, changed)), "changed.")
+
+
+def writeModel(model, dat_fname, lcad_fname, split = False):
+    """
+    Write model to the file dat_fname in ldraw format, the file is
+    compressed with gzip if dat_fname ends with .gz. If split is True
+    dat_fname is a directory and each group is written to its own file.
+    """
+    main_name = os.path.splitext(os.path.basename(lcad_fname))[0]
+    ldrawWriter.saveModel(model, dat_fname, main_name, os.path.basename(lcad_fname), split = split)
+
+
+if (__name__ == "__main__"):
+
+    # Profile the model, this prints the functions and lines that take the
+    # most time and writes the call stacks to a .folded file for flamegraph tools.
+    lcad_profiler = None
+    if ("--profile" in sys.argv):
+        lcad_profiler = profiler.Profiler()
+        sys.argv.remove("--profile")
+
+    # Keep running, building the model again whenever the lcad file or one
+    # of the files that it depends on (imported modules, Python modules and
+    # parts files) changes.
+    watch = False
+    if ("--watch" in sys.argv):
+        watch = True
+        sys.argv.remove("--watch")
+
+    # Evaluate the top level forms as they are read, so that the AST of
+    # the whole file is never in memory. This is for very large files.
+    stream = False
+    if ("--stream" in sys.argv):
+        stream = True
+        sys.argv.remove("--stream")
+
+    # Write the parts to temporary files as they are added, so that the
+    # memory that is used does not depend on the number of parts.
+    spill = False
+    if ("--spill" in sys.argv):
+        spill = True
+        sys.argv.remove("--spill")
+
+    # Write each group to its own file in a directory (named after the
+    # output file, without the extension) instead of a single .mpd file.
+    split = False
+    if ("--split" in sys.argv):
+        split = True
+        sys.argv.remove("--split")
+
+    # Generate the time points of an animation with this many processes.
+    jobs = 1
+    if ("--jobs" in sys.argv):
+        i = sys.argv.index("--jobs")
+        try:
+            jobs = int(sys.argv[i+1])
+        except (IndexError, ValueError) as e:
+            print("--jobs must be followed by the number of processes.")
+            raise
+        sys.argv = sys.argv[:i] + sys.argv[i+2:]
+
+    if (len(sys.argv) < 2):
+        print("usage: <lcad file> <ldraw file (optional)> <time points (optional)> <--profile (optional)> <--jobs N (optional)> <--watch (optional)> <--stream (optional)> <--spill (optional)> <--split (optional)>")
+        print("       If you want to specify time points you also have to specify the ldraw file.")
+        print("       The ldraw file is compressed with gzip if its name ends with .gz.")
+        exit()
+
+    # Parse arguments.
+    lcad_fname = sys.argv[1]
+    output_fname = lcad_fname[:-4] + "mpd"
+    time_points = 1
+    if (len(sys.argv) == 3):
+        output_fname = sys.argv[2]
+    elif (len(sys.argv) == 4):
+        output_fname = sys.argv[2]
+        try:
+            time_points = int(sys.argv[3])
+        except ValueError as e:
+            print("Third argument (time points) is not an integer.")
+            raise
+
+    if split:
+        output_fname = os.path.splitext(output_fname)[0]
+
+    if (lcad_profiler is not None) and (jobs > 1):
+        print("Profiling uses a single process.")
+        jobs = 1
+
+    if watch and ((lcad_profiler is not None) or (jobs > 1)):
+        print("Watching does not support profiling or multiple processes.")
+        exit()
+
+    if stream and (jobs > 1):
+        print("Streaming uses a single process.")
+        jobs = 1
+
+    if spill and (jobs > 1):
+        print("Spilling uses a single process.")
+        jobs = 1
+
+    # The time points of animations are generated by a pool of worker
+    # processes. Each one parses the model once. The first time point is
+    # generated first as the others are only written if it has parts.
+    if (jobs > 1) and (time_points > 1):
+        print("Building model.")
+        with open(lcad_fname) as fp:
+            ldraw_file_contents = fp.read()
+        initargs = (os.path.abspath(lcad_fname), ldraw_file_contents, os.path.abspath(output_fname), split)
+        pool = multiprocessing.Pool(jobs, initializer = initWorker, initargs = initargs)
+        try:
+            [index, n_parts, feedback] = pool.apply(buildFrame, (0,))
+            for text in feedback:
+                print(text)
+
+            if (n_parts > 0):
+
+                # Consecutive time points in the same process can re-use more of the last time point.
+                chunksize = max(1, (time_points - 1)//(4 * jobs))
+                for [index, n_parts, feedback] in pool.imap_unordered(buildFrame, range(1, time_points), chunksize):
+                    if ((index % 10) == 0):
+                        print(" time step", index)
+        finally:
+            pool.close()
+            pool.join()
+
+        print("Done.")
+        exit()
+
+    # Build the model again whenever a file that it depends on changes.
+    if watch:
+        try:
+            watchModel(lcad_fname, output_fname, time_points, stream, spill, split)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
+    generate(lcad_fname, output_fname, time_points, lcad_profiler, stream, spill, split)
+
+    if lcad_profiler is not None:
+        print("")
+        print(lcad_profiler.report())
+        profile_fname = os.path.splitext(output_fname)[0] + ".folded"
+        lcad_profiler.writeCollapsed(profile_fname)
+        print("Wrote call stacks to", profile_fname)
+
+    print("Done.")
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+#
+## @file
+#
+# Creates the lcad_parser.json file, the LR tables of the rply parser.
+# Run this after changing the grammar in lexerParser.py.
+#
+
+import opensdraw.lcad_language.lexerParser as lexerParser
+
+lexerParser.saveTables()
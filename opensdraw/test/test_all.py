@@ -7,19 +7,53 @@
 
 """
 
+import datetime
+import gc
+import glob
+import gzip
+import importlib
+import io
 import math
 import nose
 import numbers
 import numpy
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
 
 import opensdraw.lcad_language.belt as belt
 import opensdraw.lcad_language.chain as chain
+import opensdraw.lcad_language.compiler as compiler
+import opensdraw.lcad_language.coreFunctions as coreFunctions
 import opensdraw.lcad_language.curve as curve
+import opensdraw.lcad_language.folding as folding
+import opensdraw.lcad_language.geometry as geometry
 import opensdraw.lcad_language.interpreter as interpreter
 import opensdraw.lcad_language.lcadExceptions as lcadExceptions
 import opensdraw.lcad_language.lexerParser as lexerParser
 import opensdraw.lcad_language.lcadTypes as lcadTypes
+import opensdraw.lcad_language.ldrawWriter as ldrawWriter
+import opensdraw.lcad_language.profiler as profiler
 import opensdraw.lcad_language.pulleySystem as pulleySystem
+import opensdraw.lcad_language.vm as vm
+
+def setup_module():
+    """
+    Use a temporary directory for the parse cache, so that the tests
+    do not write to the user's cache directory.
+    """
+    global cache_dir, tmp_dir
+    cache_dir = lexerParser.cache_dir
+    tmp_dir = tempfile.mkdtemp()
+    lexerParser.cache_dir = os.path.join(tmp_dir, "lcadcache")
+
+def teardown_module():
+    lexerParser.cache_dir = cache_dir
+    shutil.rmtree(tmp_dir)
 
 def exe(string):
     """
@@ -32,6 +66,42 @@ def exe(string):
     sym = interpreter.interpret(model, ast)
     return interpreter.getv(sym)
 
+def exeCompiled(string):
+    """
+    Same as exe(), but using the compiled AST.
+    """
+    lenv = interpreter.LEnv(add_built_ins = True)
+    model = interpreter.Model()
+    ast = lexerParser.parse(string, "test")
+    interpreter.createLexicalEnv(lenv, ast)
+    compiler.compileTree(ast)
+    sym = interpreter.interpret(model, ast)
+    return interpreter.getv(sym)
+
+def exeFolded(string):
+    """
+    Same as exe(), but with constant folding.
+    """
+    lenv = interpreter.LEnv(add_built_ins = True)
+    model = interpreter.Model()
+    ast = lexerParser.parse(string, "test")
+    interpreter.createLexicalEnv(lenv, ast)
+    folding.foldTree(ast)
+    sym = interpreter.interpret(model, ast)
+    return interpreter.getv(sym)
+
+def exeVM(string):
+    """
+    Same as exe(), but using the bytecode VM.
+    """
+    lenv = interpreter.LEnv(add_built_ins = True)
+    model = interpreter.Model()
+    ast = lexerParser.parse(string, "test")
+    interpreter.createLexicalEnv(lenv, ast)
+    vm.compileTree(ast)
+    sym = interpreter.interpret(model, ast)
+    return interpreter.getv(sym)
+
 ## Symbols
 
 # t (true)
@@ -55,6 +125,543 @@ def text_time_index():
     assert exe("time-index") == 0
 
 
+## Compiled engine.
+def test_compiled_1():
+    assert exeCompiled("(def incf (x :y 0) (+ x y 1)) (incf 1 :y 2)") == 4
+
+def test_compiled_2():
+    assert exeCompiled("(def x 0) (for (i 10) (set x (+ i x))) x") == 45
+
+def test_compiled_3():
+    assert exeCompiled("(def x 1 y 0) (for (i 2) (set y (+ y x)) (def x 2)) y") == 3
+
+def test_compiled_4():
+    assert exeCompiled("(import mod :local) (fn)") == math.pi
+
+@nose.tools.raises(lcadExceptions.SymbolNotDefined)
+def test_compiled_5():
+    exeCompiled("(+ x 1)")
+
+def test_compiled_6():
+    assert interpreter.execute("(part '1234' 5)", engine = "compiled").groups()[0].getNParts() == 1
+
+
+## Bytecode VM.
+def test_vm_1():
+    assert exeVM("(def incf (x :y 0) (+ x y 1)) (incf 1 :y 2)") == 4
+
+def test_vm_2():
+    assert exeVM("(def x 0) (for (i 10) (set x (+ i x))) x") == 45
+
+def test_vm_3():
+    assert exeVM("(def x 1 y 0) (for (i 2) (set y (+ y x)) (def x 2)) y") == 3
+
+def test_vm_4():
+    assert exeVM("(def x 0) (while (< x 10) (set x (+ x 1))) x") == 10
+
+def test_vm_5():
+    assert exeVM("(def x 2) (cond ((= x 1) 1) ((= x 2) 2) (t 3))") == 2
+
+def test_vm_6():
+    assert exeVM("(def f (n) (if (= n 0) 0 (+ (f (- n 1)) n))) (f 5000)") == 12502500
+
+def test_vm_7():
+    assert exeVM("(import mod :local) (fn)") == math.pi
+
+@nose.tools.raises(lcadExceptions.SymbolNotDefined)
+def test_vm_8():
+    exeVM("(+ x 1)")
+
+@nose.tools.raises(lcadExceptions.WrongTypeException)
+def test_vm_9():
+    exeVM("(def f (x) x) (f 1) (sin \"a\")")
+
+def test_vm_10():
+    assert interpreter.execute("(part '1234' 5)", engine = "vm").groups()[0].getNParts() == 1
+
+def test_vm_11():
+    # The bytecode for deeply nested expressions is compiled without recursion.
+    for fold_constants in [True, False]:
+        model = interpreter.execute("(block " * 2000 + "(part '3001' 4)" + ")" * 2000, engine = "vm", fold_constants = fold_constants)
+        assert model.groups()[0].getNParts() == 1
+
+def test_vm_12():
+    # Functions that are symbols and built in functions whose arguments are
+    # constants or symbols are called by the CALL opcode.
+    assert exeVM("(def f (a b) (+ a b)) (def x 0) (for (i 10) (set x (f x i))) x") == 45
+
+
+## Program.
+def test_program_1():
+    program = interpreter.Program("(def x 2) (def f (n) (* n x)) (for (i (f time-index)) (part '1234' 5))")
+    assert program.execute(1).groups()[0].getNParts() == 2
+    assert program.execute(2).groups()[0].getNParts() == 4
+    assert program.execute(1).groups()[0].getNParts() == 2
+
+def test_program_2():
+    program = interpreter.Program("(import timed) (def l (list)) (for (i timed:x) (append l i)) (for (i l) (part '1234' 5))", engine = "vm")
+    assert program.execute(3).groups()[0].getNParts() == 3
+    assert program.execute(1).groups()[0].getNParts() == 1
+
+def test_program_3():
+    program = interpreter.Program("(def n 0) (defmemo f (x) (block (set n (+ n 1)) x)) (f 1) (f 1) (for (i n) (part '1234' 5))")
+    assert program.execute().groups()[0].getNParts() == 1
+    assert program.execute().groups()[0].getNParts() == 1
+
+
+## Incremental.
+def test_incremental_1():
+    program = interpreter.Program("(def x 2) (group 'chassis' (for (i x) (part '1234' 5))) (for (i time-index) (part '1234' 5))", incremental = True)
+    model = program.execute(1)
+    model = program.execute(3)
+    assert program.tracker.n_reused == 2
+    assert model.groups()[0].getNParts() == 3
+    assert model.groups()[1].getNParts() == 2
+
+def test_incremental_2():
+    program = interpreter.Program("(def y (* 2 time-index)) (for (i y) (part '1234' 5))", incremental = True)
+    assert program.execute(1).groups()[0].getNParts() == 2
+    assert program.execute(2).groups()[0].getNParts() == 4
+    assert program.tracker.n_reused == 0
+
+def test_incremental_3():
+    program = interpreter.Program("(def r (rand-integer 0 10)) (part '1234' 5)", incremental = True)
+    program.execute(1)
+    assert program.execute(1).groups()[0].getNParts() == 1
+    assert program.tracker.n_reused == 1
+
+def test_incremental_4():
+    program = interpreter.Program("(defmemo f (x) (* x time-index)) (def a (f 1)) (def b (f 1)) (for (i b) (part '1234' 5))", incremental = True, engine = "vm")
+    assert program.execute(1).groups()[0].getNParts() == 1
+    assert program.execute(3).groups()[0].getNParts() == 3
+
+def test_incremental_5():
+    # Symbols that refer to the same list or vector still share it when the forms are re-used.
+    for code in ["(def v (vector 1 2 3)) (def w v) (set (aref w 0) (+ 1 time-index)) (for (i (aref v 0)) (part '1' 4))",
+                 "(def l (list 0)) (def m l) (set (aref m 0) time-index) (for (i (aref l 0)) (part '1' 4))"]:
+        program = interpreter.Program(code, incremental = True)
+        for time_index in [0, 1, 2]:
+            n_parts = program.execute(time_index).groups()[0].getNParts()
+            assert n_parts == interpreter.execute(code, time_index = time_index).groups()[0].getNParts()
+
+
+## Tail calls.
+def test_tail_1():
+    assert exe("(def f (n acc) (if (= n 0) acc (f (- n 1) (+ acc 1)))) (f 5000 0)") == 5000
+
+def test_tail_2():
+    assert exeCompiled("(def f (n acc) (if (= n 0) acc (f (- n 1) (+ acc 1)))) (f 5000 0)") == 5000
+
+def test_tail_3():
+    assert exeVM("(def f (n acc) (if (= n 0) acc (f (- n 1) (+ acc 1)))) (f 5000 0)") == 5000
+
+def test_tail_4():
+    assert exe("(def f (n :acc 0) (cond ((= n 0) acc) (t (f (- n 1) :acc (+ acc n))))) (f 5000)") == 12502500
+
+def test_tail_5():
+    assert exeVM("(def f (n :acc 0) (cond ((= n 0) acc) (t (f (- n 1) :acc (+ acc n))))) (f 5000)") == 12502500
+
+def test_tail_6():
+    assert exe("(def f (l x) (block (def y (+ x 1)) (if (= y 5000) l (f l y)))) (len (f (list 1 2) 0))") == 2
+
+def test_tail_7():
+    assert exe("(def f (n) (if (= n 0) 0 (+ 1 (f (- n 1))))) (f 50)") == 50
+
+def test_tail_8():
+    ast = lexerParser.parse("(block " * 5000 + "1" + ")" * 5000, "test")
+    interpreter.createLexicalEnv(interpreter.LEnv(add_built_ins = True), ast)
+    nodes = []
+    interpreter.walk(ast, lambda node, indent: nodes.append(node))
+    assert len(nodes) == 10001
+
+def test_tail_9():
+    # Deeply nested programs run on every engine, with and without constant folding.
+    deep_call = "(def f (x) " + "(+ 1 " * 1000 + "x" + ")" * 1000 + ") (for (i (f 1)) (part '3001' 4))"
+    deep_if = "(if t " * 1000 + "(part '3001' 4)" + ")" * 1000
+    for engine in ["interpreted", "compiled", "vm"]:
+        for fold_constants in [True, False]:
+            model = interpreter.execute(deep_call, engine = engine, fold_constants = fold_constants)
+            assert model.groups()[0].getNParts() == 1001
+            model = interpreter.execute(deep_if, engine = engine, fold_constants = fold_constants)
+            assert model.groups()[0].getNParts() == 1
+
+
+## Profiler.
+def test_profiler_1():
+    prof = profiler.Profiler()
+    interpreter.execute("(def f (x) (+ x 1))\n(for (i 10) (f i))", filename = "test", profiler = prof)
+    assert prof.functions["f (test:1)"].count == 10
+    assert prof.functions["+"].count == 10
+    assert prof.lines[("test", 2)].count == 11
+    assert "for;f (test:1);+ " in prof.collapsedStacks()
+    assert interpreter.dispatch is not prof.dispatch
+
+def test_profiler_2():
+    prof = profiler.Profiler()
+    interpreter.execute("(def f (n) (if (= n 0) 0 (f (- n 1)))) (f 10)", filename = "test", profiler = prof)
+    assert prof.functions["f (test:1)"].count == 11
+
+@nose.tools.raises(lcadExceptions.LCadException)
+def test_profiler_3():
+    interpreter.execute("(+ 1 2)", engine = "vm", profiler = profiler.Profiler())
+
+def test_profiler_4():
+    # Expressions that are nested too deeply for the interpreter are run on the virtual machine.
+    prof = profiler.Profiler()
+    depth = vm.max_depth + 10
+    code = "(def x 1)\n" + "(+ x " * depth + "x" + ")" * depth
+    interpreter.execute(code, filename = "test", profiler = prof)
+    assert prof.functions[profiler.vm_name].count == 1
+    assert profiler.vm_name in prof.report()
+    assert vm.run is not prof.run
+
+
+## Constant folding.
+def test_folding_1():
+    assert exeFolded("(* 2 pi)") == 2.0 * math.pi
+
+def test_folding_2():
+    ast = lexerParser.parse("(def x 1) (translate (list 0 0 (* 2 5)) (list x 0 0))", "test")
+    interpreter.createLexicalEnv(interpreter.LEnv(add_built_ins = True), ast)
+    folding.foldTree(ast)
+    assert ast[1].value[1].folded.value == [0, 0, 10]
+    assert ast[1].value[2].folded is None
+
+def test_folding_3():
+    assert exeFolded("(def f () (block (def l (list 1 2)) (append l 3) (len l))) (f) (f)") == 3
+
+def test_folding_4():
+    assert exeFolded("(def f () (+ 1 2)) (set + -) (f)") == -1
+
+def test_folding_5():
+    assert exeFolded("(if nil (/ 1 0) 2)") == 2
+
+@nose.tools.raises(lcadExceptions.WrongTypeException)
+def test_folding_6():
+    exeFolded("(+ 1 \"a\")")
+
+def test_folding_7():
+    model = interpreter.execute("(translate (list 0 0 5) (part '1234' 5))", fold_constants = False)
+    assert model.groups()[0].getNParts() == 1
+
+def test_folding_8():
+    # Deeply nested constant expressions are folded without recursion.
+    assert exeFolded("(+ 1 " * 3000 + "1" + ")" * 3000) == 3001
+    for engine in ["interpreted", "compiled", "vm"]:
+        interpreter.execute("(+ 1 " * 3000 + "1" + ")" * 3000, engine = engine)
+
+
+## Startup.
+def test_startup_1():
+    # modules.xml lists the functions of each module.
+    interpreter.LEnv(add_built_ins = True)
+    for module_name in set(interpreter.builtin_modules.values()):
+        module = importlib.import_module(module_name)
+        names = [name for name in interpreter.builtin_modules if (interpreter.builtin_modules[name] == module_name)]
+        assert sorted(names) == sorted(module.lcad_functions.keys())
+
+def test_startup_2():
+    # Modules are only imported when one of their functions is used.
+    code = "import sys; import opensdraw.lcad_language.interpreter as i; i.execute('(def x 1) (+ x 2)');"
+    code += "print(' '.join(sorted(m for m in set(i.builtin_modules.values()) if m in sys.modules)));"
+    code += "print('scipy' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code]).decode().split("\n")
+    assert (output[0] == "opensdraw.lcad_language.coreFunctions opensdraw.lcad_language.mathFunctions")
+    assert (output[1] == "False")
+
+
+## Parse cache.
+def cacheFile(code):
+    """
+    Write code to a file in the temporary directory, returns the
+    name of the file.
+    """
+    filename = os.path.join(tempfile.mkdtemp(dir = tmp_dir), "cache.lcad")
+    with open(filename, "w") as fp:
+        fp.write(code)
+    return filename
+
+def test_parse_cache_1():
+    filename = cacheFile("(def x 1) x")
+    ast = lexerParser.parse("(def x 1) x", filename, cache = True)
+    assert os.path.exists(lexerParser.cachePath(filename))
+    assert lexerParser.parse("(def x 1) x", filename, cache = True) is not ast
+    assert lexerParser.parse("(def x 1) x", filename, cache = True)[1].value == "x"
+
+    # The cache is not next to the file.
+    assert os.listdir(os.path.dirname(filename)) == ["cache.lcad"]
+
+def test_parse_cache_2():
+    filename = cacheFile("(def x 1) x")
+    lexerParser.parse("(def x 1) x", filename, cache = True)
+    assert lexerParser.parse("(def y 10) y", filename, cache = True)[1].value == "y"
+    assert lexerParser.loadCache(filename)["ast"][1].value == "y"
+
+def test_parse_cache_3():
+    # parse() only uses the cache when asked, and the cache can be turned off.
+    filename = cacheFile("(def x 1) x")
+    lexerParser.parse("(def x 1) x", filename)
+    assert not os.path.exists(lexerParser.cachePath(filename))
+    lexerParser.use_cache = False
+    try:
+        lexerParser.parse("(def x 1) x", filename, cache = True)
+    finally:
+        lexerParser.use_cache = True
+    assert not os.path.exists(lexerParser.cachePath(filename))
+
+def test_parse_cache_4():
+    # A cache directory that cannot be created is ignored.
+    filename = cacheFile("(def x 1) x")
+    cache_dir = lexerParser.cache_dir
+    lexerParser.cache_dir = os.path.join(filename, "cache")
+    try:
+        assert lexerParser.parse("(def x 1) x", filename, cache = True)[1].value == "x"
+    finally:
+        lexerParser.cache_dir = cache_dir
+
+def test_parse_cache_5():
+    # Cache files with the wrong version or with classes other than the AST classes are not used.
+    filename = cacheFile("(def x 1) x")
+    lexerParser.parse("(def x 1) x", filename, cache = True)
+    record = lexerParser.loadCache(filename)
+    assert record is not None
+
+    with open(lexerParser.cachePath(filename), "wb") as fp:
+        fp.write(b"lcadcache 1\n")
+        pickle.dump(record, fp)
+    assert lexerParser.loadCache(filename) is None
+
+    record["hash"] = datetime.date(2015, 1, 1)
+    with open(lexerParser.cachePath(filename), "wb") as fp:
+        fp.write(lexerParser.cache_header)
+        pickle.dump(record, fp)
+    assert lexerParser.loadCache(filename) is None
+    assert lexerParser.parse("(def x 1) x", filename, cache = True)[1].value == "x"
+
+
+## Parser.
+def nodeKey(node):
+    """
+    The type, value and source position of each node in an AST.
+    """
+    if isinstance(node, list):
+        return [nodeKey(elt) for elt in node]
+    value = node.value
+    if isinstance(node, lexerParser.LCadExpression):
+        value = nodeKey(value)
+    return [type(node), value, node.filename, node.start_line, node.start_column, node.end_line, node.end_column]
+
+def rplyParse(string, filename):
+    lexerParser.use_rply = True
+    try:
+        return lexerParser.parseString(string, filename)
+    finally:
+        lexerParser.use_rply = False
+
+def test_parser_1():
+    # The hand written parser and rply give the same AST.
+    path = os.path.dirname(os.path.abspath(__file__)) + "/../"
+    for filename in glob.glob(path + "examples/*.lcad") + glob.glob(path + "library/*.lcad"):
+        with open(filename) as fp:
+            code = fp.read()
+        assert nodeKey(lexerParser.parseString(code, filename)) == nodeKey(rplyParse(code, filename))
+
+def test_parser_2():
+    code = "(def s 'a\nb') ; comment\r\n(print \"x\" 1 -2.5e3 .5 inf x.y)\n\t()"
+    assert nodeKey(lexerParser.parseString(code, "test")) == nodeKey(rplyParse(code, "test"))
+
+@nose.tools.raises(ValueError)
+def test_parser_3():
+    lexerParser.parseString("(def x 1))", "test")
+
+@nose.tools.raises(Exception)
+def test_parser_4():
+    lexerParser.parseString("(def x 1", "test")
+
+def test_parser_5():
+    # The hand written parser and rply give the same AST for a large file.
+    code = "(group 'main'\n"
+    for i in range(5000):
+        code += "(tb " + str(i) + " 0 1.5 0 90 0 '3001' 4) ; part\n"
+    code += ")\n"
+    assert nodeKey(lexerParser.parseString(code, "test")) == nodeKey(rplyParse(code, "test"))
+
+def test_parser_6():
+    # parseForms() is a generator that reads only the chunks that it needs
+    # for each form, so parsing does not depend on the length of the file.
+    read = []
+    def chunks():
+        for i in range(100000):
+            read.append(i)
+            yield "(sbs " + str(i) + " 0 1 0 0 0 '3001' 4)\n"
+
+    forms = lexerParser.parseForms(chunks(), "test")
+    assert isinstance(forms, types.GeneratorType)
+    assert (next(forms).value[1].value == 0)
+    assert (len(read) <= 2)
+    assert (next(forms).value[1].value == 1)
+    assert (len(read) <= 3)
+    assert (len(list(forms)) == 99998)
+
+def test_parser_7():
+    # Long lists with rply.
+    code = "(list " + " ".join(map(str, range(20000))) + ")"
+    ast = rplyParse(code, "test")
+    assert (len(ast[0].value) == 20001)
+    assert (ast[0].value[-1].value == 19999)
+    assert gc.isenabled()
+
+def test_parser_8():
+    # The AST nodes do not have a __dict__ and the symbol names are interned.
+    ast = lexerParser.parseString("(def x 'a') (print x 'a' 1 1.5)", "test")
+    for node in [ast[0]] + ast[1].value:
+        assert not hasattr(node, "__dict__")
+    assert ast[0].value[1].value is ast[1].value[1].value
+    assert ast[0].value[2].value is ast[1].value[2].value
+
+def test_parser_9():
+    # Only the expressions that need one have their own lexical environment,
+    # the others share the lexical environment of the expression that contains them.
+    code = "(def f (x y) (+ x y))\n"
+    code += "".join(["(f " + str(i) + " (* 2 " + str(i) + "))\n" for i in range(100)])
+    ast = lexerParser.parseString(code, "test")
+    lenv = interpreter.LEnv(add_built_ins = True)
+    interpreter.createLexicalEnv(lenv, ast)
+    assert ast[0].value[3].lenv is not lenv
+    for node in ast[1:]:
+        assert node.lenv is lenv
+        assert node.value[2].lenv is lenv
+
+def test_parser_10():
+    # The parser tables are generated if they are missing, but not written.
+    tables_file = lexerParser.tables_file
+    lexerParser.tables_file = os.path.join(tmp_dir, "lcad_parser.json")
+    try:
+        lexerParser.buildParser()
+        assert not os.path.exists(lexerParser.tables_file)
+        lexerParser.saveTables(lexerParser.tables_file)
+        assert os.path.exists(lexerParser.tables_file)
+    finally:
+        lexerParser.tables_file = tables_file
+
+def test_parser_11():
+    # The rply lexer and parser are only built when they are used.
+    code = "import opensdraw.lcad_language.lexerParser as lp; lp.parse('(def x 1)');"
+    code += "print(lp.parser is None); lp.use_rply = True; lp.parse('(def x 1)'); print(lp.parser is None)"
+    output = subprocess.check_output([sys.executable, "-c", code]).decode().split("\n")
+    assert (output[0] == "True")
+    assert (output[1] == "False")
+
+
+## Streaming.
+def exeStream(string, time_index = 0, engine = "interpreted"):
+    """
+    Execute string one top level form at a time, returns the model.
+    """
+    return interpreter.executeStream(io.StringIO(string), "test", time_index, engine)
+
+def test_stream_1():
+    # The forms are the same as those from the parser, for any chunk size.
+    path = os.path.dirname(os.path.abspath(__file__)) + "/../examples/belt.lcad"
+    with open(path) as fp:
+        code = fp.read()
+    ast = nodeKey(lexerParser.parseString(code, path))
+    for chunk_size in [1, 2, 7, 100]:
+        forms = lexerParser.parseStream(io.StringIO(code), path, chunk_size)
+        assert (nodeKey([form for form in forms]) == ast)
+
+def test_stream_2():
+    # Calling a function before it is defined.
+    code = "(part '1234' 1) (f 2) (def f (n) (for (i n) (part '1234' 2))) (part '1234' 3)"
+    for engine in ["interpreted", "compiled", "vm"]:
+        parts = exeStream(code, engine = engine).groups()[0].getParts()
+        assert ([part.part_color for part in parts] == ["1", "2", "2", "3"])
+
+def test_stream_3():
+    # A function that calls a function that is defined later.
+    model = exeStream("(def f (n) (g n)) (f 3) (def g (n) (for (i n) (part '1234' 5)))")
+    assert model.groups()[0].getNParts() == 3
+
+def test_stream_4():
+    # Symbols created by import.
+    model = exeStream("(import timed) (for (i timed:x) (part '1234' 5))", time_index = 2)
+    assert model.groups()[0].getNParts() == 2
+
+@nose.tools.raises(lcadExceptions.SymbolNotDefined)
+def test_stream_5():
+    exeStream("(part '1234' 5) (f 1)")
+
+@nose.tools.raises(lcadExceptions.VariableNotSetException)
+def test_stream_6():
+    exeStream("(def f () (+ x 1)) (f) (def x 1)")
+
+
+## Array Functions.
+def test_arange_1():
+    assert exe("(arange 5)").tolist() == [0, 1, 2, 3, 4]
+
+def test_arange_2():
+    assert exe("(arange 1 2 0.25)").tolist() == [1.0, 1.25, 1.5, 1.75]
+
+@nose.tools.raises(lcadExceptions.NumberArgumentsException)
+def test_arange_3():
+    exe("(arange 1 2 3 4)")
+
+def test_array_1():
+    assert isinstance(exe("(array 1 2 3)"), lcadTypes.LCadArray)
+
+def test_array_2():
+    assert exe("(array (list (list 1 2) (list 3 4)))").shape == (2, 2)
+
+@nose.tools.raises(lcadExceptions.WrongTypeException)
+def test_array_3():
+    exe("(array (list 1 'a'))")
+
+def test_array_4():
+    assert exe("(aref (array (list (list 1 2) (list 3 4))) 1 0)") == 3
+
+def test_linspace_1():
+    assert exe("(linspace 0 1 5)").tolist() == [0.0, 0.25, 0.5, 0.75, 1.0]
+
+def test_slice_1():
+    assert exe("(slice (arange 10) 2 5)").tolist() == [2, 3, 4]
+
+def test_slice_2():
+    assert exe("(slice (arange 10) 0 10 3)").tolist() == [0, 3, 6, 9]
+
+def test_slice_3():
+    assert exe("(slice (list 1 2 3) -2)") == [2, 3]
+
+def test_slice_4():
+    # Slices are copies.
+    assert exe("(def a (arange 3)) (set (aref (slice a 0) 0) 5) (aref a 0)") == 0
+
+# broadcasting
+def test_array_math_1():
+    assert exe("(+ (arange 3) 1.5)").tolist() == [1.5, 2.5, 3.5]
+
+def test_array_math_2():
+    assert exe("(def a (arange 3)) (- a 1) a").tolist() == [0, 1, 2]
+
+def test_array_math_3():
+    assert exe("(* (arange 3) (arange 3))").tolist() == [0, 1, 4]
+
+def test_array_math_4():
+    assert exe("(% (arange 4) 2)").tolist() == [0, 1, 0, 1]
+
+def test_array_math_5():
+    assert numpy.allclose(exe("(sin (linspace 0 pi 3))"), [0, 1, 0])
+
+def test_array_math_6():
+    assert numpy.allclose(exe("(atan2 (array 1 -1) 1)"), [0.25 * math.pi, -0.25 * math.pi])
+
+def test_array_math_7():
+    assert exe("(factorial (arange 5))").tolist() == [1, 1, 2, 6, 24]
+
+def test_array_math_8():
+    assert isinstance(exe("(cos (arange 3))"), lcadTypes.LCadArray)
+
+
 ## Comparison Functions.
 
 # equal
@@ -219,6 +826,68 @@ def test_def_14():
 def test_def_15():
     exe("(def fn (x :y 2) (+ x y)) (fn 1 :z 3)")
 
+def test_def_16():
+    assert exe("(def f (n) (if (= n 0) 0 (+ (f (- n 1)) n))) (f 10)") == 55
+
+def test_def_17():
+    assert exe("(def f (x :y x) (+ x y)) (f 2)") == 4
+
+def test_def_18():
+    assert exe("(def f (n) (block (def g (x) (+ x n)) g)) (def g1 (f 1) g2 (f 5)) (+ (g1 1) (g2 1))") == 8
+
+def test_def_19():
+    assert exe("(def fn (:y (aref (list) 1)) y) (fn :y 3)") == 3
+
+def test_def_20():
+    assert exe("(def fn (x :y \"a\") y) (fn 1)") == "a"
+
+@nose.tools.raises(lcadExceptions.KeywordValueException)
+def test_def_21():
+    exe("(def fn (x :y 2) (+ x y)) (fn 1 :y)")
+
+# defmemo
+def test_defmemo_1():
+    assert exe("(def n 0) (defmemo fn (x) (block (set n (+ n 1)) (* x 2))) (fn 1) (fn 1) (fn 2) n") == 2
+
+def test_defmemo_2():
+    assert exe("(def n 0) (defmemo fn (x :y 1) (block (set n (+ n 1)) (+ x y))) (fn 1 :y 2) (fn 1) (fn 1 :y 2) n") == 2
+
+def test_defmemo_3():
+    assert exe("(def n 0) (defmemo fn (v) (block (set n (+ n 1)) v)) (fn (vector 1 2 3)) (fn (vector 1 2 3)) (fn (vector 1 2 4)) n") == 2
+
+def test_defmemo_4():
+    assert exe("(defmemo fn () (list 1 2)) (append (fn) 3) (len (fn))") == 2
+
+def test_defmemo_5():
+    model = interpreter.execute("(defmemo fn () (part '1234' 5)) (fn) (translate (list 0 0 20) (fn))")
+    [p1, p2] = model.groups()[0].getParts()
+    assert (p1.matrix[2,3] == 0) and (p2.matrix[2,3] == 20)
+
+@nose.tools.raises(lcadExceptions.MemoizeException)
+def test_defmemo_6():
+    exe("(defmemo fn () (group 'g' (part '1234' 5))) (fn)")
+
+@nose.tools.raises(lcadExceptions.NumberArgumentsException)
+def test_defmemo_7():
+    exe("(defmemo x 1)")
+
+def test_defmemo_8():
+    # With a function as step-offset (see examples/auto-step.lcad) each part
+    # gets the same step as it would without memoization.
+    code = "(def auto-inc-fn () (block (def step 0) (def auto-inc () (block (set step (+ step 1)) step)) auto-inc))"
+    code += "(set step-offset (auto-inc-fn)) (defmemo f (x) (block (part x 4) 1))"
+    code += "(f '3001') (f '3002') (f '3001') (part '9999' 4) (f '3002') (part '9999' 4)"
+    steps = []
+    try:
+        for definition in ["defmemo", "def"]:
+            interpreter.builtin_symbols["step-offset"].setv(0)
+            model = interpreter.execute(code.replace("defmemo", definition))
+            steps.append([[part.part_id, part.step] for part in model.groups()[0].getParts()])
+    finally:
+        interpreter.builtin_symbols["step-offset"].setv(0)
+    assert (steps[0] == steps[1])
+    assert ([step for [part_id, step] in steps[0]] == [1, 2, 3, 4, 5, 6])
+
 # for
 def test_for_1():
     assert exe("(def x 0) (for (i 10) (set x (+ 1 x))) x") == 10
@@ -251,6 +920,12 @@ def test_for_8():
 @nose.tools.raises(lcadExceptions.LCadException)
 def test_for_9():
     exe("(for (1 10) 1)")
+
+def test_for_10():
+    assert exe("(def i 5) (for (i 3) i) i") == 5
+
+def test_for_11():
+    assert exe("(def x 0) (for (i (arange 1 4)) (set x (+ i x))) x") == 6
     
 # if
 def test_if_1():
@@ -284,6 +959,84 @@ def test_import_2():
 def test_import_3():
     exe("(import)")
 
+def test_import_4():
+    interpreter.builtin_symbols["time-index"].setv(1)
+    assert exe("(import timed) timed:x") == 1
+    interpreter.builtin_symbols["time-index"].setv(2)
+    assert exe("(import timed) timed:x") == 2
+    interpreter.builtin_symbols["time-index"].setv(0)
+
+def test_import_5():
+    assert exe("(import shared) (import shared :local) (append shared:l 3) (len l)") == 3
+
+def test_import_6():
+    assert exe("(import shared) (append shared:l 3) (len shared:l)") == 3
+    assert exe("(import shared) (append shared:l 3) (len shared:l)") == 3
+
+def test_import_7():
+    interpreter.dependencies = set()
+    try:
+        exe("(import mod) (pyimport pyimp1)")
+        assert os.path.abspath("mod.lcad") in interpreter.dependencies
+        assert os.path.abspath("pyimp1.py") in interpreter.dependencies
+    finally:
+        interpreter.dependencies = None
+
+def test_import_8():
+    # Modules that use volatile functions are evaluated by every import.
+    code = "(rand-seed 1) (import rmod) (list (rand-uniform) rmod:x)"
+    assert exe(code) == exe(code)
+
+def test_import_9():
+    # Only the most recently used modules are kept.
+    exe("(import mod)")
+    import_function = interpreter.builtin_functions["import"]
+    max_modules = coreFunctions.max_modules
+    coreFunctions.max_modules = 1
+    try:
+        exe("(import mod shared)")
+        assert (len(import_function.modules) == 1)
+        assert (list(import_function.modules.keys())[0][0] == os.path.abspath("shared.lcad"))
+    finally:
+        coreFunctions.max_modules = max_modules
+
+def test_import_10():
+    # Modules are evaluated again when a module that they import or a Python module that they use changes.
+    tmp_dir = tempfile.mkdtemp()
+    import_function = interpreter.builtin_functions["import"]
+    import_function.paths.append(tmp_dir + "/")
+    sys.path.append(tmp_dir)
+    try:
+        with open(os.path.join(tmp_dir, "inner.lcad"), "w") as fp:
+            fp.write("(def y 1)")
+        with open(os.path.join(tmp_dir, "outer.lcad"), "w") as fp:
+            fp.write("(import inner) (def x inner:y)")
+        with open(os.path.join(tmp_dir, "lcadhelper.py"), "w") as fp:
+            fp.write("import opensdraw.lcad_language.interpreter as interp\n")
+            fp.write("class Get(interp.LCadFunction):\n")
+            fp.write("    def __init__(self):\n")
+            fp.write("        interp.LCadFunction.__init__(self, 'get')\n")
+            fp.write("        self.setSignature([])\n")
+            fp.write("    def call(self, model):\n")
+            fp.write("        return 1\n")
+            fp.write("lcad_functions = {'get' : Get()}\n")
+        with open(os.path.join(tmp_dir, "hmod.lcad"), "w") as fp:
+            fp.write("(pyimport lcadhelper)")
+        assert exe("(import outer) outer:x") == 1
+        assert exe("(import hmod :local) (get)") == 1
+
+        with open(os.path.join(tmp_dir, "inner.lcad"), "w") as fp:
+            fp.write("(def y 22)")
+        with open(os.path.join(tmp_dir, "lcadhelper.py"), "a") as fp:
+            fp.write("Get.call = lambda self, model: 2\n")
+        importlib.reload(sys.modules["lcadhelper"])
+        assert exe("(import outer) outer:x") == 22
+        assert exe("(import hmod :local) (get)") == 2
+    finally:
+        import_function.paths.remove(tmp_dir + "/")
+        sys.path.remove(tmp_dir)
+        shutil.rmtree(tmp_dir)
+
 # is-main
 def test_is_main_1():
     assert exe("(if (is-main) 1 2)") == 1
@@ -295,11 +1048,20 @@ def test_lambda_1():
 @nose.tools.raises(lcadExceptions.NumberArgumentsException)
 def test_lambda_2():
     exe("(lambda (x))")
+
+def test_lambda_3():
+    assert exe("(def f (n) (lambda (x) (+ x n))) (+ ((f 1) 2) ((f 5) 2))") == 10
+
+def test_lambda_4():
+    assert exe("(def x 0) (for (i 3) (set x (+ x ((lambda (y) (* y 2)) i)))) x") == 6
     
 # len
 def test_len_1():
     assert exe("(len (list 1 2 3))") == 3
 
+def test_len_2():
+    assert exe("(len (linspace 0 1 7))") == 7
+
 # list
 def test_list_1():
     assert exe("(def x (list 1 2 3)) (aref x 0)") == 1
@@ -341,6 +1103,12 @@ def test_set_5():
 def test_set_6():
     exe("(set t nil)")
 
+def test_set_7():
+    assert exe("(def f (lambda (x) (+ x 1)) g (lambda (x) (* x 10)) r 0) (for (i 2) (set r (+ r (f 1))) (set f g)) r") == 12
+
+def test_set_8():
+    assert exe("(def r 0) (for (f (list + *)) (set r (+ r (f 2 3)))) r") == 11
+
 # while
 def test_while_1():
     assert exe("(def x 0) (while (< x 9) (set x (+ 2 x))) x") == 10
@@ -527,6 +1295,94 @@ def test_py_math_4():
 def test_group_1():
     assert exe("(group \"adsf\" 1)") == 1
 
+def test_group_2():
+    # Parts are stored in columns and sorted by step.
+    model = interpreter.execute("(part '1' 5 2) (translate (list 1 2 3) (part '2' 'red' 1)) (part '1' 5 1)")
+    group = model.groups()[0]
+    assert (group.n_rows == 3) and (group.part_ids == ["1", "2"])
+    [p1, p2, p3] = group.getParts()
+    assert (p1.part_id == "2") and (p1.part_color == "4") and (p1.step == 1)
+    assert (p2.part_id == "1") and (p2.step == 1) and (p3.step == 2)
+    assert (p1.toLDraw() == "1 4 1 2 3 1 0 0 0 1 0 0 0 1 2.dat")
+
+def test_group_3():
+    # Adding the parts of another group with a transform.
+    model = interpreter.execute("(part '1' 5 1) (line (list 0 0 0) (list 1 0 0) 16)")
+    group = model.groups()[0]
+    other = interpreter.Group("other")
+    for i in range(20):
+        other.extend(group, geometry.translationMatrix(i, 0, 0), i)
+    assert (other.n_rows == 20) and (other.getNParts() == 20) and (other.getNPrimitives() == 20)
+    items = other.getParts()
+    assert (items[0].coords[3] == 1) and (items[-1].step == 20) and (items[-1].matrix[0,3] == 19)
+
+# ldrawWriter
+def test_ldraw_writer_1():
+    # The same as formatting each part with Part.toLDraw().
+    model = interpreter.execute("(group 'sub.ldr' (part '1' 5)) (rotate (list 30 0 0) (part '2' 'red' 2)) (part 'sub.ldr' 16 1) (line (list 0 0 0) (list 1.0004 0 0) 16)")
+    fp = io.StringIO()
+    ldrawWriter.writeModel(model, fp, "test", "test.lcad")
+    [line, sub, part] = [item.toLDraw() for item in model.groups()[0].getParts()]
+    sub = sub.replace("sub.ldr", "test - sub.ldr")
+    lines = fp.getvalue().split("\n")
+    assert (lines[:8] == ["0 FILE test - main", "0 // Generated by opensdraw from test.lcad", "", line, "0 STEP", sub, "0 STEP", part])
+    assert (lines[8:13] == ["", "", "0 FILE test - sub.ldr", "", "1 5 0 0 0 1 0 0 0 1 0 0 0 1 1.dat"])
+
+def test_ldraw_writer_2():
+    # Spilling the parts to temporary files does not change the output.
+    code = "(defmemo fn (x) (part '1' x (% x 3))) (for (i 20) (translate (list i 0 0) (fn i))) (triangle (list 0 0 0) (list 1 0 0) (list 0 1 0) 16)"
+    fp = io.StringIO()
+    ldrawWriter.writeModel(interpreter.execute(code), fp, "test", "test.lcad")
+
+    sink = ldrawWriter.SpillSink(block_size = 3)
+    try:
+        model = interpreter.execute(code, sink = sink)
+        assert (model.groups()[0].n_rows < 3) and (model.groups()[0].getNParts() == 20)
+        spill_fp = io.StringIO()
+        ldrawWriter.writeModel(model, spill_fp, "test", "test.lcad")
+    finally:
+        sink.close()
+    assert (spill_fp.getvalue() == fp.getvalue())
+    assert not os.path.exists(sink.directory)
+
+def test_ldraw_writer_3():
+    # Bytes, gzip and a file for each group.
+    model = interpreter.execute("(group 'sub.ldr' (part '1' 5)) (part 'sub.ldr' 16) (comment 'x')")
+    fp = io.StringIO()
+    ldrawWriter.writeModel(model, fp, "test", "test.lcad")
+    assert (ldrawWriter.modelBytes(model, "test") == fp.getvalue().encode("utf-8"))
+    assert (gzip.decompress(ldrawWriter.modelBytes(model, "test", compress = True)) == fp.getvalue().encode("utf-8"))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ldrawWriter.saveModel(model, os.path.join(tmp_dir, "test.mpd.gz"))
+        with gzip.open(os.path.join(tmp_dir, "test.mpd.gz"), "rt") as gz_fp:
+            assert (gz_fp.read() == fp.getvalue())
+
+        ldrawWriter.saveModel(model, os.path.join(tmp_dir, "test"), split = True)
+        assert (sorted(os.listdir(os.path.join(tmp_dir, "test"))) == ["test - main.ldr", "test - sub.ldr"])
+        with open(os.path.join(tmp_dir, "test", "test - main.ldr")) as main_fp:
+            assert (main_fp.read().split("\n")[:4] == ["0 // Generated by opensdraw from test.lcad", "", "1 16 0 0 0 1 0 0 0 1 0 0 0 1 test - sub.ldr", "0 x"])
+
+def test_ldraw_writer_4():
+    # The runs are merged a few at a time when there are more runs than merge_fan_in.
+    code = "(for (i 150) (part '1' i (% (* i 7) 5))) (triangle (list 0 0 0) (list 1 0 0) (list 0 1 0) 16)"
+    fp = io.StringIO()
+    ldrawWriter.writeModel(interpreter.execute(code), fp, "test", "test.lcad")
+
+    for merge_fan_in in [64, 4]:
+        ldrawWriter.merge_fan_in = merge_fan_in
+        sink = ldrawWriter.SpillSink(block_size = 1)
+        try:
+            model = interpreter.execute(code, sink = sink)
+            spill_fp = io.StringIO()
+            ldrawWriter.writeModel(model, spill_fp, "test", "test.lcad")
+            assert (sink.n_runs > 151)
+            assert (len(os.listdir(sink.directory)) <= merge_fan_in)
+        finally:
+            ldrawWriter.merge_fan_in = 64
+            sink.close()
+        assert (spill_fp.getvalue() == fp.getvalue())
+
 # header
 def test_header_1():
     assert exe("(header \"asdf\")") == "asdf"
@@ -592,6 +1448,12 @@ def test_rand_uniform_2():
 
 
 ## Type Functions.
+def test_is_array_1():
+    assert exe("(if (array? (arange 2)) 1 0)") == 1
+
+def test_is_array_2():
+    assert exe("(if (array? (vector 0 0 0)) 1 0)") == 0
+
 def test_is_boolean_1():
     assert exe("(if (boolean? nil) 1 0)") == 1
 